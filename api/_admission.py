@@ -0,0 +1,255 @@
+"""Rate limiting and admission control for the API.
+
+Each limit is a token bucket per key (a client address, a session): it
+holds up to `burst` tokens, refills at `rate` tokens a second, and a request
+spends one. A request that finds the bucket empty is refused with the
+seconds until a token is back, which the API sends as Retry-After.
+
+Buckets are kept as the time at which they will be full again (GCRA, the
+"generic cell rate algorithm"), one number per key, so the shared stores
+can hold them too:
+
+    memory                         per process (default)
+    sqlite:///relative/path.db     shared by the workers on one machine
+    redis://[:password@]host:port/db  shared by every instance
+
+A Redis server can't update such a bucket atomically without scripting, so
+there each bucket becomes a counter of `burst` requests per window of
+burst / rate seconds (INCRBY and EXPIRE in one pipeline). A shared store
+that fails lets requests through rather than taking the API down with it.
+
+`AdmissionControl` also caps the requests being handled at once and sheds
+the rest with a 503 before any session work is done for them.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote, urlparse
+
+from _session_backends import RespClient
+
+
+class MemoryBuckets:
+    """Token buckets in this process, least recently used dropped past max_keys"""
+    name = "memory"
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._full_at = OrderedDict()  # key -> time the bucket is full again
+
+    def take(self, key, now=None):
+        """Spend a token; returns 0, or the seconds until one is available"""
+        now = time.time() if now is None else now
+        with self._lock:
+            full_at = max(self._full_at.get(key, now), now) + self.interval
+            wait = full_at - now - self.tolerance
+            if wait > 0:
+                return wait
+            self._full_at[key] = full_at
+            self._full_at.move_to_end(key)
+            while len(self._full_at) > self.max_keys:
+                self._full_at.popitem(last=False)
+        return 0
+
+    def size(self):
+        with self._lock:
+            return len(self._full_at)
+
+
+class SQLiteBuckets:
+    """Token buckets in a SQLite table, shared by local workers"""
+    name = "sqlite"
+    SWEEP_EVERY = 1000  # takes between deletes of full buckets
+
+    def __init__(self, path, rate, burst, prefix):
+        self.path = path
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+        self.prefix = prefix
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._takes = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, full_at REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, now=None):
+        now = time.time() if now is None else now
+        key = self.prefix + key
+        conn = self._conn()
+        with conn:
+            # Taken for writing up front, so two workers can't both spend the last token
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT full_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            full_at = max(row[0] if row else now, now) + self.interval
+            wait = full_at - now - self.tolerance
+            if wait > 0:
+                return wait
+            conn.execute("INSERT OR REPLACE INTO rate_buckets (key, full_at) VALUES (?, ?)", (key, full_at))
+        with self._lock:
+            self._takes += 1
+            due = self._takes >= self.SWEEP_EVERY
+            if due:
+                self._takes = 0
+        if due:
+            conn.execute("DELETE FROM rate_buckets WHERE full_at <= ?", (now,))
+        return 0
+
+    def size(self):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM rate_buckets WHERE key LIKE ? AND full_at > ?",
+            (self.prefix + "%", time.time())).fetchone()[0]
+
+
+class RedisBuckets:
+    """Fixed-window counters on a Redis-compatible server"""
+    name = "redis"
+
+    def __init__(self, client, rate, burst, prefix):
+        self.client = client
+        self.window = burst / rate
+        self.burst = burst
+        self.prefix = prefix
+
+    def take(self, key, now=None):
+        now = time.time() if now is None else now
+        window = int(now // self.window)
+        name = f"{self.prefix}{key}:{window}"
+        count, _ = self.client.execute(("INCRBY", name, 1),
+                                       ("EXPIRE", name, int(self.window) + 1))
+        if count > self.burst:
+            return (window + 1) * self.window - now
+        return 0
+
+    def size(self):
+        return None  # the server expires the counters
+
+
+def create_buckets(url, rate, burst, name):
+    """Buckets for one limit from a RATE_LIMIT_BACKEND url (see the module docstring)"""
+    if not url or url == "memory":
+        return MemoryBuckets(rate, burst)
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        path = unquote(parsed.path[1:] if parsed.path.startswith("/") else parsed.path)
+        return SQLiteBuckets(path, rate, burst, prefix=name + ":")
+    if parsed.scheme == "redis":
+        db = int(parsed.path[1:]) if parsed.path[1:] else 0
+        client = RespClient(parsed.hostname or "127.0.0.1", parsed.port or 6379, db=db,
+                            password=unquote(parsed.password) if parsed.password else None)
+        return RedisBuckets(client, rate, burst, prefix=f"mff:rate:{name}:")
+    raise ValueError(f"Unsupported RATE_LIMIT_BACKEND: {url}")
+
+
+def client_address(remote_addr, forwarded_for, proxy_hops=0):
+    """The client's address, trusting X-Forwarded-For for `proxy_hops` proxies"""
+    if proxy_hops and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if len(hops) >= proxy_hops:
+            return hops[-proxy_hops]
+    return remote_addr or "unknown"
+
+
+class Rejection:
+    """Why a request was refused: the status, Retry-After seconds and message"""
+    __slots__ = ("status", "retry_after", "error")
+
+    def __init__(self, status, retry_after, error):
+        self.status = status
+        self.retry_after = retry_after
+        self.error = error
+
+    @property
+    def retry_after_header(self):
+        return str(max(1, int(self.retry_after + 0.999)))
+
+
+class AdmissionControl:
+    """Per-client and per-session rate limits plus a cap on concurrent requests
+
+    `limits` maps "client", "new_session" and "session" to buckets (any may
+    be missing to turn that limit off); `max_in_flight` 0 means no cap.
+    """
+
+    def __init__(self, limits, max_in_flight=0):
+        self.limits = limits
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.limited = 0
+        self.store_errors = 0
+
+    def enter(self):
+        """Claim a slot for a request; returns a Rejection when the API is full"""
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return Rejection(503, 1, "Server is busy, please retry")
+            self.in_flight += 1
+            self.admitted += 1
+        return None
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def check(self, client, session_id=None):
+        """Spend the request's tokens; returns a Rejection if a bucket is empty"""
+        rejection = self._take("client", client)
+        if rejection is None and session_id:
+            rejection = self._take("session", session_id)
+        return rejection
+
+    def check_new_session(self, client):
+        """Spend a client's token for starting a session; a Rejection if it has none"""
+        return self._take("new_session", client)
+
+    def _take(self, name, key):
+        buckets = self.limits.get(name)
+        if buckets is None:
+            return None
+        try:
+            wait = buckets.take(key)
+        except Exception as e:
+            print(f"Rate limit store error ({name}): {str(e)}")
+            with self._lock:
+                self.store_errors += 1
+            return None
+        if not wait:
+            return None
+        with self._lock:
+            self.limited += 1
+        return Rejection(429, wait, "Too many requests, please slow down")
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "limited": self.limited,
+                "store_errors": self.store_errors
+            }
+        for name, buckets in self.limits.items():
+            if buckets is not None and buckets.name == "memory":
+                stats[f"{name}_buckets"] = buckets.size()
+        return stats
@@ -0,0 +1,176 @@
+"""Minimal asyncio HTTP/1.1 client for upstream image fetches.
+
+Just enough of HTTP for GETting images from the render service: keep-alive
+connection pooling per host, Content-Length, chunked and read-to-close
+bodies, redirects and an overall per-request timeout. Waiting on a slow
+render costs a coroutine rather than a worker thread, which is what lets
+the ASGI app (api/asgi.py) hold thousands of image fetches in flight.
+"""
+import asyncio
+import ssl
+from urllib.parse import urljoin, urlsplit
+
+_REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class AsyncHTTPError(Exception):
+    """The request could not be completed"""
+
+
+class _Response:
+    __slots__ = ("status", "headers", "body", "keep_alive")
+
+    def __init__(self, status, headers, body, keep_alive):
+        self.status = status
+        self.headers = headers  # lower-cased names
+        self.body = body
+        self.keep_alive = keep_alive
+
+
+class AsyncHTTPClient:
+    """Pooled keep-alive connections, at most `per_host` open per host"""
+
+    def __init__(self, per_host=64, timeout=60, max_redirects=3):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._idle = {}  # (scheme, host, port) -> [(reader, writer)]
+        self._slots = {}  # (scheme, host, port) -> Semaphore
+        self._ssl = None
+        self.requests = 0
+        self.reused = 0
+        self.errors = 0
+
+    async def get(self, url, timeout=None):
+        """GET a URL; returns (status, headers, body) with lower-cased header names"""
+        try:
+            return await asyncio.wait_for(self._get(url), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            raise AsyncHTTPError(f"Timed out fetching {url}")
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            self.errors += 1
+            raise AsyncHTTPError(f"Request to {url} failed: {e}")
+
+    async def _get(self, url):
+        for _ in range(self.max_redirects + 1):
+            response = await self._request(url)
+            location = response.headers.get("location")
+            if response.status not in _REDIRECTS or not location:
+                return response.status, response.headers, response.body
+            url = urljoin(url, location)
+        raise AsyncHTTPError(f"Too many redirects fetching {url}")
+
+    async def _request(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported URL scheme {parts.scheme!r}")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        origin = (parts.scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        request = (f"GET {target} HTTP/1.1\r\nHost: {host}\r\n"
+                   "User-Agent: mystic-forest-flow\r\nAccept: */*\r\n"
+                   "Connection: keep-alive\r\n\r\n").encode("latin-1")
+
+        slots = self._slots.get(origin)
+        if slots is None:
+            slots = self._slots[origin] = asyncio.Semaphore(self.per_host)
+        async with slots:
+            self.requests += 1
+            idle = self._idle.setdefault(origin, [])
+            while idle:
+                reader, writer = idle.pop()
+                if writer.is_closing() or reader.at_eof():
+                    writer.close()
+                    continue
+                try:
+                    response = await self._exchange(reader, writer, request)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    # The server dropped an idle keep-alive connection
+                    writer.close()
+                    continue
+                except BaseException:
+                    writer.close()
+                    raise
+                self.reused += 1
+                return self._release(origin, reader, writer, response)
+
+            reader, writer = await self._connect(origin)
+            try:
+                response = await self._exchange(reader, writer, request)
+            except BaseException:
+                writer.close()
+                raise
+            return self._release(origin, reader, writer, response)
+
+    async def _connect(self, origin):
+        scheme, hostname, port = origin
+        context = None
+        if scheme == "https":
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        return await asyncio.open_connection(hostname, port, ssl=context)
+
+    def _release(self, origin, reader, writer, response):
+        if response.keep_alive:
+            self._idle[origin].append((reader, writer))
+        else:
+            writer.close()
+        return response
+
+    async def _exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = status_line.decode("latin-1").split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (version == "HTTP/1.1"
+                      and headers.get("connection", "").lower() != "close")
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked(reader)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        elif int(status) in (204, 304) or 100 <= int(status) < 200:
+            body = b""
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return _Response(int(status), headers, body, keep_alive)
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                # Trailers, then the blank line ending the body
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "reused_connections": self.reused,
+            "idle_connections": sum(len(c) for c in self._idle.values()),
+            "errors": self.errors
+        }
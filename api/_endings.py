@@ -0,0 +1,79 @@
+"""How `_calculate_end` picks an ending, compiled from a story pack.
+
+Every choice carries the integer weight of its tag (see the pack's
+"ending_rules"), and a journey view keeps the running sum of those weights,
+the balance, next to its score. Each choice therefore updates both in O(1)
+and classifying an ending is a walk over a handful of rules, with no scan of
+the sentiment tally.
+
+`EndingResolver.reachable` lists every ending a game can still reach from a
+(node, score, balance) state, memoized per state, for prefetching and
+analytics.
+"""
+from _story_graph import CALCULATE_END
+
+# Reachability memo entries kept per resolver before it starts over
+MAX_MEMO = 100000
+
+
+class EndingResolver:
+    """`_calculate_end` for one story graph"""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.rules = graph.ending_rules
+        self._reachable = {}  # (node index, score, balance) -> frozenset of node ids
+
+    def classify(self, score, balance):
+        """The generic ending a score and tag balance get"""
+        for rule in self.rules:
+            if rule.matches(score, balance):
+                return rule.ending
+        return self.rules[-1].ending
+
+    def resolve(self, score, balance, session_hash):
+        """The ending node a session lands on; its hash picks the variant"""
+        generic = self.classify(score, balance)
+        variants = self.graph.endings.get(generic)
+        if variants:
+            variant = variants[session_hash % len(variants)]
+            if variant in self.graph:
+                return variant
+        return generic
+
+    def candidates(self, score, balance):
+        """Every ending node `_calculate_end` can resolve to, over all sessions"""
+        generic = self.classify(score, balance)
+        variants = [variant for variant in self.graph.endings.get(generic, ()) if variant in self.graph]
+        return frozenset(variants or (generic,))
+
+    def reachable(self, node_index, score=0, balance=0, _depth=0):
+        """Ids of every ending reachable from a node with a score and balance
+
+        Stories are expected to be acyclic; in one with loops, paths are cut
+        once they are longer than the story has nodes.
+        """
+        key = (node_index, score, balance)
+        found = self._reachable.get(key)
+        if found is not None:
+            return found
+        if _depth > len(self.graph):
+            return frozenset()
+        node = self.graph.nodes[node_index]
+        if node.is_end:
+            found = frozenset((node.id,))
+        else:
+            endings = set()
+            for choice in node.choices:
+                if choice.next_index == CALCULATE_END:
+                    # Resolved from the state the choice is taken in, before
+                    # its own modifier and weight count (see resolve_next_node)
+                    endings |= self.candidates(score, balance)
+                else:
+                    endings |= self.reachable(choice.next_index, score + choice.score_modifier,
+                                              balance + choice.weight, _depth + 1)
+            found = frozenset(endings)
+        if len(self._reachable) >= MAX_MEMO:
+            self._reachable.clear()
+        self._reachable[key] = found
+        return found
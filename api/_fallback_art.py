@@ -0,0 +1,97 @@
+"""Pre-rendered stand-in pictures for when the image service is down.
+
+One small SVG per story node: a forest silhouette under a sky whose colours
+come from a hash of the node id, captioned with the start of the node's
+situation. They are drawn from the story packs at startup (and again for
+new pack versions on first use), so serving one needs no upstream and no
+Pillow. The same node always gets the same picture.
+"""
+import hashlib
+import textwrap
+import threading
+from xml.sax.saxutils import escape
+
+WIDTH = 1024
+HEIGHT = 1024
+CAPTION_CHARS = 34
+CAPTION_LINES = 3
+TREE_COUNT = 9
+
+
+class FallbackArt:
+    """(pack id, node id) -> SVG bytes, for the packs in a PackRegistry"""
+
+    def __init__(self, story_packs):
+        self.story_packs = story_packs
+        self._lock = threading.Lock()
+        self._art = {}  # (pack id, version, node id) -> bytes
+        self.rendered = 0
+        self.served = 0
+        for pack_id in story_packs.ids():
+            pack = story_packs.current(pack_id)
+            for node in pack.graph.nodes:
+                self._render(pack, node.id)
+
+    def get(self, pack_id, node_id):
+        """SVG bytes for a node of the current pack version, or None for an unknown pack"""
+        pack = self.story_packs.current(pack_id)
+        if pack is None:
+            return None
+        with self._lock:
+            self.served += 1
+            svg = self._art.get((pack.id, pack.version, node_id))
+        return svg if svg is not None else self._render(pack, node_id)
+
+    def _render(self, pack, node_id):
+        node = pack.graph.get(node_id)
+        # A node a newer pack version dropped still gets a picture
+        caption = node.situation if node is not None else pack.title
+        svg = render_svg(f"{pack.id}/{node_id}", caption).encode()
+        with self._lock:
+            if len(self._art) > 10000:
+                self._art.clear()
+            self._art[(pack.id, pack.version, node_id)] = svg
+            self.rendered += 1
+        return svg
+
+    def stats(self):
+        with self._lock:
+            return {"pictures": len(self._art), "rendered": self.rendered, "served": self.served}
+
+
+def render_svg(seed, caption):
+    """A deterministic forest picture for `seed` with `caption` along the bottom"""
+    digest = hashlib.sha256(seed.encode()).digest()
+    sky_hue = digest[0] * 360 // 256
+    ground_hue = (sky_hue + 90 + digest[1] % 60) % 360
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{HEIGHT}" '
+        f'viewBox="0 0 {WIDTH} {HEIGHT}">',
+        '<defs><linearGradient id="sky" x1="0" y1="0" x2="0" y2="1">'
+        f'<stop offset="0" stop-color="hsl({sky_hue},45%,22%)"/>'
+        f'<stop offset="1" stop-color="hsl({(sky_hue + 40) % 360},55%,58%)"/>'
+        '</linearGradient></defs>',
+        f'<rect width="{WIDTH}" height="{HEIGHT}" fill="url(#sky)"/>',
+        f'<circle cx="{200 + digest[2] * 3}" cy="{180 + digest[3] % 120}" r="70" '
+        f'fill="hsl({(sky_hue + 180) % 360},60%,85%)" opacity="0.8"/>'
+    ]
+    # Two rows of pines, the nearer one darker and larger
+    for row, (base, scale, light) in enumerate(((720, 1.0, 28), (860, 1.5, 16))):
+        for i in range(TREE_COUNT):
+            byte = digest[4 + row * TREE_COUNT + i]
+            x = i * WIDTH // (TREE_COUNT - 1) + byte % 60 - 30
+            height = int((180 + byte % 120) * scale)
+            half = int((50 + byte % 30) * scale)
+            parts.append(f'<polygon points="{x},{base - height} {x - half},{base} {x + half},{base}" '
+                         f'fill="hsl({ground_hue},35%,{light}%)"/>')
+    parts.append(f'<rect y="{HEIGHT - 250}" width="{WIDTH}" height="250" '
+                 f'fill="hsl({ground_hue},30%,10%)" opacity="0.85"/>')
+    lines = textwrap.wrap(caption, CAPTION_CHARS)
+    if len(lines) > CAPTION_LINES:
+        lines = lines[:CAPTION_LINES]
+        lines[-1] = lines[-1].rstrip(".,;: ") + "…"
+    for i, line in enumerate(lines):
+        parts.append(f'<text x="{WIDTH // 2}" y="{HEIGHT - 175 + i * 62}" text-anchor="middle" '
+                     f'font-family="Georgia, serif" font-size="44" fill="#f0ecde">{escape(line)}</text>')
+    parts.append("</svg>")
+    return "".join(parts)
@@ -0,0 +1,19 @@
+"""Small file helpers shared by the on-disk caches."""
+import os
+import tempfile
+
+
+def write_atomic(path, data):
+    """Write bytes to `path` through a temporary file, so readers never see half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,453 @@
+"""Server-side proxy cache for generated images.
+
+Image URLs handed to the browser point at `/api/image/<key>`, where the key
+carries the image's prompt and seed, signed with a secret (IMAGE_KEY_SECRET,
+or one kept in the cache directory): any process holding the secret can
+turn a key back into its upstream render URL, with nothing to look up.
+Because prompts are deterministic, a key always names the same picture, so
+fetched images are kept in an on-disk cache under a hash of the upstream URL
+with a size cap and least-recently-used eviction, and served with a strong
+ETag taken from a hash of the image bytes.
+
+`AsyncImageFetcher` puts the same cache behind asyncio for the ASGI app, so
+a miss waits on a coroutine instead of a thread.
+
+With an `UpstreamPolicy` (see _resilience.py) every upstream fetch runs
+under its deadline, hedging, retry budget and circuit breaker. Keys can be
+registered with the (pack id, node id) they illustrate, so a caller whose
+fetch failed can show that node's fallback art instead.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from _async_http import AsyncHTTPError
+from _files import write_atomic
+from _resilience import CircuitOpenError, DeadlineExceeded
+
+KEY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,4096}\.[A-Za-z0-9_-]{16}$")
+
+
+class ImageFetchError(Exception):
+    """The upstream image service did not return an image
+
+    `retryable` is False when asking again won't help (the service said
+    the request itself was bad); `retry_after` is set when the circuit
+    breaker refused the fetch, to the seconds until it lets one through.
+    """
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CachedImage:
+    __slots__ = ("key", "path", "content_type", "etag", "size")
+
+    def __init__(self, key, path, content_type, etag, size):
+        self.key = key
+        self.path = path
+        self.content_type = content_type
+        self.etag = etag
+        self.size = size
+
+
+class _Flight:
+    """One in-progress upstream fetch that other requests can wait on"""
+    __slots__ = ("done", "image", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.image = None
+        self.error = None
+
+
+def cache_name(upstream_url):
+    """The name an upstream URL's image is stored under"""
+    return hashlib.sha256(upstream_url.encode()).hexdigest()[:32]
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _remember(mapping, key, value, limit=10000):
+    mapping[key] = value
+    mapping.move_to_end(key)
+    while len(mapping) > limit:
+        mapping.popitem(last=False)
+
+
+class ImageCache:
+    """Content-addressed disk cache with single-flight upstream fetches
+
+    `url_for(prompt, seed)` builds the upstream render URL for a key.
+    """
+
+    def __init__(self, url_for, directory=None, max_bytes=512 * 1024 * 1024, timeout=60,
+                 pool_size=32, policy=None, secret=None):
+        self.url_for = url_for
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "mystic-forest-images")
+        self.max_bytes = max_bytes
+        self.timeout = timeout  # per upstream request
+        self.policy = policy
+        os.makedirs(self.directory, exist_ok=True)
+        self._secret = secret.encode() if secret else self._load_secret()
+        # Keys are only valid where the same secret is, and so are responses linking to them
+        self.key_id = hashlib.sha256(self._secret).hexdigest()[:16]
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # name -> bytes on disk, least recently used first
+        self._bytes = 0
+        self._signed = OrderedDict()  # (prompt, seed, fallback) -> key, bounded
+        self._opened = OrderedDict()  # key -> (name, upstream url, fallback), bounded
+        self._flights = {}  # name -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_fetches = 0
+        self.upstream_errors = 0
+        self.evictions = 0
+        self._load_index()
+
+    # --- Paths ---
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name[:2], name + suffix)
+
+    def _load_index(self):
+        """Rebuild the LRU order from what is already on disk"""
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".img"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                        meta_size = os.path.getsize(path[:-4] + ".json")
+                    except OSError:
+                        continue
+                    found.append((stat.st_mtime, name[:-4], stat.st_size + meta_size))
+                elif name.endswith(".src"):
+                    # Left by versions that kept a key registry on disk
+                    try:
+                        os.unlink(os.path.join(root, name))
+                    except OSError:
+                        pass
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._bytes += size
+
+    def _load_secret(self):
+        """A random signing secret shared by every process using this directory"""
+        path = os.path.join(self.directory, "key-secret")
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32).hex().encode())
+            os.link(tmp_path, path)  # fails if another process got there first
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    # --- Keys ---
+    def register(self, prompt, seed, fallback=None):
+        """Return the proxy key for a prompt's image at a seed
+
+        The key carries the prompt, the seed and `fallback` (the (pack id,
+        node id) the image illustrates, for `fallback_of`), signed with the
+        cache's secret, so every process holding the secret can serve it
+        without a shared registry.
+        """
+        with self._lock:
+            key = self._signed.get((prompt, seed, fallback))
+        if key is not None:
+            return key
+        fields = [prompt, seed] + (list(fallback) if fallback else [])
+        payload = _b64(zlib.compress(json.dumps(fields, separators=(",", ":")).encode(), 9))
+        key = f"{payload}.{self._sign(payload)}"
+        upstream_url = self.url_for(prompt, seed)
+        entry = (cache_name(upstream_url), upstream_url, fallback)
+        with self._lock:
+            _remember(self._signed, (prompt, seed, fallback), key)
+            _remember(self._opened, key, entry)
+        return key
+
+    def _sign(self, payload):
+        return _b64(hmac.new(self._secret, payload.encode(), hashlib.sha256).digest()[:12])
+
+    def _open(self, key):
+        """(cache file name, upstream URL, fallback) for a key; KeyError if we didn't sign it"""
+        with self._lock:
+            entry = self._opened.get(key)
+        if entry is not None:
+            return entry
+        payload, _, signature = key.partition(".")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise KeyError(key)
+        fields = json.loads(zlib.decompress(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))))
+        upstream_url = self.url_for(fields[0], fields[1])
+        entry = (cache_name(upstream_url), upstream_url, tuple(fields[2:4]) or None)
+        with self._lock:
+            _remember(self._opened, key, entry)
+        return entry
+
+    def source(self, key):
+        """The upstream URL a key stands for, or None"""
+        try:
+            return self._open(key)[1]
+        except KeyError:
+            return None
+
+    def fallback_of(self, key):
+        """The (pack id, node id) a key was registered with, or None"""
+        try:
+            return self._open(key)[2]
+        except KeyError:
+            return None
+
+    # --- Cache ---
+    def contains(self, key):
+        try:
+            name = self._open(key)[0]
+        except KeyError:
+            return False
+        with self._lock:
+            return name in self._entries
+
+    def lookup(self, key):
+        """Return the cached image for a key, or None"""
+        try:
+            return self._lookup(self._open(key)[0])
+        except KeyError:
+            return None
+
+    def _lookup(self, name):
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            with open(self._path(name, ".json"), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self._forget(name)
+            return None
+        path = self._path(name, ".img")
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(name)
+            return None
+        return CachedImage(name, path, meta["content_type"], meta["etag"], meta["size"])
+
+    def get(self, key):
+        """Return the image for a key, fetching it upstream on a miss
+
+        Concurrent misses for the same image share one upstream request.
+        Raises KeyError for a key this cache didn't sign.
+        """
+        name, upstream_url, _ = self._open(key)
+        image = self._lookup(name)
+        if image is not None:
+            with self._lock:
+                self.hits += 1
+            return image
+
+        with self._lock:
+            flight = self._flights.get(name)
+            cached = flight is None and name in self._entries
+            leader = flight is None and not cached
+            if leader:
+                flight = self._flights[name] = _Flight()
+                self.misses += 1
+            elif not cached:
+                self.coalesced += 1
+
+        if cached:
+            # Another request finished fetching it since our lookup
+            return self.get(key)
+        if not leader:
+            if not flight.done.wait(self.policy.deadline if self.policy else self.timeout):
+                raise ImageFetchError("Timed out waiting for image")
+            if flight.error is not None:
+                raise flight.error
+            return flight.image
+
+        try:
+            flight.image = self._fetch(name, upstream_url)
+            return flight.image
+        except Exception as e:
+            flight.error = e if isinstance(e, ImageFetchError) else ImageFetchError(str(e))
+            raise flight.error
+        finally:
+            with self._lock:
+                self._flights.pop(name, None)
+            flight.done.set()
+
+    def _fetch(self, name, upstream_url):
+        def attempt(timeout):
+            self._tally("upstream_fetches")
+            try:
+                response = self.http.get(upstream_url, timeout=timeout)
+            except requests.RequestException as e:
+                raise self._upstream_failed(f"Upstream request failed: {e}")
+            return self._accept(name, response.status_code, response.headers.get("Content-Type"),
+                                response.content)
+
+        if self.policy is None:
+            return attempt(self.timeout)
+        try:
+            return self.policy.call(attempt)
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            raise self._refused(e)
+
+    def _upstream_failed(self, message, retryable=True):
+        self._tally("upstream_errors")
+        return ImageFetchError(message, retryable)
+
+    def _refused(self, error):
+        """ImageFetchError for a fetch the policy gave up on or never tried"""
+        if isinstance(error, CircuitOpenError):
+            return ImageFetchError(str(error), False, self.policy.breaker.retry_after())
+        return ImageFetchError(str(error))
+
+    def _accept(self, name, status, content_type, data):
+        """Store an upstream response if it is an image"""
+        content_type = (content_type or "image/jpeg").split(";")[0]
+        if status != 200 or not content_type.startswith("image/"):
+            # Overload and server errors may pass; anything else won't
+            retryable = status == 200 or status == 429 or status >= 500
+            raise self._upstream_failed(f"Upstream returned {status} ({content_type})", retryable)
+        return self.store(name, data, content_type)
+
+    def _tally(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def store(self, name, data, content_type):
+        """Add image bytes to the cache and evict old entries over the cap"""
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        meta = {"content_type": content_type, "etag": etag, "size": len(data),
+                "stored_at": time.time()}
+        meta_data = json.dumps(meta).encode()
+        path = self._path(name, ".img")
+        write_atomic(path, data)
+        write_atomic(self._path(name, ".json"), meta_data)
+        with self._lock:
+            # The metadata file counts against max_bytes too
+            self._bytes -= self._entries.pop(name, 0)
+            self._entries[name] = len(data) + len(meta_data)
+            self._bytes += len(data) + len(meta_data)
+            self._evict()
+        return CachedImage(name, path, content_type, etag, len(data))
+
+    def _forget(self, name):
+        self._bytes -= self._entries.pop(name, 0)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            for suffix in (".img", ".json"):
+                try:
+                    os.unlink(self._path(name, suffix))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "images": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "upstream_fetches": self.upstream_fetches,
+                "upstream_errors": self.upstream_errors,
+                "evictions": self.evictions
+            }
+
+
+class AsyncImageFetcher:
+    """Cache misses fetched on the event loop with an AsyncHTTPClient
+
+    Concurrent misses for a key share one fetch, as with ImageCache.get.
+    Disk writes go to `executor` (the loop's default one if None).
+    """
+
+    def __init__(self, cache, client, executor=None):
+        self.cache = cache
+        self.client = client
+        self.executor = executor
+        self._flights = {}  # name -> Task
+
+    async def get(self, key):
+        name, upstream_url, _ = self.cache._open(key)
+        image = self.cache._lookup(name)
+        if image is not None:
+            self.cache._tally("hits")
+            return image
+
+        flight = self._flights.get(name)
+        if flight is None:
+            self.cache._tally("misses")
+            flight = self._flights[name] = asyncio.ensure_future(self._fetch(name, upstream_url))
+            flight.add_done_callback(lambda done: self._landed(name, done))
+        else:
+            self.cache._tally("coalesced")
+        # A waiter giving up (a cancelled prefetch) must not cancel the fetch
+        # other requests are waiting on
+        return await asyncio.shield(flight)
+
+    def _landed(self, name, flight):
+        self._flights.pop(name, None)
+        if not flight.cancelled():
+            flight.exception()  # retrieved, even if every waiter went away
+
+    async def _fetch(self, name, upstream_url):
+        loop = asyncio.get_running_loop()
+
+        async def attempt(timeout):
+            self.cache._tally("upstream_fetches")
+            try:
+                status, headers, body = await self.client.get(upstream_url, timeout)
+            except AsyncHTTPError as e:
+                raise self.cache._upstream_failed(f"Upstream request failed: {e}")
+            return await loop.run_in_executor(self.executor, self.cache._accept, name, status,
+                                              headers.get("content-type"), body)
+
+        policy = self.cache.policy
+        if policy is None:
+            return await attempt(self.cache.timeout)
+        try:
+            return await policy.call_async(attempt)
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            raise self.cache._refused(e)
+
+    def in_flight(self):
+        return len(self._flights)
@@ -0,0 +1,166 @@
+"""Compact, append-only record of one player's game.
+
+A game used to be stored as a dict whose `path_history` and `choice_history`
+lists repeated node ids and full choice texts at every step. A `Journey`
+keeps only the (node index, choice index) pair of each step in an `array`,
+plus the node the player is on. Score, sentiment tally, the weighted tag
+balance the ending rules use, path and the readable history are all
+replayed from the compiled story graph when they are needed, which is cheap
+because a game is a handful of steps.
+"""
+import base64
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+# Two unsigned 16-bit values per step: node index, choice index
+_TYPECODE = "H"
+
+
+class JourneyError(ValueError):
+    """A journey doesn't fit the story graph it is replayed on"""
+
+
+def _history_entry(node, choice):
+    return {
+        "from_node": node.id,
+        "choice_index": choice.index,
+        "choice_text": choice.text,
+        "tag": choice.tag
+    }
+
+
+class JourneyView(namedtuple("JourneyView", [
+        "path_history", "score", "sentiment_tally", "steps", "balance"])):
+    """What a journey adds up to; `steps` holds (node, choice) pairs
+
+    `balance` is the sum of the choices' tag weights (see _endings).
+    """
+    __slots__ = ()
+
+    @property
+    def choice_history(self):
+        """The history in the dict form the API has always used"""
+        return [_history_entry(node, choice) for node, choice in self.steps]
+
+    @property
+    def last_choice(self):
+        return _history_entry(*self.steps[-1]) if self.steps else None
+
+    def after(self, node, choice, next_node_id):
+        """The view once `choice` at `node` has led to `next_node_id`"""
+        sentiment_tally = dict(self.sentiment_tally)
+        if choice.tag:
+            sentiment_tally[choice.tag] = sentiment_tally.get(choice.tag, 0) + 1
+        return JourneyView(self.path_history + [next_node_id],
+                           self.score + choice.score_modifier, sentiment_tally,
+                           self.steps + [(node, choice)], self.balance + choice.weight)
+
+
+class Journey:
+    """One game: the pack it is pinned to and the choices taken so far"""
+    __slots__ = ("pack_id", "pack_version", "start", "current", "steps",
+                 "image_reroll", "created_at", "share")
+
+    def __init__(self, pack_id, pack_version, start, current=None, steps=None,
+                 image_reroll=0, created_at=None, share=None):
+        self.pack_id = pack_id
+        self.pack_version = pack_version
+        self.start = start  # node index the game began on
+        self.current = start if current is None else current
+        self.steps = steps if steps is not None else array(_TYPECODE)
+        self.image_reroll = image_reroll  # bumped by POST /api/reroll
+        self.created_at = time.time() if created_at is None else created_at
+        self.share = share  # /api/share-image response, once the game has ended
+
+    def __len__(self):
+        return len(self.steps) // 2
+
+    def record(self, node_index, choice_index, next_index):
+        """Append a choice taken at `node_index` that led to `next_index`"""
+        self.steps.append(node_index)
+        self.steps.append(choice_index)
+        self.current = next_index
+        self.image_reroll = 0
+        self.share = None
+
+    def copy(self):
+        return Journey(self.pack_id, self.pack_version, self.start, self.current,
+                       array(_TYPECODE, self.steps), self.image_reroll, self.created_at,
+                       self.share)
+
+    def replay(self, graph):
+        """Derive the path, score and sentiment tally from a story graph"""
+        nodes = graph.nodes
+        try:
+            path = [nodes[self.start].id]
+            score = 0
+            balance = 0
+            sentiment_tally = {}
+            steps = []
+            for i in range(0, len(self.steps), 2):
+                node = nodes[self.steps[i]]
+                choice = node.choices[self.steps[i + 1]]
+                steps.append((node, choice))
+                following = self.steps[i + 2] if i + 2 < len(self.steps) else self.current
+                path.append(nodes[following].id)
+                score += choice.score_modifier
+                balance += choice.weight
+                if choice.tag:
+                    sentiment_tally[choice.tag] = sentiment_tally.get(choice.tag, 0) + 1
+            nodes[self.current]
+        except IndexError:
+            raise JourneyError("journey does not match the story graph")
+        return JourneyView(path, score, sentiment_tally, steps, balance)
+
+    # --- Serialization ---
+    def to_primitive(self):
+        """A small JSON-friendly dict (see from_primitive)"""
+        steps = self.steps
+        if sys.byteorder == "big":
+            steps = array(_TYPECODE, steps)
+            steps.byteswap()
+        data = {
+            "k": self.pack_id,
+            "v": self.pack_version,
+            "b": self.start,
+            "n": self.current,
+            "j": base64.b64encode(steps.tobytes()).decode("ascii"),
+            "r": self.image_reroll,
+            "t": round(self.created_at, 3)
+        }
+        if self.share is not None:
+            data["x"] = self.share
+        return data
+
+    @classmethod
+    def from_primitive(cls, data):
+        steps = array(_TYPECODE)
+        steps.frombytes(base64.b64decode(data["j"]))
+        if sys.byteorder == "big":
+            steps.byteswap()
+        return cls(data["k"], data["v"], data["b"], data["n"], steps,
+                   data.get("r", 0), data.get("t"), data.get("x"))
+
+    @classmethod
+    def from_legacy(cls, state, graph):
+        """Convert a game stored as a dict of path/choice lists"""
+        try:
+            steps = array(_TYPECODE)
+            for entry in state.get("choice_history", []):
+                steps.append(graph.index_of(entry["from_node"]))
+                steps.append(entry["choice_index"])
+            path = state.get("path_history") or [state["current_node_id"]]
+            return cls(state.get("pack_id"), state.get("pack_version"), graph.index_of(path[0]),
+                       graph.index_of(state["current_node_id"]), steps,
+                       state.get("image_reroll", 0), state.get("created_at"))
+        except (KeyError, OverflowError, TypeError):
+            raise JourneyError("stored game does not match the story graph")
+
+    def size(self):
+        """Approximate bytes held, for session memory budgets"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.steps)
+        if self.share is not None:
+            size += sum(sys.getsizeof(value) for value in self.share.values())
+        return size
@@ -0,0 +1,277 @@
+"""Request metrics in the Prometheus text format, and a sampling profiler.
+
+`Metrics` keeps a latency histogram per endpoint and per (endpoint, stage),
+where a stage is a slice of a request such as the session read or prompt
+building, timed with `metrics.stage("prompts")`. Observing a value is a
+bisect and three additions under a lock, cheap enough to leave on.
+Counters the rest of the API already keeps (session store, image cache,
+choice texts, ...) are read from their `stats()` methods at scrape time.
+
+`SamplingProfiler` samples the stacks of threads that are handling a
+request every few milliseconds while it is switched on, and reports them
+as folded stacks (one `frame;frame;frame count` line per stack), the input
+format of flamegraph tools.
+"""
+import bisect
+import sys
+import threading
+import time
+from collections import Counter
+
+# Seconds; the upper bounds of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Stage:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe_stage(self.name, time.perf_counter() - self.started)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Metrics:
+    """Histograms and counters for the API, rendered by `exposition()`"""
+
+    def __init__(self, prefix="mff", enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._requests = {}  # (endpoint, method) -> Histogram
+        self._stages = {}  # (endpoint, stage) -> Histogram
+        self._responses = Counter()  # (endpoint, status) -> count
+        self._sources = []  # (name, stats function, counter keys)
+        self.active = {}  # thread id -> endpoint, for the profiler
+
+    # --- Requests ---
+    def begin(self, endpoint):
+        """Start timing a request on this thread"""
+        if not self.enabled:
+            return
+        self._local.endpoint = endpoint
+        self._local.started = time.perf_counter()
+        self.active[threading.get_ident()] = endpoint
+
+    def end(self, method, status):
+        """Finish the request begun on this thread"""
+        started = getattr(self._local, "started", None)
+        if started is None:
+            return
+        self._local.started = None
+        self.active.pop(threading.get_ident(), None)
+        self.observe_request(self._local.endpoint, method, status, time.perf_counter() - started)
+
+    def observe_request(self, endpoint, method, status, seconds):
+        key = (endpoint, method)
+        with self._lock:
+            histogram = self._requests.get(key)
+            if histogram is None:
+                histogram = self._requests[key] = Histogram()
+            histogram.observe(seconds)
+            self._responses[(endpoint, status)] += 1
+
+    # --- Stages ---
+    def stage(self, name):
+        """Context manager timing one stage of the current request"""
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def observe_stage(self, name, seconds):
+        if not self.enabled:
+            return
+        key = (getattr(self._local, "endpoint", None) or "none", name)
+        with self._lock:
+            histogram = self._stages.get(key)
+            if histogram is None:
+                histogram = self._stages[key] = Histogram()
+            histogram.observe(seconds)
+
+    # --- Counters kept elsewhere ---
+    def add_source(self, name, stats, counters=()):
+        """Expose the numbers in `stats()` as `<prefix>_<name>_<key>`
+
+        Keys listed in `counters` only ever go up and are exported as
+        counters, everything else as gauges.
+        """
+        self._sources.append((name, stats, frozenset(counters)))
+
+    # --- Exposition ---
+    def exposition(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            requests = {key: _copy(h) for key, h in self._requests.items()}
+            stages = {key: _copy(h) for key, h in self._stages.items()}
+            responses = dict(self._responses)
+
+        name = f"{self.prefix}_request_duration_seconds"
+        lines += [f"# HELP {name} Time spent handling a request",
+                  f"# TYPE {name} histogram"]
+        for (endpoint, method), histogram in sorted(requests.items()):
+            lines += _histogram_lines(name, {"endpoint": endpoint, "method": method}, histogram)
+
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines += [f"# HELP {name} Time spent in one stage of a request",
+                  f"# TYPE {name} histogram"]
+        for (endpoint, stage), histogram in sorted(stages.items()):
+            lines += _histogram_lines(name, {"endpoint": endpoint, "stage": stage}, histogram)
+
+        name = f"{self.prefix}_responses_total"
+        lines += [f"# HELP {name} Responses sent, by status code",
+                  f"# TYPE {name} counter"]
+        for (endpoint, status), count in sorted(responses.items()):
+            lines.append(f"{name}{_labels({'endpoint': endpoint, 'status': status})} {count}")
+
+        for source, stats, counters in self._sources:
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"Error collecting {source} metrics: {str(e)}")
+                continue
+            for key, value in sorted((values or {}).items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key in counters:
+                    name = f"{self.prefix}_{source}_{key}_total"
+                    lines.append(f"# TYPE {name} counter")
+                else:
+                    name = f"{self.prefix}_{source}_{key}"
+                    lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _copy(histogram):
+    copy = Histogram()
+    copy.counts = list(histogram.counts)
+    copy.sum = histogram.sum
+    copy.count = histogram.count
+    return copy
+
+
+def _labels(labels):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+    return lines
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads handling requests while enabled"""
+
+    def __init__(self, active_threads, interval=0.005, max_depth=64):
+        self.active_threads = active_threads  # thread id -> endpoint
+        self.interval = interval
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self.samples = 0
+        self.started_at = None
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        """Start sampling (clearing earlier samples); no-op if already running"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            if interval:
+                self.interval = interval
+            self._stacks.clear()
+            self.samples = 0
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            active = dict(self.active_threads)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, endpoint in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(endpoint)
+                stacks.append(";".join(reversed(stack)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += 1
+
+    def folded(self):
+        """The samples so far as folded stacks, most frequent first"""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self._thread is not None,
+                "interval": self.interval,
+                "samples": self.samples,
+                "stacks": len(self._stacks),
+                "started_at": self.started_at
+            }
@@ -0,0 +1,403 @@
+"""Local index of the story outcomes saved to the ForestAdventure contract.
+
+Reading outcomes straight from the chain costs one JSON-RPC call per story
+and can't rank them at all. `OutcomeIndex` instead tails the contract's
+`StoryCreated` and `StoryUpdated` events with `eth_getLogs`, a block range
+at a time, and keeps them in a SQLite table the API can page and sort
+locally. Each range is applied in the same transaction as the checkpoint
+(the next block to read), so a restarted indexer picks up exactly where it
+stopped and never applies a range twice. Ranges the node refuses (too many
+logs) are halved until it accepts them. Blocks younger than `confirmations`
+are left for the next pass, which keeps short reorgs out of the index.
+
+`StoryCreated` doesn't carry the image URLs or the timestamp, so they are
+read with `getStoryOutcome` once per new story, in one JSON-RPC batch per
+range, at indexing time rather than on every page view.
+"""
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+import requests
+
+# --- Keccak-256 (the Ethereum hash, not NIST SHA3-256) ---
+_ROUND_CONSTANTS = (
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808A, 0x8000000080008000,
+    0x000000000000808B, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008A, 0x0000000000000088, 0x0000000080008009, 0x000000008000000A,
+    0x000000008000808B, 0x800000000000008B, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800A, 0x800000008000000A,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008)
+# Rotation of lane x + 5y
+_ROTATIONS = (0, 1, 62, 28, 27, 36, 44, 6, 55, 20, 3, 10, 43, 25, 39,
+              41, 45, 15, 21, 8, 18, 2, 61, 56, 14)
+_MASK = (1 << 64) - 1
+
+
+def _rotate(value, shift):
+    return ((value << shift) | (value >> (64 - shift))) & _MASK if shift else value
+
+
+def _permute(lanes):
+    for constant in _ROUND_CONSTANTS:
+        columns = [lanes[x] ^ lanes[x + 5] ^ lanes[x + 10] ^ lanes[x + 15] ^ lanes[x + 20]
+                   for x in range(5)]
+        for x in range(5):
+            d = columns[(x - 1) % 5] ^ _rotate(columns[(x + 1) % 5], 1)
+            for y in range(0, 25, 5):
+                lanes[x + y] ^= d
+        moved = [0] * 25
+        for x in range(5):
+            for y in range(5):
+                moved[y + 5 * ((2 * x + 3 * y) % 5)] = _rotate(lanes[x + 5 * y], _ROTATIONS[x + 5 * y])
+        for y in range(0, 25, 5):
+            row = moved[y:y + 5]
+            for x in range(5):
+                lanes[x + y] = row[x] ^ (~row[(x + 1) % 5] & _MASK & row[(x + 2) % 5])
+        lanes[0] ^= constant
+
+
+def keccak256(data):
+    rate = 136
+    padded = bytearray(data) + b"\x01"
+    padded += b"\x00" * (-len(padded) % rate)
+    padded[-1] |= 0x80
+    lanes = [0] * 25
+    for offset in range(0, len(padded), rate):
+        for i in range(rate // 8):
+            lanes[i] ^= int.from_bytes(padded[offset + 8 * i:offset + 8 * i + 8], "little")
+        _permute(lanes)
+    return b"".join(lane.to_bytes(8, "little") for lane in lanes[:4])
+
+
+def event_topic(signature):
+    return "0x" + keccak256(signature.encode()).hex()
+
+
+def function_selector(signature):
+    return keccak256(signature.encode())[:4]
+
+
+STORY_CREATED = event_topic("StoryCreated(uint256,address,string,uint256)")
+STORY_UPDATED = event_topic("StoryUpdated(uint256,string)")
+GET_STORY_OUTCOME = function_selector("getStoryOutcome(uint256)")
+
+# getStoryOutcome calls sent in one JSON-RPC batch
+BATCH_SIZE = 100
+# SQLite integers are signed 64-bit; uint256 scores beyond that are clamped
+MAX_SCORE = (1 << 63) - 1
+
+
+# --- ABI decoding ---
+def _word(data, offset):
+    return int.from_bytes(data[offset:offset + 32], "big")
+
+
+def _string(data, head_offset):
+    """A dynamic string whose offset is stored at head_offset"""
+    start = _word(data, head_offset)
+    length = _word(data, start)
+    return data[start + 32:start + 32 + length].decode("utf-8", "replace")
+
+
+def _address(word_bytes):
+    return "0x" + word_bytes[-20:].hex()
+
+
+def _hex_bytes(value):
+    return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+
+
+class IndexerError(Exception):
+    """The JSON-RPC node failed or answered with an error"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code  # the JSON-RPC error code, None for transport errors
+
+
+class OutcomeIndex:
+    """ForestAdventure outcomes mirrored into SQLite from contract events"""
+
+    def __init__(self, path, rpc_url, contract, start_block=0, block_range=2000,
+                 confirmations=2, poll_interval=15.0, timeout=10.0, fetch_details=True):
+        self.path = path
+        self.rpc_url = rpc_url
+        self.contract = contract.lower()
+        self.start_block = start_block
+        self.block_range = block_range
+        self.confirmations = confirmations
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.fetch_details = fetch_details
+        self._range = block_range  # shrinks while the node refuses wide ranges
+        self._http = requests.Session()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._rpc_id = 0
+        self.rpc_calls = 0
+        self.rpc_errors = 0
+        self.events = 0
+        self.ranges = 0
+        self.head = None
+        self.last_sync_at = None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stories ("
+            " story_id INTEGER PRIMARY KEY,"
+            " player TEXT NOT NULL,"
+            " ending_category TEXT NOT NULL,"
+            " score INTEGER NOT NULL,"
+            " image_url TEXT,"
+            " manga_image_url TEXT,"
+            " created_at INTEGER,"
+            " block_number INTEGER NOT NULL,"
+            " tx_hash TEXT,"
+            " updated_block INTEGER)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS stories_rank ON stories (score DESC, story_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS stories_ending"
+                     " ON stories (ending_category, score DESC, story_id)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            " contract TEXT PRIMARY KEY,"
+            " next_block INTEGER NOT NULL)"
+        )
+
+    def _conn(self):
+        # One connection per thread, as in the SQLite session backend
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- JSON-RPC ---
+    def _rpc(self, method, params):
+        with self._lock:
+            self._rpc_id += 1
+            self.rpc_calls += 1
+            rpc_id = self._rpc_id
+        try:
+            response = self._http.post(self.rpc_url, json={
+                "jsonrpc": "2.0", "id": rpc_id, "method": method, "params": params
+            }, timeout=self.timeout)
+            response.raise_for_status()
+            reply = response.json()
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                self.rpc_errors += 1
+            raise IndexerError(f"{method} failed: {str(e)}")
+        error = reply.get("error")
+        if error:
+            with self._lock:
+                self.rpc_errors += 1
+            raise IndexerError(f"{method}: {error.get('message')}", error.get("code"))
+        return reply.get("result")
+
+    def _rpc_batch(self, method, params_list):
+        """One JSON-RPC batch; a result or an IndexerError per call, in order"""
+        with self._lock:
+            first_id = self._rpc_id + 1
+            self._rpc_id += len(params_list)
+            self.rpc_calls += 1
+        payload = [{"jsonrpc": "2.0", "id": first_id + i, "method": method, "params": params}
+                   for i, params in enumerate(params_list)]
+        try:
+            response = self._http.post(self.rpc_url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            replies = {reply.get("id"): reply for reply in response.json()}
+        except (requests.RequestException, ValueError, TypeError, AttributeError) as e:
+            with self._lock:
+                self.rpc_errors += 1
+            raise IndexerError(f"{method} batch failed: {str(e)}")
+        results = []
+        for i in range(len(params_list)):
+            reply = replies.get(first_id + i) or {"error": {"message": "no reply"}}
+            error = reply.get("error")
+            if error:
+                results.append(IndexerError(f"{method}: {error.get('message')}", error.get("code")))
+            else:
+                results.append(reply.get("result"))
+        return results
+
+    def _story_details(self, story_ids):
+        """{story id: (image_url, manga_image_url, timestamp)} from getStoryOutcome
+
+        One batch per BATCH_SIZE stories. Read at "latest" so nodes without
+        archive state can answer; a newer image URL is what the later
+        StoryUpdated events lead to anyway.
+        """
+        details = {}
+        for i in range(0, len(story_ids), BATCH_SIZE):
+            chunk = story_ids[i:i + BATCH_SIZE]
+            calls = [[{"to": self.contract,
+                       "data": "0x" + (GET_STORY_OUTCOME + story_id.to_bytes(32, "big")).hex()},
+                      "latest"] for story_id in chunk]
+            for story_id, result in zip(chunk, self._rpc_batch("eth_call", calls)):
+                if isinstance(result, IndexerError):
+                    # The outcome still ranks without its pictures
+                    print(f"Error reading story {story_id}: {str(result)}")
+                    continue
+                result = _hex_bytes(result)
+                details[story_id] = (_string(result, 96), _string(result, 128), _word(result, 192))
+        return details
+
+    # --- Syncing ---
+    def checkpoint(self):
+        """The next block the index will read"""
+        row = self._conn().execute(
+            "SELECT next_block FROM checkpoints WHERE contract = ?", (self.contract,)
+        ).fetchone()
+        return row[0] if row else self.start_block
+
+    def sync_once(self):
+        """Index every confirmed block past the checkpoint; returns events applied"""
+        with self._sync_lock:
+            head = int(self._rpc("eth_blockNumber", []), 16) - self.confirmations
+            with self._lock:
+                self.head = head
+            start = self.checkpoint()
+            applied = 0
+            while start <= head:
+                end = min(start + self._range - 1, head)
+                try:
+                    logs = self._rpc("eth_getLogs", [{
+                        "address": self.contract,
+                        "fromBlock": hex(start),
+                        "toBlock": hex(end),
+                        "topics": [[STORY_CREATED, STORY_UPDATED]]
+                    }])
+                except IndexerError as e:
+                    # Nodes cap the logs per call; refused ranges are halved
+                    if e.code is None or self._range == 1:
+                        raise
+                    self._range = max(1, self._range // 2)
+                    continue
+                applied += self._apply(logs, end)
+                start = end + 1
+                self._range = min(self.block_range, self._range * 2)
+            with self._lock:
+                self.last_sync_at = time.time()
+            return applied
+
+    def _apply(self, logs, end):
+        """Write one range's events and move the checkpoint past it, atomically"""
+        logs = sorted((log for log in logs if not log.get("removed")),
+                      key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"], 16)))
+        details = {}
+        if self.fetch_details:
+            details = self._story_details([int(log["topics"][1], 16) for log in logs
+                                           if log["topics"][0] == STORY_CREATED])
+        created = []
+        updated = []
+        for log in logs:
+            topics = log["topics"]
+            data = _hex_bytes(log["data"])
+            block = int(log["blockNumber"], 16)
+            story_id = int(topics[1], 16)
+            if topics[0] == STORY_CREATED:
+                image_url, manga_image_url, created_at = details.get(story_id, (None, None, None))
+                created.append((story_id, _address(_hex_bytes(topics[2])), _string(data, 0),
+                                min(_word(data, 32), MAX_SCORE), image_url, manga_image_url,
+                                created_at, block, log.get("transactionHash")))
+            elif topics[0] == STORY_UPDATED:
+                updated.append((_string(data, 0), block, story_id))
+
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO stories (story_id, player, ending_category, score,"
+                " image_url, manga_image_url, created_at, block_number, tx_hash)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                created
+            )
+            conn.executemany(
+                "UPDATE stories SET image_url = ?, updated_block = ? WHERE story_id = ?",
+                updated
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (contract, next_block) VALUES (?, ?)",
+                (self.contract, end + 1)
+            )
+        with self._lock:
+            self.events += len(logs)
+            self.ranges += 1
+        return len(logs)
+
+    def start(self):
+        """Keep syncing in a background thread every poll_interval seconds"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outcome-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                print(f"Error syncing story outcomes: {str(e)}")
+                traceback.print_exc()
+            self._stop.wait(self.poll_interval)
+
+    # --- Reads ---
+    def leaderboard(self, offset=0, limit=20, ending=None):
+        """(stories, total): highest score first, earliest story first on ties"""
+        conn = self._conn()
+        if ending:
+            rows = conn.execute(
+                "SELECT * FROM stories WHERE ending_category = ?"
+                " ORDER BY score DESC, story_id LIMIT ? OFFSET ?", (ending, limit, offset)
+            ).fetchall()
+            total = conn.execute(
+                "SELECT COUNT(*) FROM stories WHERE ending_category = ?", (ending,)
+            ).fetchone()[0]
+        else:
+            rows = conn.execute(
+                "SELECT * FROM stories ORDER BY score DESC, story_id LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM stories").fetchone()[0]
+        return [dict(row) for row in rows], total
+
+    def story(self, story_id):
+        row = self._conn().execute(
+            "SELECT * FROM stories WHERE story_id = ?", (story_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def stats(self):
+        stories = self._conn().execute("SELECT COUNT(*) FROM stories").fetchone()[0]
+        checkpoint = self.checkpoint()
+        with self._lock:
+            return {
+                "stories": stories,
+                "checkpoint": checkpoint,
+                "head": self.head,
+                "lag_blocks": max(0, self.head + 1 - checkpoint) if self.head is not None else None,
+                "events": self.events,
+                "ranges": self.ranges,
+                "rpc_calls": self.rpc_calls,
+                "rpc_errors": self.rpc_errors,
+                "last_sync_at": self.last_sync_at
+            }
@@ -0,0 +1,108 @@
+"""Short, content-addressed codes for finished games.
+
+Saving a game on chain used to store both image URLs, each carrying the
+whole percent-encoded prompt, at per-byte gas cost. An outcome code is a
+few dozen bytes instead:
+
+    o1-e823c1b0-10210-4f1c9a0b7d2e6358
+       |        |     digest of the outcome record
+       |        choices taken, one base-36 digit per step
+       pack version (first 8 hex digits)
+
+The record behind it (pack, path, ending, score, seed and prompts) is
+written to disk under its digest when the game ends, so the same outcome
+always gets the same code, and `/api/outcomes/<code>` turns a code back
+into the prompts and image URLs. A code only resolves if its version and
+choices match the stored record.
+
+The prompts depend on per-session style picks, so a record can't be
+rebuilt from its code: records are never deleted, and the directory has
+to be durable and shared by every instance before codes are worth keeping
+anywhere permanent.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+
+from _files import write_atomic
+
+CODE_VERSION = "o1"
+CODE_PATTERN = re.compile(r"^o1-([0-9a-f]{8})-([0-9a-z]{0,200})-([0-9a-f]{16})$")
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class OutcomeError(ValueError):
+    """A game can't be written as an outcome code"""
+
+
+def encode_choices(steps):
+    """The choice indices of a journey's (node, choice) steps as base-36 digits"""
+    digits = []
+    for i in range(1, len(steps), 2):
+        if steps[i] >= len(_DIGITS):
+            raise OutcomeError(f"choice index {steps[i]} doesn't fit one digit")
+        digits.append(_DIGITS[steps[i]])
+    return "".join(digits)
+
+
+def parse_code(code):
+    """(version prefix, choices, digest) of an outcome code, or None"""
+    match = CODE_PATTERN.match(code or "")
+    return match.groups() if match else None
+
+
+class OutcomeRecords:
+    """Outcome records on disk, one JSON file per digest, kept for good"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.registered = 0
+        self.resolved = 0
+        self.misses = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + ".json")
+
+    def register(self, record):
+        """Store a record (a JSON-friendly dict with pack_version and choices); returns its code"""
+        data = json.dumps(record, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        path = self._path(digest)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+            with self._lock:
+                self.registered += 1
+        return f"{CODE_VERSION}-{record['pack_version'][:8]}-{record['choices']}-{digest}"
+
+    def get(self, code):
+        """The record behind a code, or None"""
+        parts = parse_code(code)
+        record = None
+        if parts is not None:
+            version, choices, digest = parts
+            try:
+                with open(self._path(digest), "rb") as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                record = None
+            if record is not None and (not record["pack_version"].startswith(version)
+                                       or record["choices"] != choices):
+                record = None
+        with self._lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.resolved += 1
+        return record
+
+    def stats(self):
+        with self._lock:
+            return {
+                "registered": self.registered,
+                "resolved": self.resolved,
+                "misses": self.misses
+            }
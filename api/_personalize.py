@@ -0,0 +1,78 @@
+"""Per-session personalization of choice texts.
+
+Each player gets an adverb inserted after the verb of most choice texts
+("Take boldly the path..."), picked from the adverbs that match their
+personality traits. Where the verb sits is worked out when the story graph
+is compiled, the adverb list is resolved once per trait combination, and the
+rendered texts are cached per (session, traits, node), so a node view does no
+string splitting or table building.
+"""
+import threading
+from collections import OrderedDict
+
+
+class ChoicePersonalizer:
+    """Renders and caches personalized choice texts"""
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._adverbs = {}  # (pack version, traits) -> adverbs
+        self._texts = OrderedDict()  # (session, pack version, traits, node) -> texts
+        self.hits = 0
+        self.misses = 0
+
+    def adverbs_for(self, pack, traits):
+        """Adverbs matching a set of personality traits, in trait order"""
+        key = (pack.version, tuple(traits or ()))
+        adverbs = self._adverbs.get(key)
+        if adverbs is None:
+            trait_adverbs = pack.styles.get("trait_adverbs", {})
+            adverbs = tuple(adverb for trait in key[1]
+                            for adverb in trait_adverbs.get(trait, ()))
+            self._adverbs[key] = adverbs
+        return adverbs
+
+    def choice_texts(self, session_id, session_hash, traits, pack, node):
+        """Personalized text of every choice at a node for one session"""
+        # Traits are part of the key: a player whose traits change (a new
+        # game under the same session) gets texts for the new ones
+        key = (session_id, pack.version, tuple(traits or ()), node.index)
+        with self._lock:
+            texts = self._texts.get(key)
+            if texts is not None:
+                self._texts.move_to_end(key)
+                self.hits += 1
+                return texts
+            self.misses += 1
+
+        texts = render_choice_texts(node, self.adverbs_for(pack, traits), session_hash,
+                                    node.index == pack.graph.start.index)
+        with self._lock:
+            self._texts[key] = texts
+            while len(self._texts) > self.max_entries:
+                self._texts.popitem(last=False)
+        return texts
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached_nodes": len(self._texts),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+def render_choice_texts(node, adverbs, session_hash, is_start):
+    """Insert a session-specific adverb after each choice's verb
+
+    The first choice at the start node is always left as written.
+    """
+    texts = []
+    for choice in node.choices:
+        if (is_start and choice.index == 0) or not adverbs or choice.verb_prefix is None:
+            texts.append(choice.text)
+            continue
+        adverb = adverbs[(session_hash + choice.index) % len(adverbs)]
+        texts.append(f"{choice.verb_prefix} {adverb} {choice.verb_suffix}")
+    return tuple(texts)
@@ -0,0 +1,171 @@
+"""Speculative image pre-warming for the story graph.
+
+While a player reads a node, the images they can need next are known: one
+per choice. The prefetcher fetches those into the image cache on a bounded
+thread pool so the picked branch's image is usually ready by the time the
+browser asks for it.
+
+`LoopPrefetcher` does the same with coroutines on an asyncio event loop, for
+the ASGI app, where a fetch waiting on the render service holds no thread.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """Bounded background fetches, tracked per session so they can be cancelled"""
+
+    def __init__(self, fetch, max_workers=8, per_session=4, max_pending=256):
+        self._fetch = fetch
+        self.max_workers = max_workers
+        self.per_session = per_session
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._sessions = {}  # session_id -> {key: future}
+        self._pending = 0
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.dropped = 0
+
+    def schedule(self, session_id, keys, keep=()):
+        """Prefetch `keys` for a session
+
+        Work queued earlier for the session is cancelled unless its key is in
+        `keys` or `keep`, so when a player picks a branch the other branches'
+        fetches that have not started yet are abandoned.
+        """
+        wanted = set(keys)
+        wanted.update(keep)
+        with self._lock:
+            tasks = self._sessions.setdefault(session_id, {})
+            for key in list(tasks):
+                if key not in wanted:
+                    if tasks[key].cancel():
+                        self._pending -= 1
+                        self.cancelled += 1
+                    del tasks[key]
+            for key in keys:
+                if key in tasks:
+                    continue
+                if len(tasks) >= self.per_session or self._pending >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                tasks[key] = self._submit(session_id, key)
+                self._pending += 1
+                self.scheduled += 1
+            if not tasks:
+                del self._sessions[session_id]
+
+    def cancel(self, session_id):
+        """Abandon every prefetch for a session that has not started yet"""
+        self.schedule(session_id, ())
+
+    def _submit(self, session_id, key):
+        """Start a fetch; the result's cancel() must only succeed before it runs"""
+        return self._executor.submit(self._run, session_id, key)
+
+    def _run(self, session_id, key):
+        try:
+            self._fetch(key)
+            ok = True
+        except Exception:
+            ok = False
+        self._finished(session_id, key, ok)
+
+    def _finished(self, session_id, key, ok):
+        with self._lock:
+            self._pending -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            tasks = self._sessions.get(session_id)
+            if tasks is not None:
+                tasks.pop(key, None)
+                if not tasks:
+                    del self._sessions[session_id]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "sessions": len(self._sessions),
+                "max_workers": self.max_workers,
+                "scheduled": self.scheduled,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "dropped": self.dropped
+            }
+
+
+class _LoopTask:
+    """Handle for a LoopPrefetcher fetch, cancellable until it starts"""
+    __slots__ = ("started", "cancelled", "future")
+
+    def __init__(self):
+        self.started = False
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        # Called with the prefetcher's lock held, like the check in _run
+        if self.started:
+            return False
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+        return True
+
+
+class LoopPrefetcher(Prefetcher):
+    """Prefetcher whose fetches are coroutines on an event loop
+
+    `fetch` is a coroutine function. schedule() may be called from any
+    thread; at most `max_workers` fetches run at once and the rest wait
+    their turn, still cancellable.
+    """
+
+    def __init__(self, fetch, loop, max_workers=64, per_session=4, max_pending=1024):
+        self._loop = loop
+        self._slots = None
+        super().__init__(fetch, max_workers=max_workers, per_session=per_session,
+                         max_pending=max_pending)
+        self._executor.shutdown()  # not used
+
+    def _submit(self, session_id, key):
+        task = _LoopTask()
+        task.future = asyncio.run_coroutine_threadsafe(
+            self._run_async(session_id, key, task), self._loop)
+        return task
+
+    async def _run_async(self, session_id, key, task):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        async with self._slots:
+            with self._lock:
+                if task.cancelled:
+                    return
+                task.started = True
+            try:
+                await self._fetch(key)
+                ok = True
+            except asyncio.CancelledError:
+                ok = False
+            except Exception:
+                ok = False
+        self._finished(session_id, key, ok)
+
+    def shutdown(self):
+        with self._lock:
+            tasks = [task for session in self._sessions.values() for task in session.values()]
+        for task in tasks:
+            task.future.cancel()
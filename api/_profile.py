@@ -0,0 +1,51 @@
+"""Per-session values that only depend on the session id and its story pack.
+
+The MD5 hash of the session id picks a player's unique image styles, the
+variant of their ending and the adverbs in their choice texts. A
+`SessionProfile` works it out once, when the session is created, together
+with the styles and traits randomly assigned to the player, and is stored
+with the session so handlers just read it.
+"""
+import hashlib
+
+
+def session_hash(session_id):
+    """The integer every per-session variation is derived from"""
+    return int(hashlib.md5(session_id.encode()).hexdigest(), 16)
+
+
+class SessionProfile:
+    """What makes one player's story look and read differently"""
+    __slots__ = ("session_hash", "style_preferences", "personality_traits",
+                 "unique_styles", "styles_version")
+
+    def __init__(self, session_hash=None, style_preferences=None, personality_traits=None,
+                 unique_styles=None, styles_version=None):
+        self.session_hash = session_hash
+        self.style_preferences = style_preferences
+        self.personality_traits = personality_traits
+        self.unique_styles = unique_styles
+        self.styles_version = styles_version  # pack version unique_styles came from
+
+    def unique_styles_for(self, pack):
+        """The 1-3 unique image styles this session gets from a pack"""
+        if self.styles_version != pack.version:
+            options = pack.styles.get("unique_styles", ())
+            count = 1 + (self.session_hash % 3) if options else 0
+            self.unique_styles = [options[(self.session_hash + i) % len(options)]
+                                  for i in range(count)]
+            self.styles_version = pack.version
+        return self.unique_styles
+
+    def to_primitive(self):
+        return {
+            "h": self.session_hash,
+            "p": self.style_preferences,
+            "t": self.personality_traits,
+            "u": self.unique_styles,
+            "v": self.styles_version
+        }
+
+    @classmethod
+    def from_primitive(cls, data):
+        return cls(data.get("h"), data.get("p"), data.get("t"), data.get("u"), data.get("v"))
@@ -0,0 +1,323 @@
+"""Policy for calls to an upstream service that can be slow or down.
+
+`UpstreamPolicy.call(attempt)` (and `call_async` for coroutines) runs
+`attempt(timeout)` under:
+
+- a deadline for the whole call, retries and hedges included; each
+  attempt gets what is left of it (at most `attempt_timeout`);
+- hedging: if an attempt hasn't answered after `hedge_delay` seconds, a
+  second one is started and whichever answers first wins, which cuts the
+  tail when one upstream render gets stuck. Only safe for idempotent calls;
+- retries of failed attempts, up to `max_attempts` attempts in all;
+- a `RetryBudget` shared by hedges and retries, so during an outage the
+  extra load is a fraction of the normal load instead of a multiple;
+- a `CircuitBreaker`: after `failure_threshold` failed calls in a row calls
+  are refused at once (`CircuitOpenError`) for `reset_timeout` seconds,
+  then one trial call decides whether it closes again.
+
+An attempt signals a failure by raising; exceptions with a false
+`retryable` attribute (a 4xx, say) are not retried, and don't count
+against the upstream's health either.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_NUMBERS = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open; the call was not attempted"""
+
+    retryable = False
+
+
+class DeadlineExceeded(Exception):
+    """No attempt answered before the call's deadline"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open probe"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Whether a call may go ahead now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opens += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def retry_after(self):
+        """Seconds until the breaker lets a trial call through"""
+        with self._lock:
+            if self.state != OPEN:
+                return 0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "state_code": _STATE_NUMBERS[self.state],
+                "consecutive_failures": self._failures,
+                "opens": self.opens,
+                "rejected": self.rejected
+            }
+
+
+class RetryBudget:
+    """Retries allowed as a fraction of calls, plus a small steady trickle
+
+    Every call deposits `ratio` tokens and a retry or hedge spends one;
+    `per_second` tokens also accrue with time so a quiet service can still
+    retry. The balance is capped at `max_tokens`.
+    """
+
+    def __init__(self, ratio=0.1, per_second=0.5, max_tokens=10.0):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self.spent = 0
+        self.denied = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.spent += 1
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"tokens": round(self._tokens, 2), "spent": self.spent, "denied": self.denied}
+
+
+class UpstreamPolicy:
+    """Deadline, hedging, retries, retry budget and circuit breaker for one upstream"""
+
+    def __init__(self, deadline=45.0, attempt_timeout=30.0, hedge_delay=10.0, max_attempts=2,
+                 breaker=None, budget=None, max_workers=64):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.hedge_delay = hedge_delay  # 0 disables hedging
+        self.max_attempts = max_attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget or RetryBudget()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+
+    def _tally(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _begin(self):
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                f"Upstream circuit is open; retry in {self.breaker.retry_after():.0f}s")
+        self._tally("calls")
+        self.budget.deposit()
+        return time.monotonic() + self.deadline
+
+    def _failed(self, error):
+        """Record a failed call and return the exception to raise"""
+        if getattr(error, "retryable", True):
+            self.breaker.record_failure()
+            self._tally("failures")
+        else:
+            # The upstream answered; the request itself was bad
+            self.breaker.record_success()
+        return error
+
+    def _attempt_timeout(self, deadline_at):
+        return max(0.001, min(self.attempt_timeout, deadline_at - time.monotonic()))
+
+    def _pool(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="upstream")
+            return self._executor
+
+    # --- Threads ---
+    def call(self, attempt):
+        """Run `attempt(timeout)` under the policy and return its result"""
+        deadline_at = self._begin()
+        if not self.hedge_delay:
+            return self._call_sequential(attempt, deadline_at)
+
+        pool = self._pool()
+        futures = {pool.submit(attempt, self._attempt_timeout(deadline_at)): 0}
+        started = 1
+        hedge_at = time.monotonic() + self.hedge_delay
+        error = None
+        while True:
+            now = time.monotonic()
+            if now >= deadline_at:
+                self._tally("deadlines_exceeded")
+                raise self._failed(DeadlineExceeded(f"No upstream answer in {self.deadline:.0f}s"))
+            wake = deadline_at
+            if started < self.max_attempts and futures:
+                wake = min(wake, hedge_at)
+            done, _ = wait(list(futures), timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                number = futures.pop(future)
+                if future.exception() is None:
+                    self.breaker.record_success()
+                    if number > 0:
+                        self._tally("hedge_wins")
+                    return future.result()
+                error = future.exception()
+                if not getattr(error, "retryable", True):
+                    raise self._failed(error)
+            if started < self.max_attempts and (not futures or time.monotonic() >= hedge_at):
+                # A retry when everything failed, a hedge when it's slow
+                if self.budget.try_spend():
+                    self._tally("hedges" if futures else "retries")
+                    futures[pool.submit(attempt, self._attempt_timeout(deadline_at))] = started
+                    started += 1
+                    hedge_at = time.monotonic() + self.hedge_delay
+                    continue
+                started = self.max_attempts  # out of budget: no more attempts
+            if not futures:
+                raise self._failed(error)
+
+    def _call_sequential(self, attempt, deadline_at):
+        for number in range(self.max_attempts):
+            if number and not self.budget.try_spend():
+                break
+            if number:
+                self._tally("retries")
+            if time.monotonic() >= deadline_at:
+                self._tally("deadlines_exceeded")
+                raise self._failed(DeadlineExceeded(f"No upstream answer in {self.deadline:.0f}s"))
+            try:
+                result = attempt(self._attempt_timeout(deadline_at))
+            except Exception as e:
+                error = e
+                if not getattr(e, "retryable", True):
+                    break
+                continue
+            self.breaker.record_success()
+            return result
+        raise self._failed(error)
+
+    # --- asyncio ---
+    async def call_async(self, attempt):
+        """`call` for a coroutine function `attempt(timeout)`"""
+        deadline_at = self._begin()
+        tasks = {asyncio.ensure_future(attempt(self._attempt_timeout(deadline_at))): 0}
+        started = 1
+        hedge_at = time.monotonic() + self.hedge_delay if self.hedge_delay else None
+        error = None
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline_at:
+                    self._tally("deadlines_exceeded")
+                    raise self._failed(DeadlineExceeded(f"No upstream answer in {self.deadline:.0f}s"))
+                wake = deadline_at
+                if hedge_at is not None and started < self.max_attempts and tasks:
+                    wake = min(wake, hedge_at)
+                done, _ = await asyncio.wait(list(tasks), timeout=max(0.0, wake - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    number = tasks.pop(task)
+                    if task.exception() is None:
+                        self.breaker.record_success()
+                        if number > 0 and hedge_at is not None:
+                            self._tally("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                    if not getattr(error, "retryable", True):
+                        raise self._failed(error)
+                hedge_due = hedge_at is not None and time.monotonic() >= hedge_at
+                if started < self.max_attempts and (not tasks or hedge_due):
+                    if self.budget.try_spend():
+                        self._tally("hedges" if tasks else "retries")
+                        tasks[asyncio.ensure_future(attempt(self._attempt_timeout(deadline_at)))] = started
+                        started += 1
+                        if hedge_at is not None:
+                            hedge_at = time.monotonic() + self.hedge_delay
+                        continue
+                    started = self.max_attempts
+                if not tasks:
+                    raise self._failed(error)
+        finally:
+            # Losing hedges are abandoned
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats.update(("budget_" + key, value) for key, value in self.budget.stats().items())
+        with self._lock:
+            stats.update({
+                "calls": self.calls,
+                "failures": self.failures,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "deadlines_exceeded": self.deadlines_exceeded
+            })
+        return stats
@@ -0,0 +1,538 @@
+"""Storage backends for the session layer.
+
+Every backend implements the same small interface:
+
+    load(session_id, touch=True) -> SessionRecord or None
+    write_many({session_id: SessionRecord})   # one round-trip / transaction
+    delete(session_id)
+    sweep()
+    count() -> int
+    stats() -> dict
+
+`MemoryBackend` keeps records in this process only. `SQLiteBackend` and
+`RedisBackend` are shared, so any worker or instance pointed at the same
+database can serve any player. `CookieBackend` keeps no server state at all:
+each player's record travels in a signed cookie, so every instance that
+knows the signing keys can serve any player without coordinating.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+from _session_store import estimate_record_size, record_from_bytes, record_to_bytes
+
+
+class MemoryBackend:
+    """In-process records with an idle TTL, a memory budget and LRU eviction"""
+    name = "memory"
+
+    def __init__(self, max_sessions=50000, max_bytes=64 * 1024 * 1024, ttl=6 * 3600):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._records = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.expired_evictions = 0
+        self.lru_evictions = 0
+
+    def load(self, session_id, touch=True):
+        now = time.time()
+        with self._lock:
+            record = self._records.get(session_id)
+            if record is None or now - record.last_access > self.ttl:
+                if record is not None:
+                    self._drop(session_id)
+                    self.expired_evictions += 1
+                self.misses += 1
+                return None
+            if touch:
+                record.last_access = now
+                self._records.move_to_end(session_id)
+            self.hits += 1
+            return record
+
+    def write_many(self, records):
+        now = time.time()
+        with self._lock:
+            for session_id, record in records.items():
+                old = self._records.get(session_id)
+                if old is not None:
+                    self._bytes -= old.size
+                else:
+                    self.created += 1
+                record.last_access = now
+                record.size = estimate_record_size(record)
+                self._records[session_id] = record
+                self._records.move_to_end(session_id)
+                self._bytes += record.size
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self._lock:
+            if session_id in self._records:
+                self._drop(session_id)
+
+    def sweep(self):
+        with self._lock:
+            self._evict(time.time())
+
+    def count(self):
+        return len(self._records)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._records),
+                "bytes": self._bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "created": self.created,
+                "expired_evictions": self.expired_evictions,
+                "lru_evictions": self.lru_evictions
+            }
+
+    def _drop(self, session_id):
+        record = self._records.pop(session_id)
+        self._bytes -= record.size
+
+    def _evict(self, now):
+        # The front of the OrderedDict is always the least recently used
+        # session, so expired entries are found there first.
+        while self._records:
+            session_id, record = next(iter(self._records.items()))
+            if now - record.last_access > self.ttl:
+                self.expired_evictions += 1
+            elif len(self._records) > self.max_sessions or self._bytes > self.max_bytes:
+                self.lru_evictions += 1
+            else:
+                break
+            self._drop(session_id)
+
+
+class SQLiteBackend:
+    """Sessions in a SQLite database in WAL mode, shared by local workers"""
+    name = "sqlite"
+    SWEEP_EVERY = 500  # writes between deletes of expired rows
+    TOUCH_SLACK = 60  # seconds a read may leave the idle timer behind, to spare writes
+
+    def __init__(self, path, ttl=6 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes_since_sweep = 0
+        self.hits = 0
+        self.misses = 0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY,"
+            " data BLOB NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)")
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads, so each
+        # worker thread gets its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load(self, session_id, touch=True):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+            (session_id, now)
+        ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if touch and row[1] < now + self.ttl - self.TOUCH_SLACK:
+            conn.execute("UPDATE sessions SET expires_at = ? WHERE id = ?", (now + self.ttl, session_id))
+        return record_from_bytes(row[0])
+
+    def write_many(self, records):
+        expires_at = time.time() + self.ttl
+        rows = [(session_id, record_to_bytes(record), expires_at)
+                for session_id, record in records.items()]
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                rows
+            )
+        with self._lock:
+            self._writes_since_sweep += len(rows)
+            due = self._writes_since_sweep >= self.SWEEP_EVERY
+            if due:
+                self._writes_since_sweep = 0
+        if due:
+            self.sweep()
+
+    def delete(self, session_id):
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def sweep(self):
+        self._conn().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+
+    def count(self):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+        ).fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": self.count(),
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RespClient:
+    """Minimal pipelining client for the Redis serialization protocol"""
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+            setup = []
+            if self.password:
+                setup.append(("AUTH", self.password))
+            if self.db:
+                setup.append(("SELECT", self.db))
+            if setup:
+                self._roundtrip(conn, setup)
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def execute(self, *commands):
+        """Send all commands in one write and return their replies in order"""
+        try:
+            return self._roundtrip(self._connection(), commands)
+        except (OSError, EOFError):
+            # Stale pooled connection: reconnect once
+            self.close()
+            return self._roundtrip(self._connection(), commands)
+
+    def _roundtrip(self, conn, commands):
+        sock, reader = conn
+        sock.sendall(b"".join(_encode_command(command) for command in commands))
+        replies = [_read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+
+def _encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        else:
+            data = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line:
+        raise EOFError("connection closed by server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise RespError(f"unexpected reply: {line!r}")
+
+
+class RedisBackend:
+    """Sessions as expiring keys on a Redis-compatible server"""
+    name = "redis"
+
+    def __init__(self, client, ttl=6 * 3600, prefix="mff:session:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, session_id, touch=True):
+        key = self.prefix + session_id
+        if touch:
+            data, _ = self.client.execute(("GET", key), ("EXPIRE", key, int(self.ttl)))
+        else:
+            data, = self.client.execute(("GET", key))
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return record_from_bytes(data)
+
+    def write_many(self, records):
+        ttl = int(self.ttl)
+        self.client.execute(*[
+            ("SET", self.prefix + session_id, record_to_bytes(record), "EX", ttl)
+            for session_id, record in records.items()
+        ])
+
+    def delete(self, session_id):
+        self.client.execute(("DEL", self.prefix + session_id))
+
+    def sweep(self):
+        # The server expires keys on its own
+        pass
+
+    def count(self):
+        # Unknown: the server can't count our keys without scanning them
+        # all, and DBSIZE would count other applications' keys too
+        return 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": None,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class CookieError(ValueError):
+    """A record can't be stored in a cookie"""
+
+
+class CookieBackend:
+    """Records signed and carried by the player's browser in a cookie
+
+    The value is `<key id>.<issued at>.<zlib+base64url record>.<HMAC-SHA256>`.
+    The MAC covers the session id too, so a state cookie only loads for the
+    session it was issued to. Records are signed with the first of `keys`
+    (a list of (key id, secret) pairs) and accepted under any of them, so a
+    key is rotated by putting a new one first and dropping the old one once
+    `ttl` has passed. A cookie that is tampered with, signed with an unknown
+    key, older than `ttl` or malformed loads as no session.
+
+    Nothing stops a player from sending back an older cookie they were
+    issued, which rewinds their own game; that is the price of keeping no
+    server state.
+
+    Per request, `begin(cookies)` hands over the incoming cookies and
+    `take_outgoing()` returns the cookie value to set on the response (or ""
+    to clear it, or None when nothing changed).
+    """
+    name = "cookie"
+
+    def __init__(self, keys, ttl=6 * 3600, max_bytes=3800, cookie_name="game_state"):
+        if not keys:
+            raise ValueError("the cookie session backend needs SESSION_COOKIE_KEYS")
+        self.signing_key_id = keys[0][0]
+        self._secrets = {key_id: secret.encode() for key_id, secret in keys}
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.cookie_name = cookie_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.oversized = 0
+
+    # --- Per request ---
+    def begin(self, cookies):
+        self._local.incoming = cookies.get(self.cookie_name)
+        self._local.outgoing = None
+
+    def take_outgoing(self):
+        outgoing = getattr(self._local, "outgoing", None)
+        self._local.outgoing = None
+        return outgoing
+
+    # --- Backend interface ---
+    def load(self, session_id, touch=True):
+        value = getattr(self._local, "incoming", None)
+        record = self.decode(session_id, value) if value else None
+        with self._lock:
+            if record is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                if value:
+                    self.rejected += 1
+        return record
+
+    def write_many(self, records):
+        # A response carries one state cookie; a request only ever writes
+        # the session it was made for
+        for session_id, record in records.items():
+            self._local.outgoing = self.encode(session_id, record)
+
+    def delete(self, session_id):
+        self._local.incoming = None
+        self._local.outgoing = ""
+
+    def sweep(self):
+        # Browsers drop the cookies; expiry is checked on load
+        pass
+
+    def count(self):
+        # Unknown: the sessions live with the players
+        return 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": None,
+                "ttl_seconds": self.ttl,
+                "max_cookie_bytes": self.max_bytes,
+                "signing_key": self.signing_key_id,
+                "verify_keys": len(self._secrets),
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejected": self.rejected,
+                "oversized": self.oversized
+            }
+
+    # --- Cookie format ---
+    def _mac(self, secret, session_id, signed):
+        digest = hmac.new(secret, f"{session_id}.{signed}".encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+    def encode(self, session_id, record):
+        payload = base64.urlsafe_b64encode(
+            zlib.compress(record_to_bytes(record, compact=True), 9)).rstrip(b"=").decode("ascii")
+        signed = f"{self.signing_key_id}.{int(time.time())}.{payload}"
+        value = f"{signed}.{self._mac(self._secrets[self.signing_key_id], session_id, signed)}"
+        if len(value) > self.max_bytes:
+            with self._lock:
+                self.oversized += 1
+            raise CookieError(f"session state is {len(value)} bytes, over the "
+                              f"{self.max_bytes} byte cookie limit")
+        return value
+
+    def decode(self, session_id, value):
+        """The record in a cookie value, or None unless it is genuine and fresh"""
+        if len(value) > self.max_bytes:
+            return None
+        signed, _, mac = value.rpartition(".")
+        key_id, _, rest = signed.partition(".")
+        issued, _, payload = rest.partition(".")
+        secret = self._secrets.get(key_id)
+        if secret is None or not payload:
+            return None
+        if not hmac.compare_digest(mac, self._mac(secret, session_id, signed)):
+            return None
+        try:
+            if time.time() - int(issued) > self.ttl:
+                return None
+            data = zlib.decompress(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return record_from_bytes(data)
+        except (ValueError, KeyError, TypeError, zlib.error):
+            # Signed by us but unreadable, e.g. by an older release
+            return None
+
+
+def parse_cookie_keys(value):
+    """SESSION_COOKIE_KEYS "id:secret,id2:secret2" -> [(id, secret), ...]"""
+    keys = []
+    for item in (value or "").split(","):
+        key_id, _, secret = item.strip().partition(":")
+        if not key_id:
+            continue
+        if not secret or "." in key_id:
+            raise ValueError(f"SESSION_COOKIE_KEYS entries look like id:secret, got {key_id!r}")
+        keys.append((key_id, secret))
+    return keys
+
+
+def create_backend(url, ttl, max_sessions, max_bytes, cookie_keys=None, cookie_max_bytes=3800):
+    """Build a backend from a SESSION_BACKEND url
+
+    memory                      -> MemoryBackend (default)
+    cookie                      -> CookieBackend (needs cookie_keys)
+    sqlite:///relative/path.db  -> SQLiteBackend (sqlite:////abs/path.db)
+    redis://[:password@]host:port/db -> RedisBackend
+    """
+    if not url or url == "memory":
+        return MemoryBackend(max_sessions=max_sessions, max_bytes=max_bytes, ttl=ttl)
+    if url == "cookie":
+        return CookieBackend(parse_cookie_keys(cookie_keys), ttl=ttl, max_bytes=cookie_max_bytes)
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        path = unquote(parsed.path[1:] if parsed.path.startswith("/") else parsed.path)
+        return SQLiteBackend(path, ttl=ttl)
+    if parsed.scheme == "redis":
+        db = int(parsed.path[1:]) if parsed.path[1:] else 0
+        client = RespClient(parsed.hostname or "127.0.0.1", parsed.port or 6379, db=db,
+                            password=unquote(parsed.password) if parsed.password else None)
+        return RedisBackend(client, ttl=ttl)
+    raise ValueError(f"Unsupported SESSION_BACKEND: {url}")
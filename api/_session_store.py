@@ -0,0 +1,187 @@
+"""Session layer for the game API.
+
+`SessionStore` is what the request handlers talk to. It reads each session
+from a backend at most once per request and batches every write made while
+handling the request into a single `write_many` call on `flush()`, so a
+choice round-trip costs one backend read and one backend write whatever the
+backend is (see `_session_backends`).
+"""
+import json
+import sys
+import threading
+import time
+
+from _journey import Journey
+from _profile import SessionProfile, session_hash
+
+
+class SessionRecord:
+    """Everything the API keeps for one player"""
+    __slots__ = ("state", "profile", "last_access", "size")
+
+    def __init__(self, state=None, profile=None):
+        self.state = state
+        self.profile = profile if profile is not None else SessionProfile()
+        self.last_access = time.time()
+        self.size = 0
+
+
+def _estimate_size(value):
+    """Rough recursive size of the containers that make up a game state"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + _estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += _estimate_size(item)
+    return size
+
+
+def estimate_record_size(record):
+    """Approximate number of bytes held by a session record"""
+    size = sys.getsizeof(record) + sys.getsizeof(record.profile)
+    if isinstance(record.state, Journey):
+        size += record.state.size()
+    elif record.state is not None:
+        size += _estimate_size(record.state)
+    for value in record.profile.to_primitive().values():
+        if value is not None:
+            size += _estimate_size(value)
+    return size
+
+
+def record_to_bytes(record, compact=False):
+    """Serialize a record for backends that store blobs
+
+    `compact` leaves out the profile values that are recomputed from the
+    session id and story pack on load (the hash and the unique styles).
+    """
+    payload = record.profile.to_primitive()
+    if compact:
+        for key in ("h", "u", "v"):
+            del payload[key]
+    state = record.state
+    payload["s"] = state.to_primitive() if isinstance(state, Journey) else state
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def record_from_bytes(data):
+    payload = json.loads(data)
+    state = payload.get("s")
+    if isinstance(state, dict) and "j" in state:
+        state = Journey.from_primitive(state)
+    # Anything else is a game stored as a dict before journeys; index.py
+    # converts it once it knows the story graph
+    return SessionRecord(state, SessionProfile.from_primitive(payload))
+
+
+class SessionStore:
+    """Request-scoped read cache and write batch in front of a backend"""
+
+    def __init__(self, backend, observe=None):
+        self.backend = backend
+        self.observe = observe  # observe(stage, seconds) for backend calls
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.writes = 0
+        self.write_errors = 0
+
+    def _pending(self):
+        # (records seen in this request, ids of records that need writing)
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            pending = self._local.pending = ({}, set())
+        return pending
+
+    def __len__(self):
+        return self.backend.count()
+
+    def __contains__(self, session_id):
+        return self.peek(session_id) is not None
+
+    def get(self, session_id):
+        """Return the session record, reading the backend once per request"""
+        return self._load(session_id, touch=True)
+
+    def peek(self, session_id):
+        """Like get() but without refreshing the session's idle timer"""
+        return self._load(session_id, touch=False)
+
+    def _load(self, session_id, touch):
+        seen, _ = self._pending()
+        if session_id in seen:
+            return seen[session_id]
+        with self._lock:
+            self.reads += 1
+        started = time.perf_counter()
+        record = self.backend.load(session_id, touch=touch)
+        if self.observe is not None:
+            self.observe("session_load", time.perf_counter() - started)
+        if record is not None and record.profile.session_hash is None:
+            # Stored before profiles kept the hash
+            record.profile.session_hash = session_hash(session_id)
+        seen[session_id] = record
+        return record
+
+    def create(self, session_id):
+        """Start an empty record for a session; written on the next flush"""
+        record = SessionRecord(profile=SessionProfile(session_hash(session_id)))
+        self.save(session_id, record)
+        return record
+
+    def get_or_create(self, session_id):
+        record = self.get(session_id)
+        if record is None:
+            record = self.create(session_id)
+        return record
+
+    def save(self, session_id, record):
+        """Queue a (possibly mutated) record to be written on flush"""
+        seen, dirty = self._pending()
+        seen[session_id] = record
+        dirty.add(session_id)
+
+    def delete(self, session_id):
+        seen, dirty = self._pending()
+        seen.pop(session_id, None)
+        dirty.discard(session_id)
+        self.backend.delete(session_id)
+
+    def flush(self):
+        """Write every record saved during this request in one batch"""
+        seen, dirty = self._pending()
+        if not dirty:
+            return
+        batch = {session_id: seen[session_id] for session_id in dirty}
+        dirty.clear()
+        started = time.perf_counter()
+        try:
+            self.backend.write_many(batch)
+        except Exception:
+            with self._lock:
+                self.write_errors += 1
+            raise
+        if self.observe is not None:
+            self.observe("session_write", time.perf_counter() - started)
+        with self._lock:
+            self.writes += 1
+
+    def end_request(self):
+        """Forget the per-request cache (unflushed writes are dropped)"""
+        self._local.pending = None
+
+    def sweep(self):
+        self.backend.sweep()
+
+    def stats(self):
+        stats = self.backend.stats()
+        with self._lock:
+            stats.update({
+                "backend": self.backend.name,
+                "store_reads": self.reads,
+                "store_writes": self.writes,
+                "store_write_errors": self.write_errors
+            })
+        return stats
@@ -0,0 +1,220 @@
+"""Share cards: one PNG per finished journey, composited on the server.
+
+A card shows the ending, the score and thumbnails of the journey's final
+images. Its key is a hash of exactly that content, so a card is drawn once
+and then served from disk however often its link is opened. The pictures
+are seeded per session, so in practice every finished game gets a card of
+its own. Needs Pillow; without it `CARDS_AVAILABLE` is False and the API
+simply doesn't offer cards.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from _files import write_atomic
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # optional; no share cards
+    Image = None
+
+CARDS_AVAILABLE = Image is not None
+CARD_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+CARD_WIDTH = 1200
+CARD_HEIGHT = 630
+THUMB_SIZE = 400
+MARGIN = 40
+BACKGROUND = (18, 38, 28)
+ACCENT = (214, 190, 120)
+TEXT = (240, 236, 222)
+
+
+class ShareCards:
+    """Card specs registered by the API, rendered to PNG on first request
+
+    Drawing a card waits at most `image_wait` seconds for its pictures; any
+    still missing then get an empty frame (and keep loading into the image
+    cache for the next request).
+    """
+
+    def __init__(self, directory, image_cache, max_cards=5000, max_specs=50000, image_wait=10):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "mystic-forest-cards")
+        self.image_cache = image_cache
+        self.max_cards = max_cards
+        self.max_specs = max_specs
+        self.image_wait = image_wait
+        os.makedirs(self.directory, exist_ok=True)
+        self._fetches = ThreadPoolExecutor(max_workers=4, thread_name_prefix="share-card")
+        self._lock = threading.Lock()
+        self._rendering = {}  # key -> [Lock, requests using it], so a card is drawn once
+        self._writes = 0
+        self.registered = 0
+        self.rendered = 0
+        self.incomplete = 0
+        self.hits = 0
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def register(self, title, ending_category, score, image_keys):
+        """Remember a card's content and return its key"""
+        spec = {"title": title, "ending": ending_category, "score": score,
+                "images": list(image_keys)}
+        data = json.dumps(spec, sort_keys=True, separators=(",", ":")).encode()
+        key = hashlib.sha256(data).hexdigest()[:32]
+        spec_path = self._path(key, ".json")
+        if not os.path.exists(spec_path):
+            write_atomic(spec_path, data)
+            with self._lock:
+                self.registered += 1
+                self._writes += 1
+                due = self._writes >= 1000
+                if due:
+                    self._writes = 0
+            if due:
+                self._trim(".json", self.max_specs)
+        return key
+
+    def get(self, key):
+        """(path, None) for the card's PNG, drawing it first if needed; KeyError if unknown
+
+        A card drawn without one of its pictures (the image service failed)
+        is not kept: it comes back as (None, PNG bytes) and is drawn again
+        next time.
+        """
+        path = self._path(key, ".png")
+        if os.path.exists(path):
+            with self._lock:
+                self.hits += 1
+            return path, None
+        with self._lock:
+            rendering = self._rendering.get(key)
+            if rendering is None:
+                rendering = self._rendering[key] = [threading.Lock(), 0]
+            rendering[1] += 1
+        try:
+            with rendering[0]:
+                if not os.path.exists(path):
+                    try:
+                        with open(self._path(key, ".json"), "rb") as f:
+                            spec = json.load(f)
+                    except OSError:
+                        raise KeyError(key)
+                    data, complete = self._render(spec)
+                    with self._lock:
+                        self.rendered += 1
+                        if not complete:
+                            self.incomplete += 1
+                    if not complete:
+                        return None, data
+                    write_atomic(path, data)
+                    self._trim(".png", self.max_cards)
+        finally:
+            # The lock stays until its last waiter is done with it, so a
+            # request arriving meanwhile can't start a second drawing
+            with self._lock:
+                rendering[1] -= 1
+                if not rendering[1]:
+                    del self._rendering[key]
+        return path, None
+
+    def _render(self, spec):
+        """(PNG bytes, whether every picture made it onto the card)"""
+        card = Image.new("RGB", (CARD_WIDTH, CARD_HEIGHT), BACKGROUND)
+        draw = ImageDraw.Draw(card)
+        thumbs = self._thumbnails(spec["images"][:2])
+        top = (CARD_HEIGHT - THUMB_SIZE) // 2
+        for i, thumb in enumerate(thumbs):
+            box = (MARGIN + i * (THUMB_SIZE + 20), top)
+            if thumb is None:
+                draw.rectangle([box, (box[0] + THUMB_SIZE, box[1] + THUMB_SIZE)], outline=ACCENT, width=3)
+            else:
+                card.paste(thumb, box)
+        left = MARGIN + len(thumbs) * (THUMB_SIZE + 20) + 10
+        width = CARD_WIDTH - left - MARGIN
+        _draw_wrapped(draw, (left, top), spec["title"], _font(30), width, ACCENT)
+        draw.text((left, top + 110), "Ending", fill=ACCENT, font=_font(22))
+        _draw_wrapped(draw, (left, top + 140), spec["ending"], _font(34), width, TEXT)
+        draw.text((left, top + 290), "Score", fill=ACCENT, font=_font(22))
+        draw.text((left, top + 320), str(spec["score"]), fill=TEXT, font=_font(64))
+        out = io.BytesIO()
+        card.save(out, "PNG", optimize=True)
+        return out.getvalue(), None not in thumbs
+
+    def _thumbnails(self, image_keys):
+        """Square thumbnails of the images, fetched together; None for any not ready in time"""
+        fetches = [self._fetches.submit(self.image_cache.get, image_key) for image_key in image_keys]
+        wait(fetches, timeout=self.image_wait)
+        return [self._thumbnail(image_key, fetch) for image_key, fetch in zip(image_keys, fetches)]
+
+    def _thumbnail(self, image_key, fetch):
+        if not fetch.done():
+            print(f"Share card image {image_key} not ready after {self.image_wait}s")
+            return None
+        try:
+            with Image.open(fetch.result().path) as source:
+                return source.convert("RGB").resize((THUMB_SIZE, THUMB_SIZE))
+        except Exception as e:
+            # A card without one picture beats no card
+            print(f"Share card image {image_key} unavailable: {str(e)}")
+            return None
+
+    def _trim(self, suffix, limit):
+        """Drop the oldest cards (".png") or specs (".json") past `limit`
+
+        A dropped spec takes its card with it.
+        """
+        try:
+            files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(suffix)]
+        except OSError:
+            return
+        if len(files) <= limit:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - limit]:
+            paths = [entry.path]
+            if suffix == ".json":
+                paths.append(entry.path[:-len(suffix)] + ".png")
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "registered": self.registered,
+                "rendered": self.rendered,
+                "incomplete": self.incomplete,
+                "hits": self.hits
+            }
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has one fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+def _draw_wrapped(draw, origin, text, font, width, fill):
+    x, y = origin
+    line_height = getattr(font, "size", 12) + 8
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}".strip()
+        if line and draw.textlength(candidate, font=font) > width:
+            draw.text((x, y), line, fill=fill, font=font)
+            y += line_height
+            line = word
+        else:
+            line = candidate
+    if line:
+        draw.text((x, y), line, fill=fill, font=font)
@@ -0,0 +1,159 @@
+"""Fingerprinted, precompressed static files from public/.
+
+At startup every text asset in public/ is read into memory, hashed, and
+compressed once with gzip (and brotli when the `brotli` package is
+installed). The scripts and stylesheet the page loads are also served under
+a content-hashed name (`script.3f2a9c1b7e04.js`), and index.html is
+rewritten to point at those names, so they can be cached by browsers and
+CDNs for a year: a new deploy changes the name, not the bytes behind it.
+index.html and the plain names are served with `no-cache` and an ETag, so
+a repeat load is a 304.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+COMPRESSIBLE = (".html", ".js", ".css", ".svg", ".json", ".txt", ".map")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, no-cache"
+
+
+def source_fingerprint(paths):
+    """Short hash of a set of files, e.g. the code that renders a response"""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class StaticAsset:
+    """One file, its compressed variants and the URL it is cached under"""
+    __slots__ = ("name", "url", "content_type", "digest", "bodies", "mtime_ns")
+
+    def __init__(self, name, data, mtime_ns, fingerprint=False):
+        self.name = name
+        self.content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if self.content_type.startswith("text/") or name.endswith(".js"):
+            self.content_type += "; charset=utf-8"
+        self.mtime_ns = mtime_ns
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        if fingerprint:
+            stem, ext = os.path.splitext(self.name)
+            self.url = f"{stem}.{self.digest}{ext}"
+        else:
+            self.url = self.name
+        self.bodies = {"identity": data}
+        compressed = gzip.compress(data, 9, mtime=0)
+        if len(compressed) < len(data):
+            self.bodies["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                self.bodies["br"] = compressed
+
+    def encodings(self):
+        # Smallest first, so it wins when the client likes several equally
+        return sorted(self.bodies, key=lambda encoding: len(self.bodies[encoding]))
+
+    def etag(self, encoding):
+        return self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+
+class StaticAssets:
+    """The compressible files in a directory, keyed by the paths they're served at"""
+
+    def __init__(self, root, fingerprint=(), entry="index.html", check_interval=2.0):
+        self.root = os.path.abspath(root)
+        self.fingerprint = tuple(fingerprint)
+        self.entry = entry
+        self.check_interval = check_interval
+        self._assets = {}  # file name -> StaticAsset
+        self._routes = {}  # served path -> (StaticAsset, immutable)
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self.builds = 0
+        self.scan()
+
+    def scan(self):
+        """(Re)build every asset whose file changed since the last scan"""
+        found = {}
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if name.endswith(COMPRESSIBLE):
+                    try:
+                        found[name] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        continue
+        with self._lock:
+            if found == {name: asset.mtime_ns for name, asset in self._assets.items()}:
+                return
+            assets = {}
+            for name, mtime_ns in found.items():
+                asset = self._assets.get(name)
+                if asset is None or asset.mtime_ns != mtime_ns:
+                    try:
+                        with open(os.path.join(self.root, name), "rb") as f:
+                            data = f.read()
+                    except OSError:
+                        continue
+                    asset = StaticAsset(name, data, mtime_ns, name in self.fingerprint)
+                assets[name] = asset
+            entry = assets.get(self.entry)
+            if entry is not None:
+                assets[entry.name] = StaticAsset(entry.name, self._link(entry, assets),
+                                                 entry.mtime_ns)
+            routes = {}
+            for name, asset in assets.items():
+                routes[name] = (asset, False)
+                if asset.url != name:
+                    routes[asset.url] = (asset, True)
+            self._assets, self._routes = assets, routes
+            self.builds += 1
+
+    def _link(self, entry, assets):
+        """The entry page with references to fingerprinted files renamed"""
+        with open(os.path.join(self.root, entry.name), "rb") as f:
+            html = f.read().decode("utf-8")
+        for name in self.fingerprint:
+            asset = assets.get(name)
+            if asset is not None:
+                # Only whole quoted references such as "style.css" or './script.js'
+                html = re.sub(r"""(?<=["'/])%s(?=["'?#])""" % re.escape(name), asset.url, html)
+        return html.encode("utf-8")
+
+    def maybe_reload(self):
+        """Rescan at most once per check_interval (cheap enough per request)"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        self.scan()
+
+    def get(self, path):
+        """(asset, immutable) for a request path, or None"""
+        return self._routes.get(path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self._assets),
+                "builds": self.builds,
+                "brotli": brotli is not None,
+                "fingerprinted": {name: self._assets[name].url
+                                  for name in self.fingerprint if name in self._assets},
+                "bytes": {encoding: sum(len(asset.bodies.get(encoding, asset.bodies["identity"]))
+                                        for asset in self._assets.values())
+                          for encoding in ("identity", "gzip") + (("br",) if brotli else ())}
+            }
@@ -0,0 +1,261 @@
+"""Compiled, immutable form of the story graph.
+
+`compile_story` turns the `story_nodes` dict into tuple-backed `Node` and
+`Choice` records with integer ids and interned strings, and checks the graph
+for dangling links, unreachable nodes and missing endings. Handlers read
+these records directly instead of copying node dicts on every request.
+"""
+import sys
+from collections import namedtuple
+
+# next_index of a choice whose ending is worked out from the player's score
+CALCULATE_END = -1
+
+# How `_calculate_end` classifies a finished game when a pack has no
+# "ending_rules": tags weigh +1/-1 into a balance, and the first rule whose
+# bounds contain the score and balance names the generic ending
+DEFAULT_ENDING_RULES = {
+    "tag_weights": {"kind": 1, "adventurous": 1, "bold": 1, "wise": 1, "resourceful": 1,
+                    "selfish": -1, "cautious": -1, "stubborn": -1},
+    "rules": [
+        {"ending": "generic_good_ending", "min_score": 5, "min_balance": 1},
+        {"ending": "generic_bad_ending", "max_score": 0},
+        {"ending": "generic_bad_ending", "max_balance": -1},
+        {"ending": "generic_neutral_ending"}
+    ]
+}
+_RULE_BOUNDS = ("min_score", "max_score", "min_balance", "max_balance")
+
+
+class StoryValidationError(ValueError):
+    """The story graph is not playable"""
+
+    def __init__(self, problems):
+        super().__init__("Invalid story graph:\n  " + "\n  ".join(problems))
+        self.problems = problems
+
+
+class Choice(namedtuple("Choice", [
+        "index", "text", "next_node", "next_index", "score_modifier", "tag",
+        "verb_prefix", "verb_suffix", "weight"])):
+    # verb_prefix/verb_suffix split the text right after its leading verb so
+    # a personalized adverb can be inserted there (None if there is no verb);
+    # weight is what the tag adds to the ending rules' balance
+    __slots__ = ()
+
+    def to_dict(self, text=None):
+        """The choice as the API has always sent it, optionally re-worded"""
+        return {
+            "text": self.text if text is None else text,
+            "next_node": self.next_node,
+            "score_modifier": self.score_modifier,
+            "tag": self.tag
+        }
+
+
+class Node(namedtuple("Node", [
+        "id", "index", "situation", "prompt", "seed", "is_end",
+        "ending_category", "choices"])):
+    __slots__ = ()
+
+
+class EndingRule(namedtuple("EndingRule", [
+        "ending", "min_score", "max_score", "min_balance", "max_balance"])):
+    # Inclusive bounds; None means unbounded
+    __slots__ = ()
+
+    def matches(self, score, balance):
+        return ((self.min_score is None or score >= self.min_score)
+                and (self.max_score is None or score <= self.max_score)
+                and (self.min_balance is None or balance >= self.min_balance)
+                and (self.max_balance is None or balance <= self.max_balance))
+
+
+class StoryGraph:
+    """Nodes addressable by integer index or by name"""
+    __slots__ = ("nodes", "by_name", "start", "endings", "ending_rules")
+
+    def __init__(self, nodes, start, endings, ending_rules=()):
+        self.nodes = nodes
+        self.by_name = {node.id: node for node in nodes}
+        self.start = self.by_name[start]
+        self.endings = endings  # generic ending -> tuple of ending node names
+        self.ending_rules = ending_rules  # EndingRules, first match wins
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def index_of(self, name):
+        return self.by_name[name].index
+
+    def to_primitive(self):
+        """Plain tuples/dicts that marshal can store (see graph_from_primitive)"""
+        return {
+            "start": self.start.id,
+            "endings": dict(self.endings),
+            "ending_rules": tuple(tuple(rule) for rule in self.ending_rules),
+            "nodes": tuple(tuple(node[:-1]) + (tuple(tuple(choice) for choice in node.choices),)
+                           for node in self.nodes)
+        }
+
+
+def graph_from_primitive(data):
+    """Rebuild a StoryGraph from to_primitive() output without re-validating"""
+    nodes = tuple(Node(*fields[:-1], tuple(Choice(*choice) for choice in fields[-1]))
+                  for fields in data["nodes"])
+    return StoryGraph(nodes, data["start"], data["endings"],
+                      tuple(EndingRule(*rule) for rule in data["ending_rules"]))
+
+
+def _split_at_verb(text, choice_verbs):
+    """Text before and after the first known verb that isn't the last word"""
+    words = text.split()
+    for j, word in enumerate(words):
+        if word in choice_verbs and j < len(words) - 1:
+            return " ".join(words[:j + 1]), " ".join(words[j + 1:])
+    return None, None
+
+
+def compile_story(story_nodes, endings, start="start", choice_verbs=(), ending_rules=None):
+    """Build a validated StoryGraph from a story_nodes-style dict
+
+    `endings` maps each generic ending of `_calculate_end` to the ending
+    nodes it can resolve to, and `ending_rules` (see DEFAULT_ENDING_RULES)
+    says which generic ending a score and tag balance get. `choice_verbs`
+    are the verbs after which choice texts can be personalized.
+    """
+    choice_verbs = frozenset(choice_verbs)
+    names = list(story_nodes)
+    index_by_name = {name: i for i, name in enumerate(names)}
+    problems = []
+    if ending_rules is None:
+        ending_rules = DEFAULT_ENDING_RULES
+    tag_weights = ending_rules.get("tag_weights", {})
+
+    nodes = []
+    for i, name in enumerate(names):
+        spec = story_nodes[name]
+        choices = []
+        for j, choice in enumerate(spec.get("choices", [])):
+            next_node = choice.get("next_node")
+            if next_node == "_calculate_end":
+                next_index = CALCULATE_END
+            elif next_node in index_by_name:
+                next_index = index_by_name[next_node]
+            else:
+                problems.append(f"{name}: choice {j} leads to unknown node {next_node!r}")
+                next_index = None
+            tag = choice.get("tag")
+            text = choice.get("text", "")
+            verb_prefix, verb_suffix = _split_at_verb(text, choice_verbs)
+            choices.append(Choice(
+                j,
+                sys.intern(text),
+                sys.intern(next_node) if next_node else next_node,
+                next_index,
+                choice.get("score_modifier", 0),
+                sys.intern(tag) if tag else tag,
+                verb_prefix,
+                verb_suffix,
+                tag_weights.get(tag, 0)
+            ))
+        ending_category = spec.get("ending_category", "")
+        nodes.append(Node(
+            sys.intern(name),
+            i,
+            spec.get("situation", ""),
+            spec.get("prompt", ""),
+            spec.get("seed", 12345),
+            spec.get("is_end", False),
+            sys.intern(ending_category) if ending_category else ending_category,
+            tuple(choices)
+        ))
+
+    if start not in index_by_name:
+        problems.append(f"start node {start!r} does not exist")
+    endings = {generic: tuple(variants) for generic, variants in endings.items()}
+    # Packs that never use _calculate_end don't need rules that work
+    uses_rules = any(choice.next_index == CALCULATE_END for node in nodes for choice in node.choices)
+    rules = _compile_rules(ending_rules.get("rules", ()), endings, index_by_name,
+                           problems if uses_rules else [])
+    problems.extend(_check(nodes, index_by_name, endings, start))
+    if problems:
+        raise StoryValidationError(problems)
+    return StoryGraph(tuple(nodes), start, endings, rules)
+
+
+def _compile_rules(specs, endings, index_by_name, problems):
+    rules = []
+    for i, spec in enumerate(specs):
+        unknown = set(spec) - {"ending"} - set(_RULE_BOUNDS)
+        if unknown:
+            problems.append(f"ending rule {i}: unknown keys {sorted(unknown)}")
+        ending = spec.get("ending")
+        if not endings.get(ending) and ending not in index_by_name:
+            problems.append(f"ending rule {i}: {ending!r} is neither an ending nor a node")
+        rules.append(EndingRule(ending, *(spec.get(bound) for bound in _RULE_BOUNDS)))
+    # _calculate_end has to land somewhere whatever the score
+    if not rules or any(bound is not None for bound in rules[-1][1:]):
+        problems.append("ending rules must end with a rule without bounds")
+    return tuple(rules)
+
+
+def _check(nodes, index_by_name, endings, start):
+    problems = []
+    ending_indexes = []
+    for generic, variants in endings.items():
+        # A generic ending node, if defined, is the fallback when a variant
+        # is missing, so it counts as reachable too
+        if generic in index_by_name:
+            variants = (generic,) + variants
+        for variant in variants:
+            index = index_by_name.get(variant)
+            if index is None:
+                problems.append(f"ending {variant!r} for {generic} does not exist")
+            elif not nodes[index].is_end:
+                problems.append(f"ending {variant!r} for {generic} is not an end node")
+            else:
+                ending_indexes.append(index)
+
+    for node in nodes:
+        if node.is_end:
+            if node.choices:
+                problems.append(f"{node.id}: end node has choices")
+            if not node.ending_category:
+                problems.append(f"{node.id}: end node has no ending_category")
+        elif not node.choices:
+            problems.append(f"{node.id}: dead end (no choices and not an ending)")
+
+    if not any(node.is_end for node in nodes):
+        problems.append("story has no endings")
+
+    # Everything must be reachable from the start; _calculate_end can lead
+    # to any of the configured endings
+    if start in index_by_name:
+        seen = {index_by_name[start]}
+        stack = [index_by_name[start]]
+        while stack:
+            for choice in nodes[stack.pop()].choices:
+                if choice.next_index == CALCULATE_END:
+                    targets = ending_indexes
+                elif choice.next_index is None:
+                    continue
+                else:
+                    targets = (choice.next_index,)
+                for target in targets:
+                    if target not in seen:
+                        seen.add(target)
+                        stack.append(target)
+        for node in nodes:
+            if node.index not in seen:
+                problems.append(f"{node.id}: unreachable from {start!r}")
+    return problems
@@ -0,0 +1,249 @@
+"""Story packs: game content loaded from files instead of Python literals.
+
+A pack is a JSON (or, on Python 3.11+, TOML) file with the story nodes, the
+ending variants `_calculate_end` chooses between, the rules it chooses them
+by and the style/personality word lists used to personalize prompts and
+choices. See
+packs/mystic_forest.json for the layout.
+
+The first load of a pack compiles and validates it and writes the result to
+a small binary cache (a header plus a marshal dump of the compiled graph).
+Later cold starts memory-map that file instead of parsing and validating the
+source again, as long as the source's mtime and size still match.
+
+`PackRegistry` holds every pack in a directory, reloads changed files
+atomically and keeps a few previous versions so sessions pinned to the
+version they started on are not broken by an edit.
+"""
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+from _endings import EndingResolver
+from _files import write_atomic
+from _story_graph import compile_story, graph_from_primitive
+
+PACK_EXTENSIONS = (".json", ".toml")
+CACHE_MAGIC = b"MFPK"
+CACHE_FORMAT = 3
+# magic, format, source mtime_ns, source size, pack version
+_CACHE_HEADER = struct.Struct(">4sHqq16s")
+
+
+class StoryPackError(Exception):
+    """A pack file could not be loaded"""
+
+
+class StoryPack:
+    """One loaded version of a story pack"""
+    __slots__ = ("id", "version", "title", "graph", "styles", "source", "resolver")
+
+    def __init__(self, pack_id, version, title, graph, styles, source):
+        self.id = pack_id
+        self.version = version
+        self.title = title
+        self.graph = graph
+        self.styles = styles
+        self.source = source
+        self.resolver = EndingResolver(graph)
+
+    @property
+    def endings(self):
+        return self.graph.endings
+
+
+def _freeze(value):
+    """Lists become tuples so shared pack data can't be mutated by handlers"""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _freeze(item) for key, item in value.items()}
+    return value
+
+
+def _parse(path, data):
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise StoryPackError("TOML packs need Python 3.11+")
+        return tomllib.loads(data.decode("utf-8"))
+    return json.loads(data)
+
+
+def _default_id(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def compile_pack(spec, version, source):
+    """Validate a parsed pack and build its StoryPack"""
+    if "nodes" not in spec:
+        raise StoryPackError("pack has no nodes")
+    styles = _freeze(spec.get("styles", {}))
+    graph = compile_story(spec["nodes"], spec.get("endings", {}), start=spec.get("start", "start"),
+                          choice_verbs=styles.get("choice_verbs", ()),
+                          ending_rules=spec.get("ending_rules"))
+    pack_id = spec.get("id") or _default_id(source)
+    return StoryPack(pack_id, version, spec.get("title", pack_id), graph, styles, source)
+
+
+def _cache_path(path, cache_dir):
+    digest = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{_default_id(path)}-{digest}.mfpk")
+
+
+def _read_cache(cache_path, stat, source):
+    try:
+        with open(cache_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if len(mapped) < _CACHE_HEADER.size:
+                    return None
+                magic, fmt, mtime_ns, size, version = _CACHE_HEADER.unpack_from(mapped)
+                if (magic != CACHE_MAGIC or fmt != CACHE_FORMAT
+                        or mtime_ns != stat.st_mtime_ns or size != stat.st_size):
+                    return None
+                with memoryview(mapped) as view:
+                    data = marshal.loads(view[_CACHE_HEADER.size:])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    return StoryPack(data["id"], version.decode("ascii"), data["title"],
+                     graph_from_primitive(data["graph"]), data["styles"], source)
+
+
+def _write_cache(cache_path, stat, pack):
+    payload = marshal.dumps({
+        "id": pack.id,
+        "title": pack.title,
+        "styles": pack.styles,
+        "graph": pack.graph.to_primitive()
+    })
+    header = _CACHE_HEADER.pack(CACHE_MAGIC, CACHE_FORMAT, stat.st_mtime_ns, stat.st_size,
+                                pack.version.encode("ascii"))
+    try:
+        write_atomic(cache_path, header + payload)
+    except OSError as e:
+        # A read-only deployment just keeps compiling from source
+        print(f"Could not write story pack cache {cache_path}: {str(e)}")
+
+
+def load_pack(path, cache_dir=None):
+    """Load a pack file, using (and refreshing) its compiled cache"""
+    stat = os.stat(path)
+    cache_path = _cache_path(path, cache_dir) if cache_dir else None
+    if cache_path:
+        pack = _read_cache(cache_path, stat, path)
+        if pack is not None:
+            return pack
+
+    with open(path, "rb") as f:
+        data = f.read()
+    version = hashlib.sha256(data).hexdigest()[:16]
+    try:
+        spec = _parse(path, data)
+    except ValueError as e:
+        raise StoryPackError(str(e))
+    pack = compile_pack(spec, version, path)
+    if cache_path:
+        _write_cache(cache_path, stat, pack)
+    return pack
+
+
+class PackRegistry:
+    """Every story pack in a directory, hot-reloaded when files change"""
+
+    def __init__(self, directory, cache_dir=None, check_interval=2.0, keep_versions=4):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.check_interval = check_interval
+        self.keep_versions = keep_versions
+        self._lock = threading.Lock()
+        self._current = {}  # pack id -> StoryPack
+        self._versions = OrderedDict()  # (pack id, version) -> StoryPack
+        self._files = {}  # path -> (mtime_ns, size)
+        self._failed = {}  # path -> (mtime_ns, size) of a broken edit
+        self._next_check = 0
+        self.reloads = 0
+        self.reload_errors = 0
+        self.scan()
+
+    def _pack_files(self):
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names
+                if name.endswith(PACK_EXTENSIONS)]
+
+    def scan(self):
+        """Load new or changed pack files; broken edits keep the old version"""
+        for path in self._pack_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if self._files.get(path) == signature or self._failed.get(path) == signature:
+                continue
+            try:
+                pack = load_pack(path, self.cache_dir)
+            except Exception as e:
+                self._failed[path] = signature
+                self.reload_errors += 1
+                print(f"Error loading story pack {path}: {str(e)}")
+                continue
+            self._failed.pop(path, None)
+            with self._lock:
+                reloaded = path in self._files
+                self._files[path] = signature
+                self._current[pack.id] = pack
+                self._versions[(pack.id, pack.version)] = pack
+                self._versions.move_to_end((pack.id, pack.version))
+                self._trim(pack.id)
+                if reloaded:
+                    self.reloads += 1
+
+    def _trim(self, pack_id):
+        versions = [key for key in self._versions if key[0] == pack_id]
+        for key in versions[:-self.keep_versions]:
+            if self._versions[key] is not self._current.get(pack_id):
+                del self._versions[key]
+
+    def maybe_reload(self):
+        """Rescan at most once per check_interval (cheap enough per request)"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        self.scan()
+
+    def current(self, pack_id):
+        return self._current.get(pack_id)
+
+    def get(self, pack_id, version=None):
+        """The pinned version if it is still loaded, else the current one"""
+        if version is not None:
+            pack = self._versions.get((pack_id, version))
+            if pack is not None:
+                return pack
+        return self._current.get(pack_id)
+
+    def ids(self):
+        return sorted(self._current)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "packs": {pack_id: pack.version for pack_id, pack in self._current.items()},
+                "loaded_versions": len(self._versions),
+                "reloads": self.reloads,
+                "reload_errors": self.reload_errors
+            }
@@ -0,0 +1,84 @@
+"""Wire formats for the game state, and compression of API responses.
+
+The state JSON the API has always sent stays the default. Clients can ask
+for a compact schema instead with the Accept header:
+
+    Accept: application/vnd.mystic-forest.compact+json
+    Accept: application/msgpack        (if the msgpack package is installed)
+
+The compact schema drops what the client can do without: the duplicate
+score and the next node and score modifier of every choice. The image
+prompt stays, since the page uses it as the picture's alt text. Keys are
+one letter:
+
+    s  situation             c  choice texts (nodes with choices)
+    i  image URL             e  1 on end nodes
+    a  image prompt          k  ending category   (end nodes)
+    p  score
+    m  manga image URL       u  summary image URL (end nodes)
+    o  outcome code          (end nodes, when issued)
+
+`compress` picks gzip, or brotli when the `brotli` package is installed,
+from Accept-Encoding for any JSON or MessagePack response big enough to
+gain from it.
+"""
+import gzip
+import json
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # optional; no MessagePack
+    msgpack = None
+
+JSON = "application/json"
+COMPACT_JSON = "application/vnd.mystic-forest.compact+json"
+MSGPACK = "application/msgpack"
+# Cheapest first, so it wins when the client likes several equally
+STATE_FORMATS = (JSON, COMPACT_JSON) + ((MSGPACK,) if msgpack is not None else ())
+# Told apart in ETags, since each is a different representation
+FORMAT_TAGS = {JSON: "", COMPACT_JSON: "-c", MSGPACK: "-m"}
+
+COMPRESSIBLE = (JSON, COMPACT_JSON, MSGPACK)
+ENCODINGS = (("br",) if brotli is not None else ()) + ("gzip",)
+GZIP_LEVEL = 6  # dynamic responses; the static files get 9 once at startup
+BROTLI_QUALITY = 5
+
+
+def compact_state(data):
+    """The compact form of a /api/state response"""
+    compact = {
+        "s": data["situation"],
+        "i": data["image_url"],
+        "a": data["image_prompt"],
+        "p": data["score"]
+    }
+    if data["is_end"]:
+        compact["e"] = 1
+        compact["k"] = data["ending_category"]
+        for field, key in (("manga_image_url", "m"), ("summary_image_url", "u"), ("outcome", "o")):
+            if data.get(field):
+                compact[key] = data[field]
+    elif data["choices"]:
+        compact["c"] = [choice["text"] for choice in data["choices"]]
+    return compact
+
+
+def encode_state(data, mimetype):
+    """(body, mimetype) for a state response in a negotiated format"""
+    if mimetype == MSGPACK and msgpack is not None:
+        return msgpack.packb(compact_state(data), use_bin_type=True), MSGPACK
+    if mimetype == COMPACT_JSON:
+        return json.dumps(compact_state(data), separators=(",", ":"), ensure_ascii=False).encode(), COMPACT_JSON
+    return None, JSON
+
+
+def compress(body, encoding):
+    """`body` compressed with a Content-Encoding from ENCODINGS"""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
@@ -0,0 +1,294 @@
+"""ASGI entry point for the game API.
+
+    uvicorn --app-dir api asgi:app --workers 1
+
+The Flask `app` in index.py stays the WSGI entry used on Vercel. This module
+serves the same routes from an asyncio event loop:
+
+- /api/image/<key> is handled on the loop itself. Cache misses are fetched
+  upstream with a pooled asyncio HTTP client, so a player waiting seconds on
+  a render costs a coroutine, not a thread, and one process can hold
+  thousands of image waits.
+- Image pre-warming runs as coroutines on the same loop (LoopPrefetcher).
+- Everything else (/api/state, /api/choice, /api/reset, /api/share-image,
+  static files) runs the Flask handlers unchanged on a small thread pool.
+  They do no upstream I/O, only CPU work and session store round-trips, so
+  a few threads keep up with the loop.
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import index
+from _admission import client_address
+from _async_http import AsyncHTTPClient
+from _image_cache import AsyncImageFetcher, ImageFetchError, KEY_PATTERN
+from _prefetch import LoopPrefetcher
+
+# Threads running the Flask handlers
+ASGI_WORKER_THREADS = int(os.environ.get("ASGI_WORKER_THREADS", 16))
+# Open connections to the image service, and concurrent prefetches
+ASGI_UPSTREAM_CONNECTIONS = int(os.environ.get("ASGI_UPSTREAM_CONNECTIONS", 256))
+ASGI_PREFETCH_CONCURRENCY = int(os.environ.get("ASGI_PREFETCH_CONCURRENCY", 128))
+
+IMAGE_PREFIX = "/api/image/"
+
+
+class GameASGI:
+    """Async image routes in front of the Flask app"""
+
+    def __init__(self, flask_app, image_cache, threads=16):
+        self.flask_app = flask_app
+        self.image_cache = image_cache
+        self.threads = threads
+        self.executor = None
+        self.client = None
+        self.images = None
+
+    # --- Lifecycle ---
+    async def startup(self):
+        if self.executor is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="asgi")
+        if self.image_cache is not None:
+            self.client = AsyncHTTPClient(per_host=ASGI_UPSTREAM_CONNECTIONS,
+                                          timeout=self.image_cache.timeout)
+            self.images = AsyncImageFetcher(self.image_cache, self.client)
+            if index.prefetcher is not None:
+                # Swap the thread-pool prefetcher for one on this loop
+                index.prefetcher.shutdown()
+                index.prefetcher = LoopPrefetcher(
+                    self.images.get, loop, max_workers=ASGI_PREFETCH_CONCURRENCY,
+                    per_session=index.PREFETCH_PER_SESSION,
+                    max_pending=index.PREFETCH_MAX_PENDING)
+
+    async def shutdown(self):
+        if isinstance(index.prefetcher, LoopPrefetcher):
+            index.prefetcher.shutdown()
+        if self.client is not None:
+            await self.client.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.startup()
+            if scope["path"].startswith(IMAGE_PREFIX) and scope["method"] in ("GET", "HEAD"):
+                # Flask's request hooks don't see these, so time them here
+                started = time.perf_counter()
+                rejection = self._check_rate(scope)
+                if rejection is not None:
+                    status = await _send_rejection(send, rejection)
+                else:
+                    status = await self._serve_image(scope, send)
+                index.metrics.observe_request("/api/image/<key>", scope["method"], status,
+                                              time.perf_counter() - started)
+            else:
+                await self._call_flask(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # --- /api/image/<key> ---
+    async def _serve_image(self, scope, send):
+        """Send an image response; returns the status code"""
+        key = scope["path"][len(IMAGE_PREFIX):]
+        if self.images is None or not KEY_PATTERN.match(key):
+            return await _send_json(send, 404, b'{"error":"Unknown image"}')
+        try:
+            image = await self.images.get(key)
+        except KeyError:
+            return await _send_json(send, 404, b'{"error":"Unknown image"}')
+        except ImageFetchError as e:
+            print(f"Error fetching image {key}: {str(e)}")
+            return await self._send_unavailable(scope, send, key, e)
+
+        # The key pins prompt and seed, so the bytes behind it never change
+        etag = f'"{image.etag}"'
+        headers = [(b"etag", etag.encode()),
+                   (b"cache-control", b"public, max-age=31536000, immutable")]
+        request_headers = dict(scope["headers"])
+        if request_headers.get(b"origin"):
+            headers.append((b"access-control-allow-origin", b"*"))
+        if_none_match = request_headers.get(b"if-none-match", b"").decode("latin-1")
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match == "*":
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return 304
+
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.executor, _read_file, image.path)
+        except OSError:
+            # Evicted between lookup and read
+            return await _send_json(send, 502, b'{"error":"Image is not available right now"}')
+        headers += [(b"content-type", image.content_type.encode()),
+                    (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body",
+                    "body": b"" if scope["method"] == "HEAD" else body})
+        return 200
+
+    async def _send_unavailable(self, scope, send, key, error):
+        """The node's stand-in picture, or an error; see index.image_unavailable"""
+        svg = index.fallback_image(key)
+        if svg is not None:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"image/svg+xml"),
+                                    (b"content-length", str(len(svg)).encode()),
+                                    (b"cache-control", b"no-store")]})
+            await send({"type": "http.response.body",
+                        "body": b"" if scope["method"] == "HEAD" else svg})
+            return 200
+        if error.retry_after is not None:
+            retry_after = str(max(1, int(error.retry_after + 0.999))).encode()
+            return await _send_json(send, 503, b'{"error":"Image service is unavailable"}',
+                                    [(b"retry-after", retry_after)])
+        return await _send_json(send, 502, b'{"error":"Image is not available right now"}')
+
+    def _check_rate(self, scope):
+        """The client rate limit for an image request (they hold no thread, so no slot)"""
+        if index.admission is None:
+            return None
+        headers = dict(scope["headers"])
+        forwarded_for = headers.get(b"x-forwarded-for", b"").decode("latin-1")
+        client = client_address((scope.get("client") or ("",))[0], forwarded_for,
+                                index.RATE_LIMIT_PROXY_HOPS)
+        return index.admission.check(client)
+
+    # --- Everything else: the Flask handlers ---
+    async def _call_flask(self, scope, receive, send):
+        # Claim the admission slot before waiting for a thread, so a backlog
+        # behind the pool is shed too; Flask's admit_request sees the flag
+        admitted = False
+        if index.admission is not None and scope["path"].startswith("/api/"):
+            rejection = index.admission.enter()
+            if rejection is not None:
+                await _send_rejection(send, rejection)
+                return
+            admitted = True
+        try:
+            await self._run_flask(scope, receive, send, admitted)
+        finally:
+            if admitted:
+                index.admission.leave()
+
+    async def _run_flask(self, scope, receive, send, admitted):
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        environ = _wsgi_environ(scope, b"".join(body))
+        environ["mff.admitted"] = admitted
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(
+            self.executor, _run_wsgi, self.flask_app, environ)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+    def stats(self):
+        return {
+            "upstream": self.client.stats() if self.client else None,
+            "image_fetches_in_flight": self.images.in_flight() if self.images else 0
+        }
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _send_json(send, status, body, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode())] + list(headers)})
+    await send({"type": "http.response.body", "body": body})
+    return status
+
+
+async def _send_rejection(send, rejection):
+    body = ('{"error":"%s"}' % rejection.error).encode()
+    return await _send_json(send, rejection.status, body,
+                            [(b"retry-after", rejection.retry_after_header.encode())])
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = "HTTP_" + name
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_wsgi(wsgi_app, environ):
+    """Call a WSGI app and collect its whole response"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                               for name, value in headers]
+
+    iterable = wsgi_app(environ, start_response)
+    try:
+        content = b"".join(iterable)
+    finally:
+        # Runs response.call_on_close callbacks such as prefetch scheduling
+        if hasattr(iterable, "close"):
+            iterable.close()
+    return response["status"], response["headers"], content
+
+
+app = GameASGI(index.app, index.image_cache, threads=ASGI_WORKER_THREADS)
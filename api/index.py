@@ -1,10 +1,36 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify, send_from_directory, send_file, make_response, g
 import requests
 import hashlib
+import hmac
+import glob
+import json
 import os
+import sys
+import tempfile
 import time
 from flask_cors import CORS
 import traceback
+
+# Sibling helper modules live next to this file (underscore-prefixed so
+# Vercel does not deploy them as functions of their own)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _session_store import SessionStore, record_to_bytes
+from _session_backends import CookieBackend, create_backend
+from _image_cache import ImageCache, ImageFetchError, KEY_PATTERN
+from _prefetch import Prefetcher
+from _story_pack import PackRegistry
+from _personalize import ChoicePersonalizer
+from _profile import SessionProfile, session_hash
+from _journey import Journey, JourneyError
+from _metrics import Metrics, SamplingProfiler
+from _share_card import CARD_KEY_PATTERN, CARDS_AVAILABLE, ShareCards
+from _static_assets import IMMUTABLE, REVALIDATE, StaticAssets, source_fingerprint
+from _outcome_index import OutcomeIndex
+from _outcomes import OutcomeError, OutcomeRecords, encode_choices, parse_code
+from _admission import AdmissionControl, client_address, create_buckets
+from _resilience import CircuitBreaker, RetryBudget, UpstreamPolicy
+from _fallback_art import FallbackArt
+from _wire import COMPRESSIBLE, ENCODINGS, FORMAT_TAGS, JSON, STATE_FORMATS, compress, encode_state
 # Import your story_nodes, other helpers (modified to remove pygame)
 # MAKE SURE Pillow is installed for manga generation later
 # from PIL import Image, ImageDraw # If doing manga server-side
@@ -13,378 +39,213 @@ app = Flask(__name__)
 CORS(app, origins=["*"], methods=["GET", "POST", "OPTIONS"], allow_headers=["Content-Type", "Authorization"])  # Enable CORS for all routes
 
 # --- Constants (Remove Pygame colors/fonts) ---
-POLLINATIONS_BASE_URL = "https://image.pollinations.ai/prompt/"
+# Overridable so the image proxy can be pointed at a local stub server
+POLLINATIONS_BASE_URL = os.environ.get("POLLINATIONS_BASE_URL", "https://image.pollinations.ai/prompt/")
 IMAGE_WIDTH = 1024
 IMAGE_HEIGHT = 1024
 IMAGE_MODEL = 'flux'
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 6 * 3600))
+SESSION_MAX_COUNT = int(os.environ.get("SESSION_MAX_COUNT", 50000))
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+# "memory", "cookie", "sqlite:///path/to/sessions.db" or "redis://host:6379/0"
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+# Signing keys for the "cookie" backend, "id:secret,...": the first signs,
+# all of them verify, so keys rotate by prepending a new one
+SESSION_COOKIE_KEYS = os.environ.get("SESSION_COOKIE_KEYS")
+SESSION_COOKIE_MAX_BYTES = int(os.environ.get("SESSION_COOKIE_MAX_BYTES", 3800))
+# Serve generated images through /api/image/<key> instead of linking upstream.
+# The keys are signed with IMAGE_KEY_SECRET, which every instance must share
+# to serve each other's keys (without it, a secret kept in IMAGE_CACHE_DIR
+# is used), so the proxy is on by default only when the secret is set
+IMAGE_KEY_SECRET = os.environ.get("IMAGE_KEY_SECRET")
+IMAGE_PROXY_ENABLED = os.environ.get("IMAGE_PROXY_ENABLED", "1" if IMAGE_KEY_SECRET else "0") == "1"
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR")  # defaults to a temp dir
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", 60))
+# Limits on upstream image fetches: the deadline covers every attempt of
+# one fetch, a second attempt is hedged in after IMAGE_HEDGE_DELAY seconds
+# (0 = never), and retries plus hedges may add at most IMAGE_RETRY_BUDGET
+# of the fetches made
+IMAGE_DEADLINE = float(os.environ.get("IMAGE_DEADLINE", 90))
+IMAGE_HEDGE_DELAY = float(os.environ.get("IMAGE_HEDGE_DELAY", 20))
+IMAGE_MAX_ATTEMPTS = int(os.environ.get("IMAGE_MAX_ATTEMPTS", 2))
+IMAGE_RETRY_BUDGET = float(os.environ.get("IMAGE_RETRY_BUDGET", 0.1))
+# After this many failed fetches in a row, stop asking for BREAKER_RESET_SECONDS
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", 30))
+# Per-node stand-in pictures served while the image service is failing
+FALLBACK_ART_ENABLED = os.environ.get("FALLBACK_ART_ENABLED", "1") == "1"
+# Composited share cards (need Pillow and the image proxy)
+SHARE_CARDS_ENABLED = os.environ.get("SHARE_CARDS_ENABLED", "1") == "1"
+SHARE_CARD_DIR = os.environ.get("SHARE_CARD_DIR")  # defaults to a temp dir
+# Longest a card request waits for its pictures before drawing empty frames
+SHARE_CARD_IMAGE_WAIT = float(os.environ.get("SHARE_CARD_IMAGE_WAIT", 10))
+# Short outcome codes for finished games, resolved by /api/outcomes/<code>.
+# The records behind them are never deleted, so OUTCOME_RECORD_DIR must be
+# durable storage every instance shares; the codes are off without it
+OUTCOME_RECORD_DIR = os.environ.get("OUTCOME_RECORD_DIR")
+OUTCOME_RECORDS_ENABLED = os.environ.get("OUTCOME_RECORDS_ENABLED", "1" if OUTCOME_RECORD_DIR else "0") == "1"
+# Background pre-warming of the next nodes' images (needs the image proxy)
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 8))
+PREFETCH_PER_SESSION = int(os.environ.get("PREFETCH_PER_SESSION", 4))
+PREFETCH_MAX_PENDING = int(os.environ.get("PREFETCH_MAX_PENDING", 256))
+# Node visit probabilities written by tools/story_paths.py --priorities
+PREFETCH_PRIORITIES = os.environ.get("PREFETCH_PRIORITIES")
 # ... other non-pygame constants ...
-# ... your story_nodes dictionary ...
-
-# --- Game Story Nodes ---
-story_nodes = {
-    "start": {
-        "situation": "You find yourself in a mysterious forest. The path ahead splits in two directions. What do you do?",
-        "prompt": "Fantasy forest with two paths, mysterious, ethereal light, detailed",
-        "seed": 12345,
-        "choices": [
-            {
-                "text": "Take the path that leads deeper into the forest",
-                "next_node": "deep_forest",
-                "score_modifier": 1,
-                "tag": "curious"
-            },
-            {
-                "text": "Take the path that seems to lead out of the forest",
-                "next_node": "forest_edge",
-                "score_modifier": 0,
-                "tag": "cautious"
-            }
-        ]
-    },
-    "deep_forest": {
-        "situation": "As you venture deeper into the forest, you encounter a small magical creature trapped under a fallen branch.",
-        "prompt": "Small magical glowing creature trapped under branch, fantasy forest, rays of light, detailed",
-        "seed": 54321,
-        "choices": [
-            {
-                "text": "Help free the creature",
-                "next_node": "grateful_creature",
-                "score_modifier": 2,
-                "tag": "kind"
-            },
-            {
-                "text": "Ignore the creature and continue exploring",
-                "next_node": "lost_forest",
-                "score_modifier": -1,
-                "tag": "selfish"
-            }
-        ]
-    },
-    "grateful_creature": {
-        "situation": "You free the creature, who thanks you and offers to lead you to a hidden treasure as a reward.",
-        "prompt": "Magical glowing creature leading adventurer through fantasy forest, magical trail, treasure map, detailed",
-        "seed": 67890,
-        "choices": [
-            {
-                "text": "Follow the creature to the treasure",
-                "next_node": "hidden_treasure",
-                "score_modifier": 1,
-                "tag": "adventurous"
-            },
-            {
-                "text": "Thank the creature but say you need to find your way out",
-                "next_node": "creature_guidance",
-                "score_modifier": 0,
-                "tag": "practical"
-            }
-        ]
-    },
-    "hidden_treasure": {
-        "situation": "The creature leads you to an ancient chest hidden beneath tree roots. Inside you find a magical amulet that glows with power.",
-        "prompt": "Ancient treasure chest with magical glowing amulet, tree roots, fantasy forest, detailed",
-        "seed": 13579,
-        "choices": [
-            {
-                "text": "Take the amulet and wear it",
-                "next_node": "amulet_power",
-                "score_modifier": 2,
-                "tag": "risk-taker"
-            },
-            {
-                "text": "Leave the amulet, treasures in enchanted forests often have curses",
-                "next_node": "wise_decision",
-                "score_modifier": 1,
-                "tag": "wise"
-            }
-        ]
-    },
-    "amulet_power": {
-        "situation": "As you put on the amulet, you feel a surge of magical energy. Your senses heighten, and you can now see magical paths in the forest that were invisible before.",
-        "prompt": "Character wearing glowing magical amulet, visible magical paths, enchanted forest, magical energy, detailed",
-        "seed": 24680,
-        "choices": [
-            {
-                "text": "Follow the brightest magical path",
-                "next_node": "_calculate_end",
-                "score_modifier": 1,
-                "tag": "bold"
-            },
-            {
-                "text": "Use your new power to find the safest way out",
-                "next_node": "_calculate_end",
-                "score_modifier": 0,
-                "tag": "careful"
-            }
-        ]
-    },
-    "forest_edge": {
-        "situation": "You reach the edge of the forest and see a small village in the distance. There's also a strange cave entrance nearby.",
-        "prompt": "Edge of fantasy forest, distant village, mysterious cave entrance, sunset, detailed",
-        "seed": 97531,
-        "choices": [
-            {
-                "text": "Head toward the village",
-                "next_node": "village_arrival",
-                "score_modifier": 0,
-                "tag": "social"
-            },
-            {
-                "text": "Explore the mysterious cave",
-                "next_node": "cave_entrance",
-                "score_modifier": 1,
-                "tag": "adventurous"
-            }
-        ]
-    },
-    "generic_good_ending": {
-        "is_end": True,
-        "ending_category": "Heroic Journey",
-        "situation": "Your choices have led you to become a hero of the forest. The magical creatures celebrate your deeds, and you've discovered powers within yourself you never knew existed. You return home with incredible stories and the knowledge that you've made a positive difference in this magical realm.",
-        "prompt": "Hero celebrated by magical forest creatures, magical aura, fantasy celebration, triumphant pose, detailed",
-        "seed": 11111,
-        "choices": []
-    },
-    "generic_neutral_ending": {
-        "is_end": True,
-        "ending_category": "Forest Explorer",
-        "situation": "You've had an interesting adventure in the magical forest. While you didn't become a legendary hero, you've seen wonders few others have witnessed. You make your way back home, forever changed by your experiences in the enchanted woods.",
-        "prompt": "Character exiting magical forest, looking back with wonder, mixed emotions, sunset, detailed",
-        "seed": 22222,
-        "choices": []
-    },
-    "generic_bad_ending": {
-        "is_end": True,
-        "ending_category": "Lost Wanderer",
-        "situation": "Your choices have led you astray. You find yourself hopelessly lost in the darkening forest. The magical creatures no longer help you, and strange shadows follow your every move. You fear you may never find your way home again.",
-        "prompt": "Lost traveler in dark fantasy forest, ominous shadows, fear, getting dark, detailed",
-        "seed": 33333,
-        "choices": []
-    },
-    "lost_forest": {
-        "situation": "As you continue deeper into the forest, ignoring the trapped creature, you start to realize you're getting lost. The trees seem to close in around you.",
-        "prompt": "Lost in dense fantasy forest, closing in trees, disorienting paths, foreboding atmosphere, detailed",
-        "seed": 44444,
-        "choices": [
-            {
-                "text": "Try to retrace your steps",
-                "next_node": "lost_deeper",
-                "score_modifier": -1,
-                "tag": "practical"
-            },
-            {
-                "text": "Climb a tree to get a better view",
-                "next_node": "tree_climb",
-                "score_modifier": 1,
-                "tag": "resourceful"
-            }
-        ]
-    },
-    "lost_deeper": {
-        "situation": "Attempting to retrace your steps only leads you deeper into the forest. Night is falling, and strange noises surround you.",
-        "prompt": "Dark fantasy forest at night, eerie glowing eyes, lost traveler, fear, detailed",
-        "seed": 55555,
-        "choices": [
-            {
-                "text": "Make camp and wait for daylight",
-                "next_node": "_calculate_end",
-                "score_modifier": -1,
-                "tag": "patient"
-            },
-            {
-                "text": "Keep moving despite the darkness",
-                "next_node": "_calculate_end",
-                "score_modifier": -2,
-                "tag": "stubborn"
-            }
-        ]
-    },
-    "tree_climb": {
-        "situation": "From atop a tall tree, you spot a clearing with a strange stone circle that seems to glow with magic. You also see the forest edge in the far distance.",
-        "prompt": "View from tall tree, fantasy forest, glowing stone circle in clearing, forest edge in distance, detailed",
-        "seed": 66666,
-        "choices": [
-            {
-                "text": "Head toward the mysterious stone circle",
-                "next_node": "stone_circle",
-                "score_modifier": 1,
-                "tag": "curious"
-            },
-            {
-                "text": "Make your way toward the forest edge",
-                "next_node": "forest_edge",
-                "score_modifier": 0,
-                "tag": "cautious"
-            }
-        ]
-    },
-    "creature_guidance": {
-        "situation": "The magical creature nods understandingly and offers to guide you to the forest edge instead. It leads you along a hidden path that seems to shimmer with gentle magic.",
-        "prompt": "Magical creature guiding traveler along shimmering path, forest edge visible, fantasy forest, detailed",
-        "seed": 77777,
-        "choices": [
-            {
-                "text": "Thank the creature again before parting ways",
-                "next_node": "forest_edge",
-                "score_modifier": 1,
-                "tag": "grateful"
-            },
-            {
-                "text": "Ask the creature if it would like to accompany you further",
-                "next_node": "_calculate_end",
-                "score_modifier": 2,
-                "tag": "friendly"
-            }
-        ]
-    },
-    "stone_circle": {
-        "situation": "You find an ancient stone circle with strange symbols. The air feels charged with magic, and the stones seem to pulse with an inner light.",
-        "prompt": "Ancient stone circle with glowing symbols, magical aura, fantasy forest clearing, detailed",
-        "seed": 88888,
-        "choices": [
-            {
-                "text": "Touch the central stone and speak a word of power",
-                "next_node": "_calculate_end",
-                "score_modifier": 1,
-                "tag": "magical"
-            },
-            {
-                "text": "Study the symbols to try to understand their meaning",
-                "next_node": "_calculate_end",
-                "score_modifier": 1,
-                "tag": "scholarly"
-            }
-        ]
-    },
-    "wise_decision": {
-        "situation": "You decide to leave the amulet behind. As you walk away, you hear a faint hissing sound and turn to see the amulet dissolving into a puddle of poisonous liquid. Your caution has saved you.",
-        "prompt": "Fantasy amulet dissolving into poisonous liquid, cautious adventurer backing away, magical chest, detailed",
-        "seed": 99999,
-        "choices": [
-            {
-                "text": "Continue exploring the forest with heightened caution",
-                "next_node": "_calculate_end",
-                "score_modifier": 1,
-                "tag": "vigilant"
-            },
-            {
-                "text": "Ask the creature to guide you back to safer territory",
-                "next_node": "creature_guidance",
-                "score_modifier": 0,
-                "tag": "practical"
-            }
-        ]
-    },
-    "village_arrival": {
-        "situation": "You arrive at the village to find it's inhabited by friendly forest folk who welcome you warmly. They offer food and shelter, curious about your forest adventures.",
-        "prompt": "Fantasy village with forest folk welcoming traveler, cozy cottages, warm lighting, detailed",
-        "seed": 12121,
-        "choices": [
-            {
-                "text": "Share your adventures and ask about the forest's secrets",
-                "next_node": "_calculate_end",
-                "score_modifier": 1,
-                "tag": "social"
-            },
-            {
-                "text": "Thank them but explain you need to continue your journey",
-                "next_node": "_calculate_end",
-                "score_modifier": 0,
-                "tag": "independent"
-            }
-        ]
-    },
-    "cave_entrance": {
-        "situation": "The cave entrance reveals a passage lined with glowing crystals that illuminate the darkness with a soft blue light.",
-        "prompt": "Cave entrance with glowing blue crystals, mysterious passage, fantasy setting, detailed",
-        "seed": 23232,
-        "choices": [
-            {
-                "text": "Venture deeper into the crystal cave",
-                "next_node": "_calculate_end",
-                "score_modifier": 2,
-                "tag": "brave"
-            },
-            {
-                "text": "Take just one small crystal and head back to the forest edge",
-                "next_node": "_calculate_end",
-                "score_modifier": -1,
-                "tag": "greedy"
-            }
-        ]
-    },
-    "heroic_savior_ending": {
-        "is_end": True,
-        "ending_category": "Heroic Savior",
-        "situation": "Your kindness and courage have made you a legendary hero of the forest. The magical creatures see you as their champion and protector. You've discovered ancient powers within yourself that allow you to communicate with the forest and its inhabitants. Your name will be sung in the folklore of this realm for generations to come.",
-        "prompt": "Epic fantasy hero, magical forest defender, ancient powers, magical creatures celebrating, detailed fantasy illustration",
-        "seed": 11112,
-        "choices": []
-    },
-    "wise_mage_ending": {
-        "is_end": True,
-        "ending_category": "Wise Mage",
-        "situation": "Your wisdom and magical affinity have transformed you into a powerful mage. The forest has accepted you as one of its guardians, and you've established a small tower where you study the ancient magics that flow through this realm. Many travelers seek your guidance, and you've become a respected figure throughout the lands.",
-        "prompt": "Wise mage in forest tower, magical tomes, arcane study, glowing runes, fantasy illustration, detailed",
-        "seed": 11113,
-        "choices": []
-    },
-    "forest_guardian_ending": {
-        "is_end": True,
-        "ending_category": "Forest Guardian",
-        "situation": "The magic of the forest has chosen you as its guardian. You've bonded with the ancient spirits of the woods, gaining the ability to shape and protect this magical realm. Your body now carries marks of the forest—perhaps leaves for hair or bark-like skin—as you've become part-human, part-forest entity, respected and sometimes feared by those who enter your domain.",
-        "prompt": "Human-forest hybrid guardian, bark skin, leaf hair, forest spirits, magical forest throne, fantasy character, detailed illustration",
-        "seed": 11114,
-        "choices": []
-    },
-    "peaceful_traveler_ending": {
-        "is_end": True,
-        "ending_category": "Peaceful Traveler",
-        "situation": "You've explored the wonders of the magical forest and learned much from your journey. Though you didn't become a legendary hero, you carry the forest's wisdom with you. You now travel between villages, sharing tales of the enchanted woods and occasionally using small magics you learned there to help those in need.",
-        "prompt": "Wandering storyteller, magical trinkets, village gathering, fantasy traveler, sunset, detailed illustration",
-        "seed": 22223,
-        "choices": []
-    },
-    "forest_explorer_ending": {
-        "is_end": True, 
-        "ending_category": "Forest Explorer",
-        "situation": "Your exploration of the magical forest has made you a renowned expert in magical flora and fauna. You've documented countless species unknown to the outside world, creating detailed journals that scholars pay handsomely to study. You now lead occasional expeditions into the forest, guiding those brave enough to witness its wonders.",
-        "prompt": "Fantasy naturalist, magical creature sketches, expedition camp, journals, forest background, detailed illustration",
-        "seed": 22224,
-        "choices": []
-    },
-    "merchant_ending": {
-        "is_end": True,
-        "ending_category": "Forest Merchant",
-        "situation": "Your adventures in the magical forest have given you access to rare herbs, magical trinkets, and exotic materials. You've established a small but profitable trading post at the forest's edge, becoming the go-to merchant for magical components. Wizards and alchemists from far and wide seek your uniquely sourced goods.",
-        "prompt": "Fantasy merchant shop, magical herbs and potions, trading post, forest edge, customer wizards, detailed illustration",
-        "seed": 22225,
-        "choices": []
-    },
-    "lost_soul_ending": {
-        "is_end": True,
-        "ending_category": "Lost Soul",
-        "situation": "The forest's magic has clouded your mind and you've lost your way—both literally and figuratively. You wander the ever-shifting paths, no longer remembering who you were before entering these woods. The forest creatures watch you with pity, but none approach, for you have become a cautionary tale told to those who might enter the forest unprepared.",
-        "prompt": "Lost wanderer in dark forest, tattered clothes, confused expression, glowing eyes watching from darkness, fantasy horror, detailed illustration",
-        "seed": 33334,
-        "choices": []
-    },
-    "cursed_wanderer_ending": {
-        "is_end": True,
-        "ending_category": "Cursed Wanderer",
-        "situation": "Your selfish actions in the forest have drawn the ire of ancient spirits. A curse now follows you—perhaps your shadow moves independently, or your reflection shows a twisted version of yourself. You search endlessly for a cure, but the curse seems to strengthen the further you get from the forest that birthed it.",
-        "prompt": "Cursed traveler, unnatural shadow, twisted reflection in water, dark fantasy, horror elements, detailed illustration",
-        "seed": 33335,
-        "choices": []
-    },
-    "forest_prisoner_ending": {
-        "is_end": True,
-        "ending_category": "Forest Prisoner",
-        "situation": "The forest has claimed you as its prisoner. The paths continuously lead you back to the center, no matter which direction you travel. You've built a small shelter and learned to survive, but freedom eludes you. Sometimes you see other travelers through the trees, but when you call out, they cannot seem to hear you—as if you exist in a separate layer of reality.",
-        "prompt": "Prisoner of magical forest, small shelter, paths that loop back, barrier of light, travelers passing by unaware, fantasy horror, detailed illustration",
-        "seed": 33336,
-        "choices": []
-    }
-}
+# Story content (nodes, ending variants, style word lists) lives in pack
+# files; see packs/mystic_forest.json and api/_story_pack.py
+STORY_PACK_DIR = os.environ.get(
+    "STORY_PACK_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "packs"))
+STORY_PACK_CACHE_DIR = os.environ.get(
+    "STORY_PACK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mystic-forest-packs"))
+DEFAULT_STORY_PACK = os.environ.get("DEFAULT_STORY_PACK", "mystic_forest")
+# Most choices /api/choices applies in one request
+MAX_BATCH_CHOICES = int(os.environ.get("MAX_BATCH_CHOICES", 64))
+# gzip/brotli for JSON and MessagePack API responses at least this big
+API_COMPRESSION = os.environ.get("API_COMPRESSION", "1") == "1"
+API_COMPRESSION_MIN_BYTES = int(os.environ.get("API_COMPRESSION_MIN_BYTES", 512))
+# Files the page loads, served under content-hashed names with immutable
+# cache headers (index.html is rewritten to point at them)
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public")
+FINGERPRINTED_ASSETS = ("script.js", "style.css", "ethers-offline.js")
+
+# Latency histograms and counters on /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# Bearer token required on /metrics when set, and by the profiler toggle
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.005))
+
+# Local index of the outcomes saved to the ForestAdventure contract, behind
+# /api/leaderboard and /api/stories/<id>; off unless an RPC URL is set
+OUTCOME_RPC_URL = os.environ.get("OUTCOME_RPC_URL")
+OUTCOME_CONTRACT = os.environ.get("OUTCOME_CONTRACT", "0xafa6C385c1B6D26Fda55f1a576828B75E9F9FD6c")
+OUTCOME_INDEX_DB = os.environ.get(
+    "OUTCOME_INDEX_DB", os.path.join(tempfile.gettempdir(), "mystic-forest-outcomes.db"))
+OUTCOME_START_BLOCK = int(os.environ.get("OUTCOME_START_BLOCK", 0))
+OUTCOME_BLOCK_RANGE = int(os.environ.get("OUTCOME_BLOCK_RANGE", 2000))
+OUTCOME_CONFIRMATIONS = int(os.environ.get("OUTCOME_CONFIRMATIONS", 2))
+# Seconds between syncs; 0 leaves syncing to tools/outcome_indexer.py
+OUTCOME_POLL_SECONDS = float(os.environ.get("OUTCOME_POLL_SECONDS", 15))
+LEADERBOARD_MAX_PER_PAGE = 100
+# Token buckets (requests per second and burst) per client address, per
+# session, and per client address for requests that create a session (a
+# player who already has one can restart games freely); a rate of 0 turns
+# that limit off. RATE_LIMIT_BACKEND shares the buckets between workers
+# (sqlite:///path.db or redis://host:port/db)
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_CLIENT_RATE = float(os.environ.get("RATE_LIMIT_CLIENT_RATE", 20))
+RATE_LIMIT_CLIENT_BURST = int(os.environ.get("RATE_LIMIT_CLIENT_BURST", 100))
+RATE_LIMIT_SESSION_RATE = float(os.environ.get("RATE_LIMIT_SESSION_RATE", 5))
+RATE_LIMIT_SESSION_BURST = int(os.environ.get("RATE_LIMIT_SESSION_BURST", 30))
+RATE_LIMIT_NEW_SESSION_RATE = float(os.environ.get("RATE_LIMIT_NEW_SESSION_RATE", 1))
+RATE_LIMIT_NEW_SESSION_BURST = int(os.environ.get("RATE_LIMIT_NEW_SESSION_BURST", 60))
+# Proxies in front of the API whose X-Forwarded-For entry can be trusted.
+# Behind a reverse proxy or load balancer this has to be set (usually 1),
+# or every player is limited as that proxy's one address; Vercel's edge
+# sets the header itself, so there it defaults to 1
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get("RATE_LIMIT_PROXY_HOPS", 1 if os.environ.get("VERCEL") else 0))
+# API requests handled at once before the rest are shed with a 503 (0 = no cap)
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", 256))
+
+# --- Metrics ---
+# Registered before the other request hooks so the timer covers them all
+# (Flask runs after_request functions in reverse order)
+metrics = Metrics(enabled=METRICS_ENABLED)
+profiler = SamplingProfiler(metrics.active, interval=PROFILER_INTERVAL)
+
+@app.before_request
+def start_request_timer():
+    metrics.begin(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.after_request
+def stop_request_timer(response):
+    metrics.end(request.method, response.status_code)
+    return response
+
+# --- Admission Control ---
+# Runs before the session hooks, so a refused request costs no session work
+admission = None
+if RATE_LIMIT_ENABLED:
+    admission = AdmissionControl({
+        name: create_buckets(RATE_LIMIT_BACKEND, rate, burst, name)
+        for name, rate, burst in (
+            ("client", RATE_LIMIT_CLIENT_RATE, RATE_LIMIT_CLIENT_BURST),
+            ("session", RATE_LIMIT_SESSION_RATE, RATE_LIMIT_SESSION_BURST),
+            ("new_session", RATE_LIMIT_NEW_SESSION_RATE, RATE_LIMIT_NEW_SESSION_BURST))
+        if rate > 0
+    }, max_in_flight=MAX_IN_FLIGHT_REQUESTS)
+
+_proxy_warning_shown = False
+
+def request_client():
+    """The address the client limits are keyed by"""
+    global _proxy_warning_shown
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and not RATE_LIMIT_PROXY_HOPS and not _proxy_warning_shown:
+        _proxy_warning_shown = True
+        print("Requests arrive through a proxy but RATE_LIMIT_PROXY_HOPS is 0, "
+              "so rate limits treat all of its clients as one")
+    return client_address(request.remote_addr, forwarded_for, RATE_LIMIT_PROXY_HOPS)
+
+def rejection_response(rejection):
+    response = jsonify({"error": rejection.error})
+    response.status_code = rejection.status
+    response.headers["Retry-After"] = rejection.retry_after_header
+    return response
+
+@app.before_request
+def admit_request():
+    if admission is None or not request.path.startswith("/api/") or request.method == "OPTIONS":
+        return None
+    # The ASGI entry claims the slot before queueing the request for a thread
+    if not request.environ.get("mff.admitted"):
+        rejection = admission.enter()
+        if rejection is not None:
+            return rejection_response(rejection)
+        g.admission_slot = True
+    
+    # Image URLs are shared between players, so only the client limit applies
+    session_id = None if request.path.startswith("/api/image/") else request.cookies.get("session_id")
+    rejection = admission.check(request_client(), session_id)
+    if rejection is not None:
+        return rejection_response(rejection)
+    return None
+
+def admit_new_session():
+    """A 429 response if this client has created too many sessions lately, else None
+
+    Called only where a session is about to be created, so restarting the
+    game in an existing session never spends these tokens.
+    """
+    if admission is None:
+        return None
+    rejection = admission.check_new_session(request_client())
+    return rejection_response(rejection) if rejection is not None else None
+
+@app.teardown_request
+def release_admission(error=None):
+    if g.pop("admission_slot", False):
+        admission.leave()
+
+# --- Game Story Packs ---
+story_packs = PackRegistry(STORY_PACK_DIR, cache_dir=STORY_PACK_CACHE_DIR)
+if story_packs.current(DEFAULT_STORY_PACK) is None:
+    raise RuntimeError(f"Story pack {DEFAULT_STORY_PACK!r} not found in {STORY_PACK_DIR}")
+
+@app.before_request
+def reload_story_packs():
+    # Picks up edited pack files; sessions stay on the version they started
+    story_packs.maybe_reload()
+
+def get_story_pack(journey=None):
+    """The pack a game is pinned to, or the default pack for a new game"""
+    if journey is not None:
+        pack = story_packs.get(journey.pack_id or DEFAULT_STORY_PACK, journey.pack_version)
+        if pack is not None:
+            return pack
+    return story_packs.current(DEFAULT_STORY_PACK)
 
 # --- Game State (In-memory - BAD for multiple users/production) ---
 game_state = {
@@ -396,34 +257,239 @@ game_state = {
     "last_reset": time.time()  # Track when the game was last reset
 }
 
-# Add a user_sessions dictionary to track individual user sessions
-user_sessions = {}
+# Per-player sessions. The backend decides where they live; the store batches
+# each request's writes into one backend call that is flushed before the
+# response is sent.
+session_store = SessionStore(create_backend(SESSION_BACKEND,
+                                            ttl=SESSION_TTL_SECONDS,
+                                            max_sessions=SESSION_MAX_COUNT,
+                                            max_bytes=SESSION_MAX_BYTES,
+                                            cookie_keys=SESSION_COOKIE_KEYS,
+                                            cookie_max_bytes=SESSION_COOKIE_MAX_BYTES),
+                             observe=metrics.observe_stage)
+# With the cookie backend the state comes in and goes out with the request
+cookie_sessions = session_store.backend if isinstance(session_store.backend, CookieBackend) else None
+
+@app.before_request
+def read_session_cookies():
+    if cookie_sessions is not None:
+        cookie_sessions.begin(request.cookies)
+
+@app.after_request
+def flush_sessions(response):
+    try:
+        session_store.flush()
+    except Exception as e:
+        print(f"Error saving sessions: {str(e)}")
+        traceback.print_exc()
+        return make_response(jsonify({"error": "Could not save game state"}), 503)
+    if cookie_sessions is not None:
+        state_cookie = cookie_sessions.take_outgoing()
+        if state_cookie:
+            response.set_cookie(cookie_sessions.cookie_name, state_cookie, max_age=SESSION_TTL_SECONDS,
+                                httponly=True, samesite="Lax", secure=request.is_secure)
+        elif state_cookie == "":
+            response.delete_cookie(cookie_sessions.cookie_name)
+    return response
+
+@app.teardown_request
+def end_session_request(error=None):
+    session_store.end_request()
+
+def add_vary(response, header):
+    """response.vary.add without parsing the header into a set and back"""
+    vary = response.headers.get("Vary")
+    if not vary:
+        response.headers["Vary"] = header
+    elif header.lower() not in vary.lower():
+        response.headers["Vary"] = f"{vary}, {header}"
+
+# Runs before flush_sessions, so a 503 from a failed flush goes out as is
+@app.after_request
+def compress_api_response(response):
+    if (not API_COMPRESSION or not request.path.startswith("/api/")
+            or response.direct_passthrough or response.mimetype not in COMPRESSIBLE
+            or response.status_code in (204, 304) or "Content-Encoding" in response.headers):
+        return response
+    add_vary(response, "Accept-Encoding")
+    if "Accept-Encoding" not in request.headers:
+        return response
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < API_COMPRESSION_MIN_BYTES:
+        return response
+    with metrics.stage("compress"):
+        response.set_data(compress(body, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # Each encoding is its own representation (see etag_matches)
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+# Disk cache behind the /api/image proxy, fetching under the upstream policy
+upstream_policy = UpstreamPolicy(
+    deadline=IMAGE_DEADLINE, attempt_timeout=IMAGE_FETCH_TIMEOUT, hedge_delay=IMAGE_HEDGE_DELAY,
+    max_attempts=IMAGE_MAX_ATTEMPTS,
+    breaker=CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS),
+    budget=RetryBudget(ratio=IMAGE_RETRY_BUDGET))
+# (upstream_image_url is defined with the helpers below)
+image_cache = ImageCache(lambda prompt, seed: upstream_image_url(prompt, seed), IMAGE_CACHE_DIR,
+                         max_bytes=IMAGE_CACHE_MAX_BYTES, timeout=IMAGE_FETCH_TIMEOUT,
+                         policy=upstream_policy, secret=IMAGE_KEY_SECRET) if IMAGE_PROXY_ENABLED else None
+if image_cache is not None and not IMAGE_KEY_SECRET:
+    print("IMAGE_KEY_SECRET is not set: image keys only resolve on workers sharing IMAGE_CACHE_DIR")
+fallback_art = FallbackArt(story_packs) if image_cache is not None and FALLBACK_ART_ENABLED else None
+
+share_cards = None
+if image_cache is not None and SHARE_CARDS_ENABLED and CARDS_AVAILABLE:
+    share_cards = ShareCards(SHARE_CARD_DIR, image_cache, image_wait=SHARE_CARD_IMAGE_WAIT)
+
+outcome_records = None
+if OUTCOME_RECORDS_ENABLED:
+    if OUTCOME_RECORD_DIR:
+        outcome_records = OutcomeRecords(OUTCOME_RECORD_DIR)
+    else:
+        print("OUTCOME_RECORDS_ENABLED needs OUTCOME_RECORD_DIR; outcome codes are off")
+
+prefetcher = None
+if image_cache is not None and PREFETCH_ENABLED:
+    prefetcher = Prefetcher(image_cache.get, max_workers=PREFETCH_WORKERS,
+                            per_session=PREFETCH_PER_SESSION,
+                            max_pending=PREFETCH_MAX_PENDING)
+
+# pack id -> node id -> probability a game visits the node; the likeliest
+# next nodes are prefetched first
+prefetch_priorities = {}
+if PREFETCH_PRIORITIES:
+    try:
+        with open(PREFETCH_PRIORITIES) as f:
+            prefetch_priorities = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading prefetch priorities: {str(e)}")
+
+# Rendered choice texts per (session, node)
+personalizer = ChoicePersonalizer()
+
+outcome_index = None
+if OUTCOME_RPC_URL:
+    outcome_index = OutcomeIndex(OUTCOME_INDEX_DB, OUTCOME_RPC_URL, OUTCOME_CONTRACT,
+                                 start_block=OUTCOME_START_BLOCK, block_range=OUTCOME_BLOCK_RANGE,
+                                 confirmations=OUTCOME_CONFIRMATIONS,
+                                 poll_interval=OUTCOME_POLL_SECONDS)
+    if OUTCOME_POLL_SECONDS > 0:
+        outcome_index.start()
+
+# Counters the components keep themselves, read when /metrics is scraped
+metrics.add_source("sessions", session_store.stats, counters=(
+    "hits", "misses", "created", "expired_evictions", "lru_evictions", "rejected",
+    "oversized", "store_reads", "store_writes", "store_write_errors"))
+metrics.add_source("story_packs", story_packs.stats, counters=("reloads", "reload_errors"))
+metrics.add_source("choice_texts", personalizer.stats, counters=("hits", "misses"))
+if admission is not None:
+    metrics.add_source("admission", admission.stats, counters=("admitted", "shed", "limited", "store_errors"))
+if image_cache is not None:
+    metrics.add_source("image_cache", image_cache.stats, counters=(
+        "hits", "misses", "coalesced", "upstream_fetches", "upstream_errors", "evictions"))
+    metrics.add_source("upstream", upstream_policy.stats, counters=(
+        "opens", "rejected", "calls", "failures", "retries", "hedges", "hedge_wins",
+        "deadlines_exceeded", "budget_spent", "budget_denied"))
+if fallback_art is not None:
+    metrics.add_source("fallback_art", fallback_art.stats, counters=("rendered", "served"))
+if share_cards is not None:
+    metrics.add_source("share_cards", share_cards.stats, counters=("registered", "rendered", "incomplete", "hits"))
+if outcome_records is not None:
+    metrics.add_source("outcome_records", outcome_records.stats,
+                       counters=("registered", "resolved", "misses"))
+if outcome_index is not None:
+    metrics.add_source("outcome_index", outcome_index.stats, counters=(
+        "events", "ranges", "rpc_calls", "rpc_errors"))
+# The ASGI entry swaps the prefetcher at startup, so look it up on each scrape
+metrics.add_source("prefetch", lambda: prefetcher.stats() if prefetcher is not None else {},
+                   counters=("scheduled", "completed", "failed", "cancelled", "dropped"))
+
+# Text files in public/, hashed and compressed once at startup
+static_assets = StaticAssets(PUBLIC_DIR, fingerprint=FINGERPRINTED_ASSETS)
+
+# /api/state ETags cover the code that renders the state and, with the image
+# proxy, the secret its image keys are signed with
+STATE_ETAG_SALT = source_fingerprint(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py")))
+if image_cache is not None:
+    STATE_ETAG_SALT += image_cache.key_id
 
 # --- Helper Functions (Refactored - NO PYGAME) ---
-def get_dynamic_seed(base_seed, path_node_ids, session_id=None):
-    """Generate a unique seed based on the path taken and session ID"""
+def get_dynamic_seed(base_seed, path_node_ids, session_id=None, reroll=0):
+    """Generate a unique seed based on the path taken and session ID
+
+    The seed is stable for a given node, path and session so identical game
+    states map to identical image URLs; `reroll` > 0 picks a different one.
+    """
     if not session_id:
         # Use existing path-based seed if no session ID
         path_hash = hashlib.md5(''.join(path_node_ids).encode()).hexdigest()
-        seed = (base_seed + int(path_hash, 16)) % 999999
+        seed = (base_seed + int(path_hash, 16) + reroll) % 999999
     else:
         # Create a unique seed combining base seed, path, and session ID
         combined = f"{base_seed}-{''.join(path_node_ids)}-{session_id}"
+        if reroll:
+            combined += f"-{reroll}"
         seed_hash = hashlib.md5(combined.encode()).hexdigest()
         seed = int(seed_hash, 16) % 999999
     
     return seed
 
-def enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id=None):
+def upstream_image_url(prompt, seed):
+    """Pollinations URL for a prompt, pinned to a seed so it can be cached"""
+    encoded_prompt = requests.utils.quote(prompt)
+    return (f"{POLLINATIONS_BASE_URL}{encoded_prompt}"
+            f"?seed={seed}&width={IMAGE_WIDTH}&height={IMAGE_HEIGHT}&model={IMAGE_MODEL}")
+
+def build_image_url(prompt, seed, fallback=None):
+    """URL the browser should load for a prompt's image
+
+    With the image proxy enabled this is a same-origin /api/image/<key> URL,
+    otherwise the Pollinations URL itself. `fallback` is the (pack id, node
+    id) whose stand-in picture to serve if the image can't be fetched.
+    """
+    if image_cache is None:
+        return upstream_image_url(prompt, seed)
+    return f"/api/image/{image_cache.register(prompt, seed, fallback)}"
+
+def node_image_prompts(node_details, path_node_ids, sentiment_tally, last_choice,
+                       session_id=None, reroll=0, pack=None):
+    """Seed and prompts for every image shown at a node
+
+    Returns (seed, {response field: prompt}); end nodes also get the manga
+    and summary images.
+    """
+    dynamic_seed = get_dynamic_seed(node_details.seed, path_node_ids, session_id, reroll)
+    
+    path_tuples = [(node, sentiment_tally.get(node, 0)) for node in path_node_ids]
+    enhanced_prompt = enhance_prompt(node_details.prompt, path_tuples, sentiment_tally, last_choice,
+                                     session_id, pack)
+    
+    prompts = {"image_url": enhanced_prompt}
+    if node_details.is_end:
+        prompts["manga_image_url"] = f"Manga style, story summary of {enhanced_prompt}"
+        prompts["summary_image_url"] = f"Fantasy book cover, hero's journey, {enhanced_prompt}"
+    return dynamic_seed, prompts
+
+def enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id=None, pack=None):
     """Enhance the base prompt with unique elements based on the user's journey"""
+    styles = (pack or get_story_pack()).styles
+    
     # Get the user's style preferences (if stored in their session)
     style_elements = []
-    if session_id and session_id in user_sessions and 'style_preferences' in user_sessions[session_id]:
-        style_elements = user_sessions[session_id]['style_preferences']
+    profile = get_session_profile(session_id) if session_id else None
+    if profile and profile.style_preferences:
+        # Copy so the session's own preferences don't grow with every call
+        style_elements = list(profile.style_preferences)
     
     # Default style elements if none are set
     if not style_elements:
-        style_elements = ["detailed", "fantasy", "ethereal"]
+        style_elements = list(styles.get("default_styles", ()))
     
     # Add sentiment-based modifiers
     if sentiment_tally.get('kind', 0) > sentiment_tally.get('selfish', 0):
@@ -437,95 +503,346 @@ def enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, sessi
     if sentiment_tally.get('cautious', 0) > 1:
         style_elements.append("muted colors")
     
-    # Add a unique element based on session ID if available
-    if session_id:
-        # Use the session ID to deterministically select unique style elements
-        session_hash = int(hashlib.md5(session_id.encode()).hexdigest(), 16)
-        
-        # List of potential style modifiers to make images unique
-        unique_styles = [
-            "cinematic lighting", "golden hour", "blue hour", "mist", 
-            "ray tracing", "dramatic shadows", "soft focus", "high contrast",
-            "low saturation", "high saturation", "dreamlike", "surreal",
-            "watercolor style", "oil painting style", "concept art", "digital art"
-        ]
-        
-        # Select 1-3 unique styles based on session ID
-        num_styles = 1 + (session_hash % 3)  # 1 to 3 styles
-        for i in range(num_styles):
-            style_index = (session_hash + i) % len(unique_styles)
-            style_elements.append(unique_styles[style_index])
-    
-    # Combine everything into an enhanced prompt
-    enhanced = f"{base_prompt}, {', '.join(style_elements)}"
+    # Add the 1-3 unique elements picked for this session, if available
+    if profile:
+        style_elements.extend(profile.unique_styles_for(pack or get_story_pack()))
     
-    # Make each image different even for the same node by adding timestamp
-    timestamp = int(time.time())
-    enhanced += f", seed:{timestamp}"
+    # Combine everything into an enhanced prompt. Variation between images
+    # comes from the seed passed to build_image_url, so the prompt itself is
+    # deterministic for a given game state.
+    enhanced = f"{base_prompt}, {', '.join(style_elements)}"
     
     return enhanced
 
-def reset_game_state(session_id=None):
-    """Reset the game state"""
-    initial_state = {
-        "current_node_id": "start",
-        "path_history": ["start"],
-        "score": 0,
-        "sentiment_tally": {},
-        "choice_history": [],
-        "created_at": time.time()
-    }
+def reset_game_state(session_id=None, pack=None):
+    """Reset the game state, pinning it to the current version of a pack"""
+    pack = pack or get_story_pack()
+    initial_state = Journey(pack.id, pack.version, pack.graph.start.index)
     
-    # If we have a session ID, store the state in the user_sessions dictionary
+    # If we have a session ID, store the state in the session store
     if session_id:
-        if session_id not in user_sessions:
-            user_sessions[session_id] = {}
+        record = session_store.get_or_create(session_id)
         
         # Generate some random style preferences for this session
         import random
-        all_style_options = [
-            "fantasy", "medieval", "ethereal", "mystical", "dramatic", 
-            "whimsical", "dark", "bright", "colorful", "muted"
-        ]
-        user_sessions[session_id]['style_preferences'] = random.sample(all_style_options, 3)
-        user_sessions[session_id]['state'] = initial_state
-        return user_sessions[session_id]['state']
+        profile = record.profile
+        all_style_options = pack.styles.get("session_styles", ())
+        profile.style_preferences = random.sample(all_style_options, min(3, len(all_style_options)))
+        ensure_personality_traits(profile, pack)
+        profile.unique_styles_for(pack)
+        record.state = initial_state
+        session_store.save(session_id, record)
+        return record.state
     
     return initial_state
 
-def get_node_details(node_id):
-    """Get details for a story node with personalized content"""
+def ensure_personality_traits(profile, pack):
+    """Give a session its random personality traits the first time round"""
+    if not profile.personality_traits:
+        import random
+        traits = pack.styles.get("personality_traits", ())
+        profile.personality_traits = random.sample(traits, min(3, len(traits)))
+        return True
+    return False
+
+def get_session_profile(session_id):
+    """The stored profile of a session, or a throwaway one for an unknown id"""
+    record = session_store.peek(session_id)
+    if record is not None:
+        return record.profile
+    return SessionProfile(session_hash(session_id))
+
+def load_game(session_id, record):
+    """(journey, pack, view) for a session's game
+
+    Games stored as dicts before journeys existed are converted, and a game
+    that no longer fits the story pack it can be played on starts over.
+    """
+    journey = record.state
+    if isinstance(journey, Journey):
+        pack = get_story_pack(journey)
+    else:
+        pack = story_packs.get(journey.get("pack_id", DEFAULT_STORY_PACK),
+                               journey.get("pack_version")) or get_story_pack()
     try:
-        # Get base node
-        node = story_nodes.get(node_id)
-        if not node:
-            return None
-            
-        # Make a copy so we don't modify the original
-        node_copy = node.copy()
+        with metrics.stage("replay"):
+            if not isinstance(journey, Journey):
+                journey = Journey.from_legacy(journey, pack.graph)
+            view = journey.replay(pack.graph)
+    except JourneyError as e:
+        print(f"Restarting game for session {session_id}: {str(e)}")
+        journey = reset_game_state(session_id, pack)
+        return journey, pack, journey.replay(pack.graph)
+    
+    # Re-pin a converted game, or one whose pack version has been unloaded
+    if record.state is not journey or (journey.pack_id, journey.pack_version) != (pack.id, pack.version):
+        journey.pack_id = pack.id
+        journey.pack_version = pack.version
+        record.state = journey
+        session_store.save(session_id, record)
+    return journey, pack, view
+
+def get_node_details(node_id, pack=None):
+    """Get the compiled (read-only) story node for a node ID, or None"""
+    return (pack or get_story_pack()).graph.get(node_id)
+
+def resolve_next_node(next_node_id, view, session_id, pack):
+    """Turn a choice's next_node into a real node, resolving _calculate_end"""
+    if next_node_id == "_calculate_end":
+        # The pack's ending rules classify the score and weighted tag
+        # balance, and the session hash picks that ending's variant, so
+        # each user gets a different ending
+        next_node_id = pack.resolver.resolve(view.score, view.balance,
+                                             get_session_profile(session_id).session_hash)
+    
+    return next_node_id
+
+def apply_choice(journey, view, choice_index, session_id, pack):
+    """Take a choice at the current node, appending it to the journey
+
+    Returns (view after the choice, None), or (view, error message) without
+    touching the journey if the choice can't be taken.
+    """
+    node_details = pack.graph.nodes[journey.current]
         
-        # Personalize choices if we're not at an end node
-        if not node_copy.get("is_end", False) and "choices" in node_copy:
-            # Deep copy choices to avoid modifying original
-            node_copy["choices"] = [choice.copy() for choice in node_copy["choices"]]
-            
-            # Personalize choice texts with small variations
-            for choice in node_copy["choices"]:
-                if "text" in choice:
-                    # We could add small variations to choice text here
-                    # But we'll keep the first choice consistent as required
-                    pass  # Implemented in the next update
+    # Validate choice index
+    if (type(choice_index) is not int or choice_index < 0
+            or choice_index >= len(node_details.choices)):
+        return view, "Invalid choice index"
         
-        return node_copy
+    # Get the chosen choice
+    choice = node_details.choices[choice_index]
+    
+    with metrics.stage("resolve"):
+        # Special processing for dynamic ending calculation
+        next_node_id = resolve_next_node(choice.next_node, view, session_id, pack)
         
-    except Exception as e:
-        traceback.print_exc()
+        # Record the step; score and sentiment tally follow from it
+        journey.record(node_details.index, choice_index, pack.graph.index_of(next_node_id))
+        return view.after(node_details, choice, next_node_id), None
+
+def predict_image_keys(view, node_details, session_id, pack):
+    """Image cache keys for every node the player's next choice can lead to
+
+    With prefetch priorities loaded, the likeliest next nodes come first, so
+    they survive the prefetcher's per-session limit.
+    """
+    priorities = prefetch_priorities.get(pack.id) or {}
+    predicted = []
+    for choice in node_details.choices:
+        next_node_id = resolve_next_node(choice.next_node, view, session_id, pack)
+        next_node = pack.graph.get(next_node_id)
+        if not next_node:
+            continue
+        
+        # The state as it would be right after taking this choice
+        after = view.after(node_details, choice, next_node_id)
+        seed, prompts = node_image_prompts(next_node, after.path_history, after.sentiment_tally,
+                                           None, session_id, pack=pack)
+        keys = []
+        for prompt in prompts.values():
+            key = image_cache.register(prompt, seed, (pack.id, next_node_id))
+            if not image_cache.contains(key):
+                keys.append(key)
+        predicted.append((-priorities.get(next_node_id, 0.0), keys))
+    if priorities:
+        predicted.sort(key=lambda item: item[0])
+    return [key for _, keys in predicted for key in keys]
+
+def share_artifact(session_id, journey, pack, view, node_prompts=None):
+    """The /api/share-image response for a finished game
+
+    `node_prompts` is the ending node's (seed, prompts) if already computed.
+    """
+    node_details = pack.graph.nodes[journey.current]
+    score = view.score
+    ending_category = node_details.ending_category or "Adventure Complete"
+    
+    # Up to 3 traits from the sentiment tally
+    top_traits = [tag for tag, count in view.sentiment_tally.items() if count > 0][:3]
+    traits_text = ", ".join(top_traits)
+    personality = f"a {traits_text} adventurer" if traits_text else "an adventurer"
+    
+    if node_prompts is None:
+        node_prompts = node_image_prompts(
+            node_details, view.path_history, view.sentiment_tally, view.last_choice,
+            session_id, journey.image_reroll, pack)
+    dynamic_seed, image_prompts = node_prompts
+    enhanced_prompt = image_prompts["image_url"]
+    
+    # Create manga-style panel layout prompt
+    share_manga_prompt = f"Manga style, 4-panel comic strip telling the story of {personality} who achieved the '{ending_category}' ending with a score of {score}, {enhanced_prompt}, clean white background with title 'Mystic Forest Adventure' and score displayed"
+    share = {
+        "share_image_url": build_image_url(share_manga_prompt, dynamic_seed, (pack.id, node_details.id)),
+        "score": score,
+        "ending_category": ending_category
+    }
+    if share_cards is not None:
+        thumbnails = [image_cache.register(image_prompts[field], dynamic_seed, (pack.id, node_details.id))
+                      for field in ("image_url", "summary_image_url")]
+        card_key = share_cards.register(pack.title, ending_category, score, thumbnails)
+        share["share_card_url"] = f"/api/share-card/{card_key}.png"
+    if outcome_records is not None:
+        try:
+            share["outcome"] = outcome_records.register({
+                "pack_id": pack.id,
+                "pack_version": pack.version,
+                "choices": encode_choices(journey.steps),
+                "path": view.path_history,
+                "ending": node_details.id,
+                "ending_category": ending_category,
+                "score": score,
+                "seed": dynamic_seed,
+                "prompts": dict(image_prompts, share_image_url=share_manga_prompt)
+            })
+        except OutcomeError as e:
+            print(f"No outcome code for this game: {str(e)}")
+    return share
+
+def render_state(session_id, record, pack=None, view=None):
+    """The /api/state response for a session that has already been loaded
+
+    /api/state, /api/choice and /api/reset all finish here, so each request
+    renders the player's node (prompts, image URLs, choice texts) once.
+    """
+    if view is None:
+        journey, pack, view = load_game(session_id, record)
+    journey = record.state
+    node_details = pack.graph.nodes[journey.current]
+    
+    # Generate image URL with dynamic seed and enhanced prompt
+    path_node_ids = view.path_history
+    sentiment_tally = view.sentiment_tally
+    last_choice = view.last_choice
+    
+    with metrics.stage("prompts"):
+        dynamic_seed, image_prompts = node_image_prompts(
+            node_details, path_node_ids, sentiment_tally, last_choice, session_id,
+            journey.image_reroll, pack)
+        enhanced_prompt = image_prompts["image_url"]
+        
+        # Create the image URLs, registering each with the proxy only once
+        image_urls = {}
+        current_keys = []
+        for field, prompt in image_prompts.items():
+            if image_cache is None:
+                image_urls[field] = upstream_image_url(prompt, dynamic_seed)
+            else:
+                key = image_cache.register(prompt, dynamic_seed, (pack.id, node_details.id))
+                current_keys.append(key)
+                image_urls[field] = f"/api/image/{key}"
+        image_url = image_urls["image_url"]
+    
+    # Work out the share artifact once, when the game reaches its ending
+    # (again for games that ended before outcome codes existed)
+    if node_details.is_end and (journey.share is None or (
+            outcome_records is not None and "outcome" not in journey.share)):
+        journey.share = share_artifact(session_id, journey, pack, view,
+                                       (dynamic_seed, image_prompts))
+        session_store.save(session_id, record)
+    
+    # Personalize choices with variations except the first choice
+    choices = []
+    if node_details.choices:
+        # Sessions stored before traits were assigned at creation
+        profile = record.profile
+        if ensure_personality_traits(profile, pack):
+            session_store.save(session_id, record)
+        
+        # The session hash makes choices consistently unique per user
+        with metrics.stage("personalize"):
+            choice_texts = personalizer.choice_texts(
+                session_id, profile.session_hash, profile.personality_traits, pack, node_details)
+            choices = [choice.to_dict(text) for choice, text in zip(node_details.choices, choice_texts)]
+    
+    # Get the score from the game state, ensuring consistency in property names
+    score = view.score
+    
+    # Prepare the response
+    response_data = {
+        "situation": node_details.situation,
+        "is_end": node_details.is_end,
+        "ending_category": node_details.ending_category,
+        "choices": choices,  # Use personalized choices
+        "image_url": image_url,
+        "image_prompt": enhanced_prompt,
+        "current_score": score,  # Use consistent name for frontend
+        "score": score  # Include both for backward compatibility
+    }
+    
+    # Special end-game content (manga and summary images) for end nodes
+    response_data.update(image_urls)
+    if node_details.is_end and journey.share.get("outcome"):
+        response_data["outcome"] = journey.share["outcome"]
+    
+    # Create response with cookie, in the format the client asked for
+    with metrics.stage("serialize"):
+        body, mimetype = encode_state(response_data, state_format())
+        if body is None:
+            response = make_response(jsonify(response_data))
+        else:
+            response = make_response(body)
+            response.mimetype = mimetype
+    add_vary(response, "Accept")
+    response.set_cookie('session_id', session_id, max_age=86400*30)  # 30 days
+    
+    # Warm the cache with the images the next choice can lead to once
+    # the response has been sent
+    if prefetcher is not None:
+        # End nodes lead nowhere; scheduling nothing still cancels the
+        # session's queued work for the branches it didn't take
+        with metrics.stage("predict"):
+            next_keys = (predict_image_keys(view, node_details, session_id, pack)
+                         if node_details.choices else [])
+        response.call_on_close(
+            lambda: prefetcher.schedule(session_id, next_keys, keep=current_keys))
+    return response
+
+def send_static_asset(path):
+    """A prebuilt file from public/, compressed and with validators; None if unknown"""
+    static_assets.maybe_reload()
+    found = static_assets.get(path)
+    if found is None:
         return None
+    asset, immutable = found
+    encoding = request.accept_encodings.best_match(asset.encodings(), default="identity")
+    response = make_response(asset.bodies.get(encoding, asset.bodies["identity"]))
+    if encoding in asset.bodies and encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    else:
+        encoding = "identity"
+    response.headers["Content-Type"] = asset.content_type
+    response.headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+    response.vary.add("Accept-Encoding")
+    response.set_etag(asset.etag(encoding))
+    return response.make_conditional(request)
+
+def state_etag(session_id, record):
+    """Changes whenever what /api/state would render for the session does"""
+    digest = hashlib.md5(f"{STATE_ETAG_SALT}:{session_id}:".encode())
+    digest.update(record_to_bytes(record, compact=True))
+    return digest.hexdigest() + FORMAT_TAGS[state_format()]
+
+def state_format():
+    """The state format the request's Accept header asks for; JSON by default"""
+    accept = request.headers.get("Accept", "")
+    # Most clients never name another format; skip parsing their header
+    if not any(mimetype in accept for mimetype in STATE_FORMATS[1:]):
+        return JSON
+    return request.accept_mimetypes.best_match(STATE_FORMATS, default=JSON)
+
+def etag_matches(etag):
+    """If-None-Match names the tag, either as is or as compress_api_response sent it"""
+    return any(request.if_none_match.contains(tag)
+               for tag in (etag,) + tuple(f"{etag}-{encoding}" for encoding in ENCODINGS))
 
 # --- API Endpoints ---
 @app.route('/')
 def serve_index():
     try:
+        response = send_static_asset('index.html')
+        if response is not None:
+            return response
         return send_from_directory('../public', 'index.html')
     except Exception as e:
         print(f"Error serving index: {str(e)}")
@@ -552,15 +869,129 @@ def serve_index():
 
 @app.route('/health')
 def health_check():
-    return jsonify({"status": "healthy", "message": "Mystic Forest Flow API is running"})
+    return jsonify({
+        "status": "healthy",
+        "message": "Mystic Forest Flow API is running",
+        "sessions": session_store.stats(),
+        "story_packs": story_packs.stats(),
+        "choice_texts": personalizer.stats(),
+        "share_cards": share_cards.stats() if share_cards is not None else None,
+        "outcome_index": outcome_index.stats() if outcome_index is not None else None,
+        "upstream": upstream_policy.stats() if image_cache is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+        "profiler": profiler.stats()
+    })
+
+def metrics_authorized():
+    if not METRICS_TOKEN:
+        return True
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return app.response_class(metrics.exposition(), mimetype="text/plain; version=0.0.4")
+
+@app.route('/metrics/profile', methods=['GET', 'POST'])
+def profiler_endpoint():
+    """GET: samples as folded stacks; POST {"enabled": bool, "interval": s} toggles"""
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Set METRICS_TOKEN to use the profiler"}), 403
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if request.method == 'GET':
+        return app.response_class(profiler.folded(), mimetype="text/plain")
+    
+    data = request.get_json(silent=True) or {}
+    interval = data.get("interval")
+    if interval is not None and (not isinstance(interval, (int, float)) or not 0.001 <= interval <= 1):
+        return jsonify({"error": "interval must be between 0.001 and 1 seconds"}), 400
+    if data.get("enabled"):
+        profiler.start(interval)
+    else:
+        profiler.stop()
+    return jsonify(profiler.stats())
 
 @app.route('/api/test')
 def test_endpoint():
     return jsonify({"message": "API is working", "timestamp": time.time()})
 
+def fallback_image(key):
+    """The stand-in picture (SVG bytes) for an image key, or None"""
+    tag = image_cache.fallback_of(key) if fallback_art is not None else None
+    return fallback_art.get(*tag) if tag is not None else None
+
+def image_unavailable(key, error):
+    """Response for an image the upstream couldn't provide
+
+    The node's stand-in picture if it has one, uncached so the real image
+    replaces it once the service recovers; otherwise an error saying when
+    to try again.
+    """
+    svg = fallback_image(key)
+    if svg is not None:
+        response = make_response(svg)
+        response.mimetype = "image/svg+xml"
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    if error.retry_after is not None:
+        response = jsonify({"error": "Image service is unavailable"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(max(1, int(error.retry_after + 0.999)))
+        return response
+    return jsonify({"error": "Image is not available right now"}), 502
+
+@app.route('/api/image/<key>', methods=['GET'])
+def serve_image(key):
+    if image_cache is None or not KEY_PATTERN.match(key):
+        return jsonify({"error": "Unknown image"}), 404
+    try:
+        image = image_cache.get(key)
+    except KeyError:
+        return jsonify({"error": "Unknown image"}), 404
+    except ImageFetchError as e:
+        print(f"Error fetching image {key}: {str(e)}")
+        return image_unavailable(key, e)
+    
+    # The key pins prompt and seed, so the bytes behind it never change
+    response = send_file(image.path, mimetype=image.content_type, etag=image.etag,
+                         conditional=True, max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.route('/api/share-card/<key>.png', methods=['GET'])
+def serve_share_card(key):
+    if share_cards is None or not CARD_KEY_PATTERN.match(key):
+        return jsonify({"error": "Unknown share card"}), 404
+    try:
+        path, partial = share_cards.get(key)
+    except KeyError:
+        return jsonify({"error": "Unknown share card"}), 404
+    except Exception as e:
+        print(f"Error drawing share card {key}: {str(e)}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not draw the share card"}), 500
+    
+    if partial is not None:
+        # Drawn without a picture the image service couldn't provide; a
+        # later request draws the whole card
+        response = make_response(partial)
+        response.mimetype = "image/png"
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    
+    # The key is a hash of everything on the card
+    response = send_file(path, mimetype="image/png", etag=key, conditional=True, max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
 @app.route('/<path:path>')
 def serve_static(path):
     try:
+        response = send_static_asset(path)
+        if response is not None:
+            return response
         return send_from_directory('../public', path)
     except Exception as e:
         print(f"Error serving static file {path}: {str(e)}")
@@ -577,133 +1008,26 @@ def get_current_state():
             session_id = hashlib.md5(f"{time.time()}-{secrets.token_hex(8)}".encode()).hexdigest()
         
         # Get or create the user's game state
-        if session_id in user_sessions and 'state' in user_sessions[session_id]:
-            game_state = user_sessions[session_id]['state']
-        else:
-            game_state = reset_game_state(session_id)
-        
-        current_node_id = game_state["current_node_id"]
-        node_details = get_node_details(current_node_id)
-        
-        if not node_details:
-            return jsonify({"error": "Invalid node"}), 400
-        
-        # Generate image URL with dynamic seed and enhanced prompt
-        path_node_ids = game_state.get("path_history", [])
-        sentiment_tally = game_state.get("sentiment_tally", {})
-        choice_history = game_state.get("choice_history", [])
-        last_choice = choice_history[-1] if choice_history else None
-        
-        base_seed = node_details.get("seed", 12345)
-        dynamic_seed = get_dynamic_seed(base_seed, path_node_ids, session_id)
-        
-        path_tuples = [(node, game_state.get("sentiment_tally", {}).get(node, 0)) 
-                       for node in path_node_ids]
-        
-        base_prompt = node_details.get("prompt", "")
-        enhanced_prompt = enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id)
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
+            limited = admit_new_session()
+            if limited is not None:
+                return limited
+            reset_game_state(session_id)
+            record = session_store.peek(session_id)
+        journey, pack, view = load_game(session_id, record)
         
-        # Create the image URL
-        encoded_prompt = requests.utils.quote(enhanced_prompt)
-        image_url = f"{POLLINATIONS_BASE_URL}{encoded_prompt}"
-        
-        # Personalize choices with variations except the first choice
-        choices = node_details.get("choices", [])
-        if choices and len(choices) > 0:
-            # Keep a deep copy to avoid modifying the original
-            choices = [choice.copy() for choice in choices]
-            
-            # Get user's personality traits from sessions or generate new ones
-            if session_id not in user_sessions:
-                user_sessions[session_id] = {}
-            
-            if 'personality_traits' not in user_sessions[session_id]:
-                # Generate random personality traits for this user
-                import random
-                traits = ["cautious", "bold", "diplomatic", "direct", "curious", "practical", 
-                          "optimistic", "pessimistic", "detailed", "concise"]
-                user_sessions[session_id]['personality_traits'] = random.sample(traits, 3)
-            
-            user_traits = user_sessions[session_id]['personality_traits']
-            
-            # Get a hash from the session ID to make choices consistently unique per user
-            session_hash = int(hashlib.md5(session_id.encode()).hexdigest(), 16)
-            
-            # Personalize choices (except first one at the start node) with small variations
-            for i, choice in enumerate(choices):
-                # Skip first choice at start node to keep it consistent
-                if current_node_id == "start" and i == 0:
-                    continue
-                    
-                original_text = choice.get("text", "")
-                
-                # Adjective modifiers based on personality
-                adjectives = {
-                    "cautious": ["carefully", "cautiously", "deliberately"],
-                    "bold": ["boldly", "bravely", "confidently"],
-                    "diplomatic": ["politely", "respectfully", "graciously"],
-                    "direct": ["directly", "straightforwardly", "bluntly"],
-                    "curious": ["curiously", "inquisitively", "wonderingly"],
-                    "practical": ["practically", "sensibly", "reasonably"],
-                    "optimistic": ["hopefully", "optimistically", "eagerly"],
-                    "pessimistic": ["warily", "skeptically", "doubtfully"],
-                    "detailed": ["meticulously", "thoroughly", "carefully"],
-                    "concise": ["simply", "briefly", "efficiently"]
-                }
-                
-                # Get suitable adjectives for this user's personality
-                suitable_adjectives = []
-                for trait in user_traits:
-                    if trait in adjectives:
-                        suitable_adjectives.extend(adjectives[trait])
-                
-                if suitable_adjectives:
-                    # Select a consistent adjective based on session and choice
-                    adj_index = (session_hash + i) % len(suitable_adjectives)
-                    selected_adj = suitable_adjectives[adj_index]
-                    
-                    # Insert the adjective into the choice text if it makes sense
-                    # Identify the verb in the choice text
-                    words = original_text.split()
-                    # Simple heuristic: Look for verbs typical in choices
-                    common_verbs = ["Take", "Go", "Explore", "Talk", "Help", "Ignore", "Follow", "Leave", 
-                                   "Examine", "Search", "Ask", "Fight", "Run", "Hide", "Climb", "Jump"]
-                    
-                    for j, word in enumerate(words):
-                        if word in common_verbs and j < len(words) - 1:
-                            # Insert adjective after the verb
-                            modified_text = " ".join(words[:j+1]) + " " + selected_adj + " " + " ".join(words[j+1:])
-                            choice["text"] = modified_text
-                            break
-        
-        # Get the score from the game state, ensuring consistency in property names
-        score = game_state.get("score", 0)
-        
-        # Prepare the response
-        response_data = {
-            "situation": node_details.get("situation", ""),
-            "is_end": node_details.get("is_end", False),
-            "ending_category": node_details.get("ending_category", ""),
-            "choices": choices,  # Use personalized choices
-            "image_url": image_url,
-            "image_prompt": enhanced_prompt,
-            "current_score": score,  # Use consistent name for frontend
-            "score": score  # Include both for backward compatibility
-        }
-        
-        # Generate special end-game content if this is an end node
-        if node_details.get("is_end", False):
-            manga_prompt = f"Manga style, story summary of {enhanced_prompt}"
-            encoded_manga_prompt = requests.utils.quote(manga_prompt)
-            response_data["manga_image_url"] = f"{POLLINATIONS_BASE_URL}{encoded_manga_prompt}"
-            
-            summary_prompt = f"Fantasy book cover, hero's journey, {enhanced_prompt}"
-            encoded_summary_prompt = requests.utils.quote(summary_prompt)
-            response_data["summary_image_url"] = f"{POLLINATIONS_BASE_URL}{encoded_summary_prompt}"
+        if etag_matches(state_etag(session_id, record)):
+            # The browser's copy is still current; skip rendering it again
+            response = make_response("", 304)
+            response.set_cookie('session_id', session_id, max_age=86400*30)
+        else:
+            response = render_state(session_id, record, pack, view)
         
-        # Create response with cookie
-        response = make_response(jsonify(response_data))
-        response.set_cookie('session_id', session_id, max_age=86400*30)  # 30 days
+        # Rendering can fill in profile values, so tag the state it left
+        response.set_etag(state_etag(session_id, record))
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Cookie")
         return response
         
     except Exception as e:
@@ -726,98 +1050,80 @@ def make_choice():
             return jsonify({"error": "No session found"}), 400
         
         # Get the user's game state
-        if session_id not in user_sessions or 'state' not in user_sessions[session_id]:
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
             return jsonify({"error": "No game in progress"}), 400
             
-        game_state = user_sessions[session_id]['state']
-        current_node_id = game_state["current_node_id"]
-        
-        # Get current node details
-        node_details = get_node_details(current_node_id)
-        if not node_details:
-            return jsonify({"error": "Invalid current node"}), 400
-            
-        # Validate choice index
-        if not node_details.get("choices") or choice_index >= len(node_details["choices"]):
-            return jsonify({"error": "Invalid choice index"}), 400
-            
-        # Get the chosen choice
-        choice = node_details["choices"][choice_index]
-        
-        # Special processing for dynamic ending calculation
-        next_node_id = choice.get("next_node")
-        if next_node_id == "_calculate_end":
-            # Calculate ending based on score and sentiment
-            score = game_state.get("score", 0)
-            sentiment_tally = game_state.get("sentiment_tally", {})
-            
-            # Count positive vs negative tags
-            positive_count = sum(sentiment_tally.get(tag, 0) for tag in 
-                             ["kind", "adventurous", "bold", "wise", "resourceful"])
-            negative_count = sum(sentiment_tally.get(tag, 0) for tag in 
-                             ["selfish", "cautious", "stubborn"])
-            
-            # Determine ending based on score and sentiment balance
-            if score >= 5 and positive_count > negative_count:
-                next_node_id = "generic_good_ending"
-            elif score <= 0 or negative_count > positive_count:
-                next_node_id = "generic_bad_ending"
-            else:
-                next_node_id = "generic_neutral_ending"
-                
-            # Create a unique ending variation based on the session ID
-            # This ensures each user gets a different ending
-            custom_endings = {
-                "generic_good_ending": [
-                    "heroic_savior_ending", "wise_mage_ending", "forest_guardian_ending"
-                ],
-                "generic_neutral_ending": [
-                    "peaceful_traveler_ending", "forest_explorer_ending", "merchant_ending"
-                ],
-                "generic_bad_ending": [
-                    "lost_soul_ending", "cursed_wanderer_ending", "forest_prisoner_ending"
-                ]
-            }
-            
-            if next_node_id in custom_endings:
-                # Use the session ID to pick a specific variant
-                session_hash = int(hashlib.md5(session_id.encode()).hexdigest(), 16)
-                ending_options = custom_endings[next_node_id]
-                ending_index = session_hash % len(ending_options)
-                custom_ending = ending_options[ending_index]
-                
-                # If we have this ending defined, use it instead
-                if custom_ending in story_nodes:
-                    next_node_id = custom_ending
-        
-        # Update game state
-        game_state["current_node_id"] = next_node_id
-        game_state["path_history"].append(next_node_id)
-        
-        # Update score
-        score_modifier = choice.get("score_modifier", 0)
-        game_state["score"] += score_modifier
-        
-        # Update sentiment tally
-        tag = choice.get("tag")
-        if tag:
-            if tag not in game_state["sentiment_tally"]:
-                game_state["sentiment_tally"][tag] = 0
-            game_state["sentiment_tally"][tag] += 1
-        
-        # Record this choice
-        game_state["choice_history"].append({
-            "from_node": current_node_id,
-            "choice_index": choice_index,
-            "choice_text": choice.get("text", ""),
-            "tag": tag
-        })
+        journey, pack, view = load_game(session_id, record)
+        view, error = apply_choice(journey, view, choice_index, session_id, pack)
+        if error:
+            return jsonify({"error": error}), 400
         
         # Save the updated state
-        user_sessions[session_id]['state'] = game_state
+        session_store.save(session_id, record)
         
         # Return the new state
-        return get_current_state()
+        return render_state(session_id, record, pack, view)
+        
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/choices', methods=['POST'])
+def make_choices():
+    """Apply a list of choices in one go, all or nothing"""
+    try:
+        data = request.get_json(silent=True) or {}
+        choice_indices = data.get('choice_indices')
+        
+        if not isinstance(choice_indices, list) or not choice_indices:
+            return jsonify({"error": "Missing choice_indices"}), 400
+        if len(choice_indices) > MAX_BATCH_CHOICES:
+            return jsonify({"error": f"At most {MAX_BATCH_CHOICES} choices per request"}), 400
+        # Get user's session ID from cookies
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return jsonify({"error": "No session found"}), 400
+        
+        # Get the user's game state
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
+            return jsonify({"error": "No game in progress"}), 400
+        
+        # Work on a copy so a bad step leaves the saved game untouched
+        journey, pack, view = load_game(session_id, record)
+        journey = journey.copy()
+        for step, choice_index in enumerate(choice_indices):
+            view, error = apply_choice(journey, view, choice_index, session_id, pack)
+            if error:
+                return jsonify({"error": error, "step": step}), 400
+        
+        # Save the updated state and render only where the player ended up
+        record.state = journey
+        session_store.save(session_id, record)
+        return render_state(session_id, record, pack, view)
+        
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/reroll', methods=['POST'])
+def reroll_image():
+    """Ask for a different picture of the player's current node"""
+    try:
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return jsonify({"error": "No session found"}), 400
+        
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
+            return jsonify({"error": "No game in progress"}), 400
+        
+        journey, pack, view = load_game(session_id, record)
+        journey.image_reroll += 1
+        journey.share = None
+        session_store.save(session_id, record)
+        return render_state(session_id, record, pack, view)
         
     except Exception as e:
         traceback.print_exc()
@@ -833,12 +1139,26 @@ def reset_game():
             import secrets
             session_id = hashlib.md5(f"{time.time()}-{secrets.token_hex(8)}".encode()).hexdigest()
         
+        # Optionally start the new game on a different story pack
+        data = request.get_json(silent=True) or {}
+        pack = None
+        if data.get("pack"):
+            pack = story_packs.current(data["pack"])
+            if pack is None:
+                return jsonify({"error": "Unknown story pack"}), 400
+        
+        # Only creating a session counts against the new-session limit
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
+            limited = admit_new_session()
+            if limited is not None:
+                return limited
+        
         # Reset the game state for this session
-        reset_game_state(session_id)
+        reset_game_state(session_id, pack)
         
         # Instead of just returning success message, return the actual game state
-        # by calling the get_current_state function
-        return get_current_state()
+        return render_state(session_id, session_store.peek(session_id))
         
     except Exception as e:
         traceback.print_exc()
@@ -853,70 +1173,98 @@ def generate_share_image():
             return jsonify({"error": "No session found"}), 400
         
         # Get the user's game state
-        if session_id not in user_sessions or 'state' not in user_sessions[session_id]:
+        record = session_store.get(session_id)
+        if record is None or record.state is None:
             return jsonify({"error": "No game in progress"}), 400
             
-        game_state = user_sessions[session_id]['state']
-        
-        # Get score and ending information
-        score = game_state.get("score", 0)
-        current_node_id = game_state.get("current_node_id", "")
-        node_details = get_node_details(current_node_id)
+        journey, pack, view = load_game(session_id, record)
         
-        if not node_details:
-            return jsonify({"error": "Invalid node"}), 400
+        node_details = pack.graph.nodes[journey.current]
             
         # Check if the game has ended
-        if not node_details.get("is_end", False):
+        if not node_details.is_end:
             return jsonify({"error": "Game has not ended yet"}), 400
-            
-        # Get the ending category
-        ending_category = node_details.get("ending_category", "Adventure Complete")
-        
-        # Generate the specific manga image prompt with user's journey details
-        path_node_ids = game_state.get("path_history", [])
-        sentiment_tally = game_state.get("sentiment_tally", {})
-        
-        # Generate main traits from sentiment tally
-        main_traits = []
-        for tag, count in sentiment_tally.items():
-            if count > 0:
-                main_traits.append(tag)
         
-        # Select top 3 traits if we have that many
-        top_traits = main_traits[:3] if len(main_traits) >= 3 else main_traits
-        traits_text = ", ".join(top_traits)
+        # Worked out when the game reached its ending; games that ended
+        # before it was kept get theirs now
+        if journey.share is None:
+            journey.share = share_artifact(session_id, journey, pack, view)
+            session_store.save(session_id, record)
+        return jsonify(journey.share)
         
-        # Create a personalized story description
-        personality = f"a {traits_text} adventurer" if traits_text else "an adventurer"
-        
-        # Generate image URL with enhanced prompt
-        base_prompt = node_details.get("prompt", "")
-        path_tuples = [(node, sentiment_tally.get(node, 0)) for node in path_node_ids]
-        choice_history = game_state.get("choice_history", [])
-        last_choice = choice_history[-1] if choice_history else None
-        
-        # Get dynamic seed
-        base_seed = node_details.get("seed", 12345)
-        dynamic_seed = get_dynamic_seed(base_seed, path_node_ids, session_id)
-        
-        # Generate enhanced prompt for manga-style image
-        enhanced_prompt = enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id)
-        
-        # Create manga-style panel layout prompt
-        share_manga_prompt = f"Manga style, 4-panel comic strip telling the story of {personality} who achieved the '{ending_category}' ending with a score of {score}, {enhanced_prompt}, clean white background with title 'Mystic Forest Adventure' and score displayed"
-        
-        # URL encode the prompt
-        encoded_manga_prompt = requests.utils.quote(share_manga_prompt)
-        share_image_url = f"{POLLINATIONS_BASE_URL}{encoded_manga_prompt}"
-        
-        # Return the share image URL
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/outcomes/<code>', methods=['GET'])
+def get_outcome(code):
+    """The prompts and images behind an outcome code saved on chain"""
+    if outcome_records is None:
+        return jsonify({"error": "Outcome codes are not enabled"}), 503
+    if parse_code(code) is None:
+        return jsonify({"error": "Invalid outcome code"}), 400
+    try:
+        record = outcome_records.get(code)
+        if record is None:
+            return jsonify({"error": "Outcome not found"}), 404
+        outcome = dict(record, code=code)
+        fallback = (record["pack_id"], record["ending"])
+        outcome["image_urls"] = {field: build_image_url(prompt, record["seed"], fallback)
+                                 for field, prompt in record["prompts"].items()}
+        response = make_response(jsonify(outcome))
+        # A code always names the same record
+        response.headers["Cache-Control"] = IMMUTABLE
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+def describe_story(story):
+    """An indexed story, with a link to its outcome when it was saved as a code"""
+    if parse_code(story.get("image_url")) is not None:
+        story["outcome_url"] = f"/api/outcomes/{story['image_url']}"
+    return story
+
+@app.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    """Saved story outcomes by score, from the local index: ?page=&per_page=&ending="""
+    if outcome_index is None:
+        return jsonify({"error": "Story outcome index is not enabled"}), 503
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', 20))
+    except ValueError:
+        return jsonify({"error": "page and per_page must be integers"}), 400
+    if page < 1 or not 1 <= per_page <= LEADERBOARD_MAX_PER_PAGE:
+        return jsonify({"error": f"page must be >= 1 and per_page between 1 and {LEADERBOARD_MAX_PER_PAGE}"}), 400
+    
+    try:
+        offset = (page - 1) * per_page
+        stories, total = outcome_index.leaderboard(offset, per_page, request.args.get('ending'))
+        for rank, story in enumerate(stories, offset + 1):
+            story["rank"] = rank
+            describe_story(story)
         return jsonify({
-            "share_image_url": share_image_url,
-            "score": score,
-            "ending_category": ending_category
+            "stories": stories,
+            "page": page,
+            "per_page": per_page,
+            "total": total,
+            "indexed_to_block": outcome_index.checkpoint() - 1
         })
-        
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/stories/<int:story_id>', methods=['GET'])
+def get_story_outcome(story_id):
+    """One saved story outcome from the local index"""
+    if outcome_index is None:
+        return jsonify({"error": "Story outcome index is not enabled"}), 503
+    try:
+        story = outcome_index.story(story_id)
+        if story is None:
+            return jsonify({"error": "Story not found"}), 404
+        return jsonify(describe_story(story))
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
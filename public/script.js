@@ -83,12 +83,12 @@ async function updateGameState() {
         const controller = new AbortController();
         const timeoutId = setTimeout(() => controller.abort(), 15000); // 15 second timeout
 
+        // Always revalidate: an unchanged game comes back as a 304 and the
+        // browser's cached copy is used
         const response = await fetch('/api/state', {
             signal: controller.signal,
-            headers: {
-                'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache'
-            }
+            cache: 'no-cache',
+            headers: { 'Accept': STATE_ACCEPT }
         });
 
         clearTimeout(timeoutId);
@@ -97,7 +97,7 @@ async function updateGameState() {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
+        const data = expandState(await response.json());
 
         // Validate the data received
         if (!data || (typeof data === 'object' && Object.keys(data).length === 0)) {
@@ -139,6 +139,28 @@ async function updateGameState() {
     }
 }
 
+// Game states come in the compact format (see api/_wire.py), which leaves
+// out what the page doesn't use; plain JSON is still understood
+const STATE_ACCEPT = 'application/vnd.mystic-forest.compact+json, application/json;q=0.5';
+
+// The compact state with the field names the rest of this file uses
+function expandState(data) {
+    if (!data || data.s === undefined) return data;
+    return {
+        situation: data.s,
+        image_url: data.i,
+        image_prompt: data.a,
+        score: data.p,
+        current_score: data.p,
+        is_end: Boolean(data.e),
+        ending_category: data.k || null,
+        choices: (data.c || []).map(text => ({ text: text })),
+        manga_image_url: data.m,
+        summary_image_url: data.u,
+        outcome: data.o
+    };
+}
+
 function renderState(data) {
     console.log("Rendering state:", data);
 
@@ -222,6 +244,7 @@ async function handleChoiceClick(event) {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'Accept': STATE_ACCEPT
             },
             body: JSON.stringify({ choice_index: choiceIndex }),
             signal: controller.signal
@@ -234,7 +257,7 @@ async function handleChoiceClick(event) {
             throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
         }
 
-        const nextStateData = await response.json();
+        const nextStateData = expandState(await response.json());
         renderState(nextStateData); // Render the new state received
     } catch (error) {
         console.error("Error making choice:", error);
@@ -344,11 +367,13 @@ function displayEndScreen(data) {
     saveToBlockchainButton.style.marginLeft = '10px';
 
     saveToBlockchainButton.addEventListener('click', async () => {
+        // Saved for good, so store the image URLs absolute (proxied ones are
+        // same-origin paths)
         const storyData = {
             endingCategory: endingCategory,
             score: score,
-            imageUrl: data.image_url || '',
-            mangaImageUrl: data.manga_image_url || ''
+            imageUrl: data.image_url ? new URL(data.image_url, window.location.origin).href : '',
+            mangaImageUrl: data.manga_image_url ? new URL(data.manga_image_url, window.location.origin).href : ''
         };
 
         const storyId = await saveStoryToBlockchain(storyData);
@@ -416,8 +441,10 @@ async function openShareModal(score, endingCategory) {
         shareMangaImageElement.style.display = 'block';
         shareMangaImageElement.src = data.share_image_url;
 
-        // Setup share buttons with the appropriate data
-        setupShareButtons(data.share_image_url, score, endingCategory);
+        // Setup share buttons with the appropriate data; the server-drawn
+        // card (score, ending, thumbnails) is what gets downloaded or copied
+        // when the server offers one
+        setupShareButtons(data.share_card_url || data.share_image_url, score, endingCategory);
 
     } catch (error) {
         console.error("Error generating share image:", error);
@@ -440,7 +467,7 @@ async function openShareModal(score, endingCategory) {
 function setupShareButtons(imageUrl, score, endingCategory) {
     // Setup download button
     downloadImageButton.onclick = () => {
-        downloadImage(imageUrl, 'mystic-forest-adventure.jpg');
+        downloadImage(imageUrl, imageUrl.endsWith('.png') ? 'mystic-forest-adventure.png' : 'mystic-forest-adventure.jpg');
     };
 
     // Setup copy button
@@ -580,7 +607,8 @@ async function resetGame() {
             signal: controller.signal,
             headers: {
                 'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache'
+                'Pragma': 'no-cache',
+                'Accept': STATE_ACCEPT
             }
         });
 
@@ -591,7 +619,7 @@ async function resetGame() {
             throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
+        const data = expandState(await response.json());
 
         // Check if we got a valid game state
         if (!data || (!data.situation && !data.current_score && !data.choices)) {
@@ -816,8 +844,33 @@ async function saveStoryToBlockchain(storyData) {
     }
 }
 
+// Story outcomes as indexed by the server (see /api/leaderboard); null when
+// the index is off or hasn't seen the story yet, so callers use the chain
+async function getIndexedStory(storyId) {
+    try {
+        const response = await fetch(`/api/stories/${encodeURIComponent(storyId)}`);
+        if (!response.ok) return null;
+        const story = await response.json();
+        return {
+            storyId: story.story_id,
+            endingCategory: story.ending_category,
+            score: story.score,
+            imageUrl: story.image_url,
+            mangaImageUrl: story.manga_image_url,
+            player: story.player,
+            timestamp: story.created_at,
+            outcomeUrl: story.outcome_url || null
+        };
+    } catch (error) {
+        return null;
+    }
+}
+
 // Get story from blockchain
 async function getStoryFromBlockchain(storyId) {
+    const indexed = await getIndexedStory(storyId);
+    if (indexed) return indexed;
+
     try {
         if (!flowContract) {
             const connected = await connectToFlow();
@@ -835,6 +888,16 @@ async function getStoryFromBlockchain(storyId) {
 
 // Get total number of stories on blockchain
 async function getTotalStoriesOnBlockchain() {
+    try {
+        const response = await fetch('/api/leaderboard?per_page=1');
+        if (response.ok) {
+            const leaderboard = await response.json();
+            return String(leaderboard.total);
+        }
+    } catch (error) {
+        // Fall back to the contract
+    }
+
     try {
         if (!flowContract) {
             const connected = await connectToFlow();
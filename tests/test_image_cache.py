@@ -0,0 +1,98 @@
+"""The image proxy's disk cache: signed keys and single-flight fetches,
+against the image service stand-in from tools/stubs.py."""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, "api"), os.path.join(REPO_DIR, "tools")]
+
+from _async_http import AsyncHTTPClient  # noqa: E402
+from _image_cache import KEY_PATTERN, AsyncImageFetcher, ImageCache  # noqa: E402
+from stubs import ImageStubServer  # noqa: E402
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = ImageStubServer(delay=0.3).start()
+        self.directory = tempfile.mkdtemp(prefix="test-image-cache-")
+
+    def tearDown(self):
+        self.stub.shutdown()
+        self.stub.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def cache(self, secret="test", directory=None):
+        return ImageCache(lambda prompt, seed: f"{self.stub.base_url}{prompt}?seed={seed}",
+                          directory or self.directory, timeout=5, secret=secret)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        cache = self.cache()
+        key = cache.register("forest", 7)
+        images = []
+        threads = [threading.Thread(target=lambda: images.append(cache.get(key))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stub.requests, 1)
+        self.assertEqual(len({image.etag for image in images}), 1)
+        self.assertEqual(len(images), 8)
+
+        cache.get(key)
+        stats = cache.stats()
+        self.assertEqual((stats["misses"], stats["upstream_fetches"]), (1, 1))
+        self.assertEqual(stats["coalesced"] + stats["hits"], 8)
+
+    def test_concurrent_async_misses_share_one_fetch(self):
+        cache = self.cache()
+        keys = [cache.register("forest", seed) for seed in range(3)]
+
+        async def fetch_all():
+            client = AsyncHTTPClient()
+            fetcher = AsyncImageFetcher(cache, client)
+            try:
+                return await asyncio.gather(*[fetcher.get(key) for key in keys for _ in range(10)])
+            finally:
+                await client.close()
+
+        images = asyncio.run(fetch_all())
+        self.assertEqual(len(images), 30)
+        self.assertEqual(self.stub.requests, 3)
+        self.assertEqual(len({image.etag for image in images}), 3)
+
+    def test_keys_are_signed(self):
+        cache = self.cache()
+        key = cache.register("forest", 7)
+        self.assertRegex(key, KEY_PATTERN)
+        self.assertEqual(cache.source(key), f"{self.stub.base_url}forest?seed=7")
+
+        # Another instance with the same secret resolves it without having seen it
+        other = self.cache(directory=os.path.join(self.directory, "other"))
+        self.assertEqual(other.source(key), cache.source(key))
+
+        stranger = self.cache(secret="other", directory=os.path.join(self.directory, "stranger"))
+        self.assertIsNone(stranger.source(key))
+        with self.assertRaises(KeyError):
+            stranger.get(key)
+        payload, signature = key.split(".")
+        tampered = payload[:-1] + ("A" if payload[-1] != "A" else "B") + "." + signature
+        with self.assertRaises(KeyError):
+            cache.get(tampered)
+        self.assertEqual(self.stub.requests, 0)
+
+    def test_cached_images_survive_a_restart(self):
+        key = self.cache().register("forest", 7)
+        self.cache().get(key)
+        image = self.cache().get(key)
+        self.assertEqual(self.stub.requests, 1)
+        self.assertTrue(os.path.exists(image.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
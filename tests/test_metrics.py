@@ -0,0 +1,67 @@
+"""Request metrics and their Prometheus text exposition."""
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "api"))
+
+from _metrics import Histogram, Metrics  # noqa: E402
+from _resilience import CircuitBreaker, UpstreamPolicy  # noqa: E402
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_buckets_are_cumulative(self):
+        metrics = Metrics()
+        for seconds in (0.0001, 0.003, 0.003, 20.0):
+            metrics.observe_request("/api/state", "GET", 200, seconds)
+        text = metrics.exposition()
+        name = "mff_request_duration_seconds"
+        self.assertIn(f'{name}_bucket{{endpoint="/api/state",method="GET",le="0.0005"}} 1', text)
+        self.assertIn(f'{name}_bucket{{endpoint="/api/state",method="GET",le="0.005"}} 3', text)
+        self.assertIn(f'{name}_bucket{{endpoint="/api/state",method="GET",le="10.0"}} 3', text)
+        self.assertIn(f'{name}_bucket{{endpoint="/api/state",method="GET",le="+Inf"}} 4', text)
+        self.assertIn(f'{name}_count{{endpoint="/api/state",method="GET"}} 4', text)
+        self.assertIn('mff_responses_total{endpoint="/api/state",status="200"} 4', text)
+
+    def test_stages_are_timed_per_endpoint(self):
+        metrics = Metrics()
+        metrics.begin("/api/choice")
+        with metrics.stage("prompts"):
+            pass
+        metrics.end("POST", 200)
+        text = metrics.exposition()
+        self.assertIn('mff_stage_duration_seconds_count{endpoint="/api/choice",stage="prompts"} 1', text)
+        self.assertEqual(metrics.active, {})
+
+    def test_disabled_metrics_record_nothing(self):
+        metrics = Metrics(enabled=False)
+        metrics.begin("/api/state")
+        with metrics.stage("prompts"):
+            pass
+        metrics.end("GET", 200)
+        self.assertNotIn("endpoint=", metrics.exposition())
+
+    def test_sources_become_counters_and_gauges(self):
+        metrics = Metrics()
+        breaker = CircuitBreaker(failure_threshold=1)
+        policy = UpstreamPolicy(breaker=breaker)
+        metrics.add_source("upstream", policy.stats, counters=("opens", "calls"))
+        metrics.add_source("broken", lambda: 1 / 0)
+        breaker.record_failure()
+        text = metrics.exposition()
+        self.assertIn("# TYPE mff_upstream_opens_total counter\nmff_upstream_opens_total 1\n", text)
+        self.assertIn("# TYPE mff_upstream_state_code gauge\nmff_upstream_state_code 2\n", text)
+        # Strings are left out; a failing source doesn't take the others down
+        self.assertNotIn("mff_upstream_state ", text)
+        self.assertNotIn("mff_broken", text)
+
+    def test_histogram_edges(self):
+        histogram = Histogram()
+        histogram.observe(0.0005)  # a bound belongs to its own bucket
+        self.assertEqual(histogram.counts[0], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
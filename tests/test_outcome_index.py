@@ -0,0 +1,82 @@
+"""The on-chain outcome indexer against the JSON-RPC stand-in from tools/stubs.py."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, "api"), os.path.join(REPO_DIR, "tools")]
+
+from _outcome_index import OutcomeIndex  # noqa: E402
+from stubs import ChainStubServer  # noqa: E402
+
+PLAYER = "0x" + "ab" * 20
+
+
+class OutcomeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="test-outcome-index-")
+        self.path = os.path.join(self.directory, "outcomes.db")
+
+    def tearDown(self):
+        self.chain.shutdown()
+        self.chain.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def index(self, **options):
+        options.setdefault("confirmations", 0)
+        return OutcomeIndex(self.path, self.chain.url, self.chain.contract, **options)
+
+    def test_resumes_from_its_checkpoint(self):
+        self.chain = ChainStubServer().start()
+        for score in (10, 30, 20):
+            self.chain.create_story(PLAYER, "Forest Guardian", score, f"https://example.com/{score}.png")
+        first = self.index()
+        self.assertEqual(first.sync_once(), 3)
+        self.assertEqual(first.checkpoint(), self.chain.block + 1)
+        self.assertEqual(first.sync_once(), 0)
+
+        story_id = self.chain.create_story(PLAYER, "Lost Wanderer", 50)
+        self.chain.update_story(1, "https://example.com/new.png")
+
+        # A fresh indexer on the same database only reads the new blocks
+        second = self.index()
+        self.assertEqual(second.sync_once(), 2)
+        self.assertEqual(second.stats()["ranges"], 1)
+        stories, total = second.leaderboard()
+        self.assertEqual(total, 4)
+        self.assertEqual([story["score"] for story in stories], [50, 30, 20, 10])
+        self.assertEqual(stories[0]["story_id"], story_id)
+        self.assertEqual(stories[0]["player"], PLAYER)
+        self.assertEqual(second.story(1)["image_url"], "https://example.com/new.png")
+
+    def test_unconfirmed_blocks_wait(self):
+        self.chain = ChainStubServer().start()
+        self.chain.create_story(PLAYER, "Forest Guardian", 10)
+        index = self.index(confirmations=2)
+        self.assertEqual(index.sync_once(), 0)
+        self.chain.mine(2)
+        self.assertEqual(index.sync_once(), 1)
+
+    def test_refused_ranges_are_halved(self):
+        self.chain = ChainStubServer(max_logs=4).start()
+        for score in range(20):
+            self.chain.create_story(PLAYER, "Forest Guardian", score)
+        index = self.index(block_range=64)
+        self.assertEqual(index.sync_once(), 20)
+        self.assertEqual(index.leaderboard(limit=100)[1], 20)
+        self.assertEqual(index.checkpoint(), self.chain.block + 1)
+        stats = index.stats()
+        self.assertGreater(stats["ranges"], 1)
+        self.assertGreater(stats["rpc_errors"], 0)
+
+        # Once the node answers again the range grows back
+        self.chain.mine(100)
+        index.sync_once()
+        self.assertEqual(index._range, 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
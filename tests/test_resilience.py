@@ -0,0 +1,217 @@
+"""Upstream resilience: circuit breaker, hedging, retries, retry budget and
+fallback art, against the image service stand-in from tools/stubs.py."""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_DIR, "api"), os.path.join(REPO_DIR, "tools")]
+
+from _image_cache import ImageCache, ImageFetchError  # noqa: E402
+from _resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RetryBudget, UpstreamPolicy  # noqa: E402
+from stubs import ImageStubServer  # noqa: E402
+
+
+def slow_then_fast_seed(slow_rate):
+    """A stub seed whose first request is slow and second one isn't"""
+    for seed in range(1000):
+        rng = random.Random(seed)
+        draws = [rng.random() for _ in range(4)]  # (fail, slow) per request
+        if draws[1] < slow_rate <= draws[3]:
+            return seed
+    raise AssertionError("no seed found")
+
+
+class UpstreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = ImageStubServer().start()
+        self.directory = tempfile.mkdtemp(prefix="test-resilience-")
+
+    def tearDown(self):
+        self.stub.shutdown()
+        self.stub.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def cache(self, **policy):
+        policy.setdefault("deadline", 5)
+        policy.setdefault("attempt_timeout", 5)
+        policy.setdefault("hedge_delay", 0)
+        self.policy = UpstreamPolicy(**policy)
+        return ImageCache(lambda prompt, seed: f"{self.stub.base_url}{prompt}?seed={seed}",
+                          self.directory, timeout=5, policy=self.policy, secret="test")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 29)
+        self.assertEqual(breaker.stats()["rejected"], 1)
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.05)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.stats()["opens"], 2)
+
+
+class UpstreamPolicyTest(UpstreamTestCase):
+
+    def test_hedge_answers_for_a_stuck_request(self):
+        self.stub.rng = random.Random(slow_then_fast_seed(0.5))
+        self.stub.slow_rate, self.stub.slow_delay = 0.5, 3.0
+        cache = self.cache(hedge_delay=0.1, max_attempts=2)
+        started = time.monotonic()
+        image = cache.get(cache.register("stuck", 1))
+        self.assertLess(time.monotonic() - started, 2.0)
+        self.assertEqual(image.content_type, "image/png")
+        stats = self.policy.stats()
+        self.assertEqual((stats["hedges"], stats["hedge_wins"]), (1, 1))
+        self.assertEqual(self.stub.requests, 2)
+
+    def test_server_errors_are_retried(self):
+        self.stub.fail_rate = 1.0
+        cache = self.cache(max_attempts=2)
+        with self.assertRaises(ImageFetchError) as raised:
+            cache.get(cache.register("down", 1))
+        self.assertTrue(raised.exception.retryable)
+        self.assertEqual(self.stub.requests, 2)
+        self.assertEqual(self.policy.stats()["retries"], 1)
+
+    def test_client_errors_are_not_retried(self):
+        self.stub.fail_rate, self.stub.fail_status = 1.0, 404
+        cache = self.cache(max_attempts=2, breaker=CircuitBreaker(failure_threshold=1))
+        with self.assertRaises(ImageFetchError) as raised:
+            cache.get(cache.register("missing", 1))
+        self.assertFalse(raised.exception.retryable)
+        self.assertEqual(self.stub.requests, 1)
+        # The service answered, so it still counts as healthy
+        self.assertEqual(self.policy.breaker.state, CLOSED)
+
+    def test_open_breaker_refuses_without_asking_upstream(self):
+        self.stub.fail_rate = 1.0
+        cache = self.cache(max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+        for i in range(2):
+            with self.assertRaises(ImageFetchError):
+                cache.get(cache.register(f"fail{i}", 1))
+        with self.assertRaises(ImageFetchError) as raised:
+            cache.get(cache.register("refused", 1))
+        self.assertFalse(raised.exception.retryable)
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(self.stub.requests, 2)
+
+        # After reset_timeout one probe goes through and closes it again
+        self.stub.fail_rate = 0.0
+        time.sleep(0.25)
+        cache.get(cache.register("probe", 1))
+        self.assertEqual(self.policy.breaker.state, CLOSED)
+        self.assertEqual(self.stub.requests, 3)
+
+    def test_retry_budget_caps_retries(self):
+        self.stub.fail_rate = 1.0
+        cache = self.cache(max_attempts=2, breaker=CircuitBreaker(failure_threshold=100),
+                           budget=RetryBudget(ratio=0, per_second=0, max_tokens=1))
+        for i in range(3):
+            with self.assertRaises(ImageFetchError):
+                cache.get(cache.register(f"fail{i}", 1))
+        # One retry from the single token, then first attempts only
+        self.assertEqual(self.stub.requests, 4)
+        stats = self.policy.stats()
+        self.assertEqual((stats["budget_spent"], stats["budget_denied"]), (1, 2))
+
+    def test_deadline_covers_every_attempt(self):
+        self.stub.delay = 1.0
+        cache = self.cache(deadline=0.3, attempt_timeout=5, hedge_delay=0.1, max_attempts=2)
+        started = time.monotonic()
+        with self.assertRaises(ImageFetchError):
+            cache.get(cache.register("slow", 1))
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(self.policy.stats()["deadlines_exceeded"], 1)
+
+
+class FallbackArtTest(unittest.TestCase):
+    """The API serves a node's stand-in picture while the image service is down"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = ImageStubServer().start()
+        cls.directory = tempfile.mkdtemp(prefix="test-fallback-")
+        os.environ.update({
+            "POLLINATIONS_BASE_URL": cls.stub.base_url,
+            "IMAGE_PROXY_ENABLED": "1",
+            "IMAGE_KEY_SECRET": "test",
+            "IMAGE_CACHE_DIR": os.path.join(cls.directory, "images"),
+            "STORY_PACK_CACHE_DIR": os.path.join(cls.directory, "packs"),
+            "IMAGE_HEDGE_DELAY": "0",
+            "IMAGE_MAX_ATTEMPTS": "1",
+            "IMAGE_DEADLINE": "3",
+            "BREAKER_FAILURES": "1",
+            "PREFETCH_ENABLED": "0",
+            "RATE_LIMIT_ENABLED": "0",
+            "SHARE_CARDS_ENABLED": "0",
+            "OUTCOME_RECORDS_ENABLED": "0"
+        })
+        import index
+        cls.index = index
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.shutdown()
+        cls.stub.server_close()
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def test_fallback_art_while_upstream_is_down(self):
+        client = self.index.app.test_client()
+        image_url = client.get("/api/state").get_json()["image_url"]
+        self.stub.down = True
+        try:
+            for _ in range(2):  # a failed fetch, then the open breaker
+                response = client.get(image_url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, "image/svg+xml")
+                self.assertEqual(response.headers["Cache-Control"], "no-store")
+                self.assertIn(b"<svg", response.data)
+            self.assertEqual(self.index.upstream_policy.breaker.state, OPEN)
+        finally:
+            self.stub.down = False
+            self.index.upstream_policy.breaker.record_success()
+
+        # The same node always gets the same picture
+        self.assertEqual(self.index.fallback_art.get("mystic_forest", "start"),
+                         self.index.fallback_art.get("mystic_forest", "start"))
+
+
+if __name__ == "__main__":
+    unittest.main()
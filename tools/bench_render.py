@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the CPU the game API spends per /api/reset and
+/api/choice request.
+
+    python tools/bench_render.py --games 300
+    python tools/bench_render.py --games 300 --against HEAD~1 --against baseline
+
+Plays complete games through Flask's test client (no sockets) with image
+prefetching off and the image service pointed at the local stand-in (the
+image proxy's cache writes are disk I/O rather than rendering, so the proxy
+is off too unless --proxy is given), and reports the median process CPU
+time per request for each endpoint, best of --rounds runs. Each round also
+runs on checkouts of the --against git revisions (alternating, so all see
+the same machine load); "change" is the working tree's median difference
+from a revision over the rounds, each round compared with itself.
+
+The default is to compare with the repository's first commit ("baseline",
+13c7121), since comparing with the previous commit hides regressions that
+build up over several. At the end of the backlog, with proxy, prefetch and
+rate limiting off, the working tree spent 25-50% more CPU per request than
+the baseline (e.g. /api/reset 589 -> 751 us, /api/choice 622 -> 772 us,
+--games 200 --rounds 9). The view functions themselves cost what they did;
+the difference is the request hooks, about 90 us a request: the batched
+session write and its size estimate (~30 us), the compression check
+(~23 us), the latency metrics (~17 us) and the rest (~10 us). A shared machine
+varies by 10-20% between invocations, so only compare the changes within
+one invocation.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+ENDPOINTS = ("/api/reset", "/api/choice")
+
+
+def run_games(tree, games, seed, proxy=False):
+    """Play `games` games on the API in `tree` and time every request"""
+    sys.path.insert(0, TOOLS_DIR)
+    from stubs import ImageStubServer
+
+    scratch = tempfile.mkdtemp(prefix="bench-render-")
+    upstream = ImageStubServer().start()
+    os.environ.update({
+        "POLLINATIONS_BASE_URL": upstream.base_url,
+        "IMAGE_CACHE_DIR": os.path.join(scratch, "images"),
+        "STORY_PACK_CACHE_DIR": os.path.join(scratch, "packs"),
+        "IMAGE_PROXY_ENABLED": "1" if proxy else "0",
+        "PREFETCH_ENABLED": "0"
+    })
+    # Every game starts a session from the same client address
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    sys.path.insert(0, os.path.join(tree, "api"))
+    import index
+
+    rng = random.Random(seed)
+    cpu = {endpoint: [] for endpoint in ENDPOINTS}
+
+    def timed(client, endpoint, payload=None):
+        started = time.process_time()
+        response = client.post(endpoint, json=payload)
+        cpu[endpoint].append(time.process_time() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{endpoint} returned {response.status_code}: {response.data[:200]}")
+        return response.get_json()
+
+    try:
+        for _ in range(games):
+            client = index.app.test_client()
+            state = timed(client, "/api/reset")
+            while not state["is_end"]:
+                choice_index = rng.randrange(len(state["choices"]))
+                state = timed(client, "/api/choice", {"choice_index": choice_index})
+    finally:
+        upstream.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return {endpoint: {"requests": len(samples),
+                       "cpu_us_median": round(statistics.median(samples) * 1e6, 1),
+                       "cpu_us_mean": round(statistics.fmean(samples) * 1e6, 1)}
+            for endpoint, samples in cpu.items() if samples}
+
+
+def bench_tree(tree, games, seed, proxy=False):
+    """Run the benchmark for a tree in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--tree", tree,
+         "--games", str(games), "--seed", str(seed), "--json"] + (["--proxy"] if proxy else []),
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def checkout(revision):
+    """Export a git revision of the repository into a temporary directory"""
+    target = tempfile.mkdtemp(prefix="bench-render-rev-")
+    archive = subprocess.run(["git", "-C", REPO_DIR, "archive", revision],
+                             check=True, capture_output=True).stdout
+    subprocess.run(["tar", "-x", "-C", target], input=archive, check=True)
+    return target
+
+
+def baseline_revision():
+    """The repository's first commit"""
+    return subprocess.run(["git", "-C", REPO_DIR, "rev-list", "--max-parents=0", "HEAD"],
+                          check=True, capture_output=True, text=True).stdout.split()[-1][:7]
+
+
+def print_table(results, changes):
+    labels = list(results)
+    print(f"{'endpoint':<14}" + "".join(f"{label:>18}" for label in labels)
+          + "".join(f"{'vs ' + label:>18}" for label in changes))
+    for endpoint in ENDPOINTS:
+        medians = [results[label].get(endpoint, {}).get("cpu_us_median") for label in labels]
+        row = f"{endpoint:<14}" + "".join(
+            f"{'-' if median is None else f'{median:.1f} us':>18}" for median in medians)
+        for label in changes:
+            samples = changes[label].get(endpoint)
+            row += f"{f'{statistics.median(samples):+.1f}%' if samples else '-':>18}"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--against", metavar="REV", action="append",
+                        help="git revision to compare the working tree with, repeatable "
+                             "(default: the first commit; \"baseline\" names it too)")
+    parser.add_argument("--no-compare", action="store_true",
+                        help="only benchmark the working tree")
+    parser.add_argument("--proxy", action="store_true",
+                        help="serve images through the API's image proxy")
+    parser.add_argument("--tree", default=REPO_DIR, help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    args = parser.parse_args()
+
+    if args.json:
+        print(json.dumps(run_games(args.tree, args.games, args.seed, args.proxy)))
+        return
+
+    revisions = [] if args.no_compare else args.against or ["baseline"]
+    revisions = [baseline_revision() if rev == "baseline" else rev for rev in revisions]
+    trees = {rev: checkout(rev) for rev in dict.fromkeys(revisions)}
+    trees["working tree"] = args.tree
+    results = {label: {} for label in trees}
+    changes = {rev: {} for rev in revisions}
+    try:
+        for _ in range(args.rounds):
+            round_results = {label: bench_tree(tree, args.games, args.seed, args.proxy)
+                             for label, tree in trees.items()}
+            for label, endpoints in round_results.items():
+                for endpoint, result in endpoints.items():
+                    best = results[label].get(endpoint)
+                    if best is None or result["cpu_us_median"] < best["cpu_us_median"]:
+                        results[label][endpoint] = result
+            current = round_results["working tree"]
+            for rev in changes:
+                for endpoint, result in round_results[rev].items():
+                    if endpoint in current:
+                        changes[rev].setdefault(endpoint, []).append(
+                            (current[endpoint]["cpu_us_median"] / result["cpu_us_median"] - 1) * 100)
+    finally:
+        for rev in revisions:
+            shutil.rmtree(trees[rev], ignore_errors=True)
+    print_table(results, changes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Load test for the game API: many simulated players walking the story graph
+at once, with per-endpoint latency percentiles, throughput, memory growth
+and session counts.
+
+    python tools/loadtest.py --players 2000 --concurrency 64
+    python tools/loadtest.py --mode http --players 500 --save baseline.json
+    python tools/loadtest.py --mode http --url http://127.0.0.1:5000 --compare baseline.json
+
+Every player plays whole games: GET /api/state, POST /api/choice until an
+ending, GET /api/share-image, POST /api/reset. Players are interleaved on
+--concurrency worker threads, so thousands of sessions are in flight at
+once without thousands of threads.
+
+--mode inprocess drives the Flask app through its test client; --mode http
+serves it on a local port (or uses --url) and talks to it over real
+sockets. When the app runs in this process the Pollinations service is
+replaced by the stand-in from tools/stubs.py; for --url, start the server
+with POLLINATIONS_BASE_URL pointing at `python tools/stubs.py images`
+(and RATE_LIMIT_ENABLED=0, since every player comes from one address).
+
+Before the load starts the same checks as test-server.py are run (/health,
+/, /api/state and /script.js must answer 200). --save writes the results
+as JSON; --compare fails (exit status 1) when a p95 latency or the request
+rate is more than --tolerance worse than a saved baseline.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+
+
+# --- Transports ---
+class InProcessTransport:
+    """Requests through Flask's test client, no sockets involved"""
+    name = "inprocess"
+
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, session_id=None, payload=None):
+        headers = {"Cookie": f"session_id={session_id}"} if session_id else {}
+        response = self.client.open(path, method=method, json=payload, headers=headers)
+        body = response.get_json(silent=True) if response.is_json else None
+        new_session = _cookie_value(response.headers.getlist("Set-Cookie"))
+        return response.status_code, body, new_session
+
+
+class HttpTransport:
+    """Requests over HTTP with one keep-alive connection pool per worker"""
+    name = "http"
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self._requests = requests
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+            # Players carry their own session cookie; the pool must not
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def request(self, method, path, session_id=None, payload=None):
+        headers = {"Cookie": f"session_id={session_id}"} if session_id else {}
+        response = self._session().request(method, self.base_url + path, json=payload,
+                                           headers=headers, timeout=30)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        new_session = _cookie_value([response.headers.get("Set-Cookie", "")])
+        return response.status_code, body, new_session
+
+
+def _cookie_value(headers):
+    for header in headers:
+        for part in header.split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "session_id":
+                return value
+    return None
+
+
+# --- Players ---
+class Player:
+    """One simulated browser playing `games` games from start to finish"""
+
+    def __init__(self, games, rng):
+        self.games_left = games
+        self.rng = rng
+        self.session_id = None
+        self.state = None
+        self.next_step = "state"
+
+    def step(self, transport, record):
+        """Make this player's next request; returns False once finished"""
+        step = self.next_step
+        if step == "state":
+            status, body = self._call(transport, record, "GET", "/api/state", "/api/state")
+            self.state = body
+        elif step == "choice":
+            choice_index = self.rng.randrange(len(self.state["choices"]))
+            status, body = self._call(transport, record, "POST", "/api/choice", "/api/choice",
+                                      {"choice_index": choice_index})
+            self.state = body
+        elif step == "share":
+            status, body = self._call(transport, record, "GET", "/api/share-image",
+                                      "/api/share-image")
+        else:
+            status, body = self._call(transport, record, "POST", "/api/reset", "/api/reset")
+            self.state = body
+
+        if status != 200 or not isinstance(body, dict):
+            # Start over with a fresh session after an error
+            self.session_id = None
+            self.next_step = "state"
+            self.games_left -= 1
+            return self.games_left > 0
+
+        if step == "share":
+            self.next_step = "reset"
+        elif step == "reset":
+            self.games_left -= 1
+            self.next_step = "choice"
+        else:
+            self.next_step = "share" if self.state.get("is_end") else "choice"
+        return self.games_left > 0
+
+    def _call(self, transport, record, method, path, endpoint, payload=None):
+        started = time.perf_counter()
+        try:
+            status, body, new_session = transport.request(method, path, self.session_id, payload)
+        except Exception as e:
+            record(endpoint, time.perf_counter() - started, False, type(e).__name__)
+            return None, None
+        record(endpoint, time.perf_counter() - started, status == 200, status)
+        if new_session:
+            self.session_id = new_session
+        return status, body
+
+
+class Recorder:
+    """Thread-safe latency and error tally per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def __call__(self, endpoint, seconds, ok, status):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                errors = self.errors.setdefault(endpoint, {})
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def rss_bytes():
+    """Current resident set size (peak size where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_load(transport, players, concurrency, games, seed):
+    rng = random.Random(seed)
+    pending = queue.Queue()
+    for _ in range(players):
+        pending.put(Player(games, random.Random(rng.random())))
+    record = Recorder()
+
+    def worker():
+        while True:
+            try:
+                player = pending.get_nowait()
+            except queue.Empty:
+                return
+            if player.step(transport, record):
+                pending.put(player)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return record, time.perf_counter() - started
+
+
+def summarize(record, elapsed):
+    endpoints = {}
+    total = 0
+    for endpoint, samples in sorted(record.latencies.items()):
+        samples.sort()
+        total += len(samples)
+        endpoints[endpoint] = {
+            "requests": len(samples),
+            "errors": record.errors.get(endpoint, {}),
+            "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+            "max_ms": round(samples[-1] * 1000, 2)
+        }
+    return {
+        "requests": total,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1) if elapsed else None,
+        "endpoints": endpoints
+    }
+
+
+# --- Checks ---
+def preflight(transport):
+    """The test-server.py checks; returns a list of failures"""
+    failures = []
+    for method, path, check in (
+            ("GET", "/health", lambda body: body and body.get("status") == "healthy"),
+            ("GET", "/", None),
+            ("GET", "/api/state", lambda body: body and "situation" in body and "choices" in body),
+            ("GET", "/script.js", None)):
+        try:
+            status, body, _ = transport.request(method, path)
+        except Exception as e:
+            failures.append(f"{path}: {e}")
+            continue
+        if status != 200:
+            failures.append(f"{path}: status {status}")
+        elif check is not None and not check(body):
+            failures.append(f"{path}: unexpected response")
+    return failures
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` against a saved baseline"""
+    problems = []
+    if baseline.get("mode") != results.get("mode"):
+        problems.append(f"baseline was measured in {baseline.get('mode')} mode, "
+                        f"not {results.get('mode')}")
+    old_rps = baseline.get("requests_per_second")
+    new_rps = results.get("requests_per_second")
+    if old_rps and new_rps and new_rps < old_rps * (1 - tolerance):
+        problems.append(f"requests/s {new_rps} vs baseline {old_rps}")
+    for endpoint, old in baseline.get("endpoints", {}).items():
+        new = results["endpoints"].get(endpoint)
+        if new is None:
+            problems.append(f"{endpoint}: no requests")
+        elif new["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            problems.append(f"{endpoint}: p95 {new['p95_ms']} ms vs baseline {old['p95_ms']} ms")
+        elif new["errors"] and not old["errors"]:
+            problems.append(f"{endpoint}: errors {new['errors']}")
+    return problems
+
+
+def print_report(results):
+    print(f"{results['mode']}: {results['players']} players, "
+          f"{results['concurrency']} workers, {results['requests']} requests "
+          f"in {results['seconds']} s ({results['requests_per_second']} req/s)")
+    print(f"{'endpoint':<20}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}  errors")
+    for endpoint, stats in results["endpoints"].items():
+        print(f"{endpoint:<20}{stats['requests']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}  {stats['errors'] or ''}")
+    memory = results.get("rss_bytes")
+    if memory:
+        print(f"RSS {memory['before'] / 2**20:.1f} MiB -> {memory['after'] / 2**20:.1f} MiB "
+              f"({(memory['after'] - memory['before']) / 2**20:+.1f} MiB)")
+    sessions = results.get("sessions")
+    if sessions:
+        print(f"sessions: {sessions.get('sessions')} live "
+              f"({sessions.get('backend')}, {sessions.get('bytes', '?')} bytes)")
+
+
+# --- Setup ---
+def load_app():
+    """Import the API with its image service replaced by the local stand-in"""
+    sys.path.insert(0, TOOLS_DIR)
+    from stubs import ImageStubServer
+
+    upstream = ImageStubServer().start()
+    scratch = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.setdefault("POLLINATIONS_BASE_URL", upstream.base_url)
+    os.environ.setdefault("IMAGE_CACHE_DIR", os.path.join(scratch, "images"))
+    os.environ.setdefault("STORY_PACK_CACHE_DIR", os.path.join(scratch, "packs"))
+    # Every simulated player comes from this one address
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    sys.path.insert(0, os.path.join(REPO_DIR, "api"))
+    import index
+    return index.app, upstream, scratch
+
+
+def serve(app):
+    """Serve the app on a free local port in background threads"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--url", help="load an already running server (implies --mode http)")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--games", type=int, default=1, help="games per player")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON to check against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    app = upstream = server = scratch = None
+    if args.url:
+        args.mode = "http"
+        transport = HttpTransport(args.url)
+    else:
+        app, upstream, scratch = load_app()
+        if args.mode == "http":
+            server, url = serve(app)
+            transport = HttpTransport(url)
+        else:
+            transport = InProcessTransport(app)
+
+    try:
+        failures = preflight(transport)
+        if failures:
+            print("Preflight failed:\n  " + "\n  ".join(failures))
+            return 1
+
+        rss_before = rss_bytes() if app else None
+        record, elapsed = run_load(transport, args.players, args.concurrency, args.games, args.seed)
+        results = summarize(record, elapsed)
+        results.update({
+            "mode": transport.name,
+            "players": args.players,
+            "concurrency": args.concurrency,
+            "games": args.games
+        })
+        if app:
+            results["rss_bytes"] = {"before": rss_before, "after": rss_bytes()}
+        status, health, _ = transport.request("GET", "/health")
+        if status == 200 and health:
+            results["sessions"] = health.get("sessions")
+    finally:
+        if server:
+            server.shutdown()
+        if upstream:
+            upstream.shutdown()
+        if scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    print_report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved results to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        if problems:
+            print("Regressions against " + args.compare + ":\n  " + "\n  ".join(problems))
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Sync the local index of ForestAdventure story outcomes outside the API.
+
+    python tools/outcome_indexer.py --rpc https://testnet.evm.nodes.onflow.org --once
+    python tools/outcome_indexer.py --rpc http://127.0.0.1:8545/ --db /var/lib/mff/outcomes.db
+
+Writes the same SQLite database the API reads for /api/leaderboard and
+/api/stories/<id>. Use it where the API can't keep a background thread
+(serverless) and set OUTCOME_POLL_SECONDS=0 there; the checkpoint lives in
+the database, so runs pick up where the last one stopped.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+from _outcome_index import IndexerError, OutcomeIndex  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rpc", default=os.environ.get("OUTCOME_RPC_URL"), help="JSON-RPC URL")
+    parser.add_argument("--contract", default=os.environ.get(
+        "OUTCOME_CONTRACT", "0xafa6C385c1B6D26Fda55f1a576828B75E9F9FD6c"))
+    parser.add_argument("--db", default=os.environ.get(
+        "OUTCOME_INDEX_DB", os.path.join(tempfile.gettempdir(), "mystic-forest-outcomes.db")))
+    parser.add_argument("--start-block", type=int, default=int(os.environ.get("OUTCOME_START_BLOCK", 0)))
+    parser.add_argument("--block-range", type=int, default=2000)
+    parser.add_argument("--confirmations", type=int, default=2)
+    parser.add_argument("--interval", type=float, default=15.0, help="seconds between syncs")
+    parser.add_argument("--once", action="store_true", help="sync to the chain head and exit")
+    args = parser.parse_args()
+    if not args.rpc:
+        parser.error("--rpc (or OUTCOME_RPC_URL) is required")
+
+    index = OutcomeIndex(args.db, args.rpc, args.contract, start_block=args.start_block,
+                         block_range=args.block_range, confirmations=args.confirmations)
+    while True:
+        started = time.perf_counter()
+        try:
+            events = index.sync_once()
+            stats = index.stats()
+            print(f"{events} events in {time.perf_counter() - started:.2f}s; "
+                  f"{stats['stories']} stories indexed to block {stats['checkpoint'] - 1}")
+        except IndexerError as e:
+            print(f"Sync failed: {str(e)}")
+            if args.once:
+                sys.exit(1)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
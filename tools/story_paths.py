@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Enumerate every way through a story pack and report what the endings add
+up to.
+
+    python tools/story_paths.py                       # all packs in packs/
+    python tools/story_paths.py --pack mystic_forest --json
+    python tools/story_paths.py --check               # for CI
+    python tools/story_paths.py --priorities prefetch-priorities.json
+
+Walks all choice sequences from the start node with a memoized DFS. What
+happens after a node only depends on the node, the score and the tag
+balance the ending rules read (api/_endings.py), so that triple is the
+memo key and the work grows with the number of distinct states rather than
+the number of paths. For each pack it prints the number of distinct choice
+sequences, every ending's path count and probability when each choice is
+equally likely (with `_calculate_end` variants equally likely too), the
+score and balance the ending is reached with, and how often each node is
+visited.
+
+--check exits non-zero when a pack doesn't load, has a loop, or has an
+ending node no path reaches (generic endings that only stand in for
+missing variants excepted). It also plays every choice sequence through
+the API's own apply_choice and fails if the endings that gives differ from
+the enumeration. --priorities writes the node visit probabilities in the
+form PREFETCH_PRIORITIES reads, so the API prefetches the likeliest
+branches first.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "api"))
+
+from _story_graph import CALCULATE_END  # noqa: E402
+from _story_pack import PACK_EXTENSIONS, load_pack  # noqa: E402
+
+
+class StoryLoopError(ValueError):
+    """The story graph has a cycle, so its paths can't be enumerated"""
+
+
+def topological_order(graph):
+    """Node indexes with every node before the nodes its choices lead to"""
+    incoming = [0] * len(graph)
+    for node in graph:
+        for choice in node.choices:
+            if choice.next_index not in (CALCULATE_END, None):
+                incoming[choice.next_index] += 1
+    ready = [node.index for node in graph if incoming[node.index] == 0]
+    order = []
+    while ready:
+        index = ready.pop()
+        order.append(index)
+        for choice in graph.nodes[index].choices:
+            if choice.next_index not in (CALCULATE_END, None):
+                incoming[choice.next_index] -= 1
+                if incoming[choice.next_index] == 0:
+                    ready.append(choice.next_index)
+    if len(order) != len(graph):
+        looped = sorted(graph.nodes[i].id for i in range(len(graph)) if incoming[i] > 0)
+        raise StoryLoopError(f"story has a loop through {', '.join(looped)}")
+    return order
+
+
+class PathAnalysis:
+    """All paths through one pack's story graph"""
+
+    def __init__(self, pack):
+        self.pack = pack
+        self.graph = pack.graph
+        self.order = topological_order(self.graph)
+        # (node index, score, balance) -> (sequences, {ending: {(score, balance): [paths, p]}})
+        self._memo = {}
+        self.sequences, self.outcomes = self._explore(self.graph.start.index, 0, 0)
+
+    def _explore(self, node_index, score, balance):
+        key = (node_index, score, balance)
+        found = self._memo.get(key)
+        if found is not None:
+            return found
+        node = self.graph.nodes[node_index]
+        if node.is_end:
+            found = (1, {node.id: {(score, balance): [1, 1.0]}})
+            self._memo[key] = found
+            return found
+
+        sequences = 0
+        outcomes = {}
+        share = 1.0 / len(node.choices)
+        for choice in node.choices:
+            next_score = score + choice.score_modifier
+            next_balance = balance + choice.weight
+            if choice.next_index == CALCULATE_END:
+                # One sequence; which variant it ends on depends on the
+                # session. Like resolve_next_node, classify the state the
+                # choice is taken in; the game still ends with its modifier
+                candidates = self.pack.resolver.candidates(score, balance)
+                sequences += 1
+                child = {ending: {(next_score, next_balance): [1, 1.0 / len(candidates)]}
+                         for ending in candidates}
+            else:
+                child_sequences, child = self._explore(choice.next_index, next_score, next_balance)
+                sequences += child_sequences
+            for ending, finals in child.items():
+                merged = outcomes.setdefault(ending, {})
+                for final, (paths, probability) in finals.items():
+                    entry = merged.setdefault(final, [0, 0.0])
+                    entry[0] += paths
+                    entry[1] += probability * share
+        found = (sequences, outcomes)
+        self._memo[key] = found
+        return found
+
+    @property
+    def states(self):
+        return len(self._memo)
+
+    def endings(self):
+        """Per ending: paths, probability and the scores/balances it is reached with"""
+        table = {}
+        for ending, finals in self.outcomes.items():
+            paths = sum(entry[0] for entry in finals.values())
+            probability = sum(entry[1] for entry in finals.values())
+            scores = {}
+            for (score, _), (_, p) in finals.items():
+                scores[score] = scores.get(score, 0.0) + p / probability
+            table[ending] = {
+                "category": self.graph.get(ending).ending_category,
+                "paths": paths,
+                "probability": probability,
+                "score_min": min(score for score, _ in finals),
+                "score_max": max(score for score, _ in finals),
+                "score_mean": sum(s * p for (s, _), (_, p) in finals.items()) / probability,
+                "balance_mean": sum(b * p for (_, b), (_, p) in finals.items()) / probability,
+                "score_distribution": dict(sorted(scores.items()))
+            }
+        return dict(sorted(table.items(), key=lambda item: (-item[1]["probability"], item[0])))
+
+    def visits(self):
+        """Probability that a game passes through each node"""
+        visits = [0.0] * len(self.graph)
+        visits[self.graph.start.index] = 1.0
+        for index in self.order:
+            node = self.graph.nodes[index]
+            if node.is_end or not visits[index]:
+                continue
+            share = visits[index] / len(node.choices)
+            for choice in node.choices:
+                if choice.next_index != CALCULATE_END:
+                    visits[choice.next_index] += share
+        # End nodes can also be reached through _calculate_end; every game
+        # ends exactly once, so the ending probabilities are exact
+        for node in self.graph:
+            if node.is_end:
+                visits[node.index] = sum(entry[1] for entry in self.outcomes.get(node.id, {}).values())
+        return dict(sorted(((node.id, visits[node.index]) for node in self.graph),
+                           key=lambda item: (-item[1], item[0])))
+
+    def problems(self):
+        """Endings that no path reaches
+
+        A generic ending with variants is only a fallback for variants
+        missing from the graph, so it is allowed to be unreachable.
+        """
+        problems = []
+        fallbacks = {generic for generic, variants in self.graph.endings.items()
+                     if any(variant in self.graph for variant in variants)}
+        for node in self.graph:
+            if node.is_end and node.id not in self.outcomes and node.id not in fallbacks:
+                problems.append(f"{self.pack.id}: ending {node.id!r} is never reached")
+        # The resolver's own reachability has to agree with the enumeration
+        reachable = self.pack.resolver.reachable(self.graph.start.index)
+        if reachable != set(self.outcomes):
+            problems.append(f"{self.pack.id}: resolver reaches {sorted(reachable)}, "
+                            f"enumeration reaches {sorted(self.outcomes)}")
+        return problems
+
+    def replay_problems(self, api):
+        """Differences between the enumeration and games played through the API
+
+        Plays every choice sequence with `api.apply_choice` (api is the
+        imported api/index.py) and counts, per ending, the sequences that
+        can end there and their probability, as `endings()` does.
+        """
+        pack = api.story_packs.current(self.pack.id)
+        if pack is None or pack.version != self.pack.version:
+            return [f"{self.pack.id}: the API has a different version of this pack loaded"]
+        variants_of = {variant: generic for generic, variants in self.graph.endings.items()
+                       for variant in variants}
+        played = {}
+        session_id = f"story-paths-{self.pack.id}"
+        with api.app.test_request_context():
+            api.reset_game_state(session_id, pack)
+            journey, _, view = api.load_game(session_id, api.session_store.peek(session_id))
+            stack = [(journey, view, 1.0, False)]
+            while stack:
+                journey, view, probability, calculated = stack.pop()
+                node = self.graph.nodes[journey.current]
+                if node.is_end:
+                    endings = [node.id]
+                    if calculated:
+                        # The session picked one variant; any of them was as likely
+                        generic = variants_of.get(node.id, node.id)
+                        endings = [variant for variant in self.graph.endings.get(generic, ())
+                                   if variant in self.graph] or [generic]
+                    for ending in endings:
+                        entry = played.setdefault(ending, [0, 0.0])
+                        entry[0] += 1
+                        entry[1] += probability / len(endings)
+                    continue
+                for index, choice in enumerate(node.choices):
+                    branch = journey.copy()
+                    after, error = api.apply_choice(branch, view, index, session_id, pack)
+                    if error:
+                        return [f"{self.pack.id}: replay failed at {node.id!r}: {error}"]
+                    stack.append((branch, after, probability / len(node.choices),
+                                  choice.next_index == CALCULATE_END))
+            api.session_store.end_request()
+
+        problems = []
+        enumerated = self.endings()
+        for ending in sorted(set(played) | set(enumerated)):
+            paths, probability = played.get(ending, (0, 0.0))
+            row = enumerated.get(ending, {"paths": 0, "probability": 0.0})
+            if paths != row["paths"] or abs(probability - row["probability"]) > 1e-9:
+                problems.append(f"{self.pack.id}: ending {ending!r} is reached by {paths} played "
+                                f"paths ({probability:.4f}), enumeration says {row['paths']} "
+                                f"({row['probability']:.4f})")
+        return problems
+
+    def report(self):
+        return {
+            "version": self.pack.version,
+            "nodes": len(self.graph),
+            "sequences": self.sequences,
+            "states": self.states,
+            "endings": self.endings(),
+            "visits": self.visits(),
+            "problems": self.problems()
+        }
+
+
+def load_api(packs_dir):
+    """Import api/index.py quietly, on the same pack directory, for replays"""
+    os.environ.setdefault("STORY_PACK_DIR", packs_dir)
+    for name in ("IMAGE_PROXY_ENABLED", "PREFETCH_ENABLED", "RATE_LIMIT_ENABLED", "METRICS_ENABLED",
+                 "OUTCOME_RECORDS_ENABLED", "SHARE_CARDS_ENABLED"):
+        os.environ.setdefault(name, "0")
+    os.environ.setdefault("SESSION_BACKEND", "memory")
+    import index
+    return index
+
+
+def pack_files(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(PACK_EXTENSIONS))
+
+
+def print_report(pack_id, report, top):
+    print(f"{pack_id} (version {report['version']}, {report['nodes']} nodes)")
+    print(f"  choice sequences: {report['sequences']}   states explored: {report['states']}")
+    print(f"  {'ending':<28}{'category':<24}{'paths':>7}{'prob':>8}{'score min/mean/max':>22}"
+          f"{'balance':>9}")
+    for ending, row in report["endings"].items():
+        scores = f"{row['score_min']}/{row['score_mean']:.1f}/{row['score_max']}"
+        print(f"  {ending:<28}{row['category']:<24}{row['paths']:>7}"
+              f"{row['probability'] * 100:>7.1f}%{scores:>22}{row['balance_mean']:>9.2f}")
+    print("  hottest nodes (probability a game visits them):")
+    for node_id, probability in list(report["visits"].items())[:top]:
+        print(f"    {node_id:<32}{probability * 100:>6.1f}%")
+    for problem in report["problems"]:
+        print(f"  PROBLEM: {problem}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packs", default=os.path.join(REPO_DIR, "packs"),
+                        help="directory of pack files")
+    parser.add_argument("--pack", action="append", help="only these pack ids")
+    parser.add_argument("--json", action="store_true", help="print the full reports as JSON")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if a pack fails to load or has unreachable endings")
+    parser.add_argument("--priorities", metavar="FILE",
+                        help="write node visit probabilities for PREFETCH_PRIORITIES")
+    parser.add_argument("--top", type=int, default=10, help="hot nodes to list")
+    args = parser.parse_args()
+
+    api = load_api(args.packs) if args.check else None
+    reports = {}
+    problems = []
+    for path in pack_files(args.packs):
+        try:
+            pack = load_pack(path)
+            if args.pack and pack.id not in args.pack:
+                continue
+            analysis = PathAnalysis(pack)
+            reports[pack.id] = analysis.report()
+            if api is not None:
+                reports[pack.id]["problems"].extend(analysis.replay_problems(api))
+        except Exception as e:
+            problems.append(f"{os.path.basename(path)}: {e}")
+            continue
+        problems.extend(reports[pack.id]["problems"])
+
+    if args.json:
+        print(json.dumps({"packs": reports, "problems": problems}, indent=2,
+                         default=lambda value: str(value)))
+    else:
+        for pack_id, report in reports.items():
+            print_report(pack_id, report, args.top)
+        for problem in problems:
+            if not any(problem in report["problems"] for report in reports.values()):
+                print(f"PROBLEM: {problem}")
+
+    if args.priorities:
+        with open(args.priorities, "w") as f:
+            json.dump({pack_id: report["visits"] for pack_id, report in reports.items()}, f, indent=2)
+            f.write("\n")
+
+    if args.check:
+        if problems:
+            sys.exit(1)
+        print(f"OK: every ending is reachable in {len(reports)} pack(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the external services the game API talks to, so it can
+be exercised without network access.
+
+    python tools/stubs.py redis --port 6380
+    python tools/stubs.py images --port 8090 --delay 0.5
+    python tools/stubs.py images --port 8090 --fail-rate 0.3 --slow-rate 0.1 --slow-delay 20
+    python tools/stubs.py chain --port 8545 --stories 200
+
+Point the API at the image stand-in with
+POLLINATIONS_BASE_URL=http://127.0.0.1:8090/prompt/, and the story outcome
+index at the chain stand-in with OUTCOME_RPC_URL=http://127.0.0.1:8545/
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import random
+import socketserver
+import struct
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+
+from _outcome_index import GET_STORY_OUTCOME, STORY_CREATED, STORY_UPDATED  # noqa: E402
+
+
+# --- Pollinations stand-in ---
+def solid_png(width, height, rgb):
+    """Encode a single-colour RGB PNG"""
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b""))
+
+
+class _ImageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.paths.append(self.path)
+            fail = server.rng.random() < server.fail_rate
+            slow = server.rng.random() < server.slow_rate
+        if server.down:
+            # Drop the connection without answering, like a crashed service
+            self.close_connection = True
+            return
+        if server.delay:
+            time.sleep(server.delay)
+        if slow:
+            time.sleep(server.slow_delay)
+        if fail:
+            body = b"Service Unavailable"
+            self.send_response(server.fail_status)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        # Same URL, same picture, like the real service with a fixed seed
+        digest = hashlib.sha256(self.path.encode()).digest()
+        body = solid_png(64, 64, digest[:3])
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageStubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Returns a small deterministic PNG for every /prompt/... request
+
+    Faults can be injected, and changed while it runs: `fail_rate` of the
+    requests get `fail_status`, `slow_rate` of them take `slow_delay`
+    seconds longer, and with `down` set every connection is dropped.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024  # load tests open hundreds of connections at once
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, fail_rate=0.0, fail_status=503,
+                 slow_rate=0.0, slow_delay=0.0, down=False, seed=0):
+        super().__init__((host, port), _ImageHandler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.down = down
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.paths = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}/prompt/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# --- Redis-protocol stand-in ---
+class _RespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                command = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if command is None:
+                return
+            self.wfile.write(server.dispatch(command))
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("inline commands are not supported")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+
+class RespStubServer(socketserver.ThreadingTCPServer):
+    """In-memory server speaking enough of the Redis protocol for the API"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _RespHandler)
+        self.data = {}
+        self.expiry = {}
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def _alive(self, key):
+        expires_at = self.expiry.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def dispatch(self, args):
+        name = args[0].upper().decode()
+        with self.lock:
+            self.commands += 1
+            handler = getattr(self, "cmd_" + name.lower(), None)
+            if handler is None:
+                return b"-ERR unknown command '%s'\r\n" % name.encode()
+            return handler(*args[1:])
+
+    def cmd_ping(self, *args):
+        return b"+PONG\r\n"
+
+    def cmd_select(self, db):
+        return b"+OK\r\n"
+
+    def cmd_auth(self, *args):
+        return b"+OK\r\n"
+
+    def cmd_get(self, key):
+        if not self._alive(key):
+            return b"$-1\r\n"
+        value = self.data[key]
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def cmd_set(self, key, value, *options):
+        self.data[key] = value
+        self.expiry.pop(key, None)
+        options = [option.upper() for option in options]
+        if b"EX" in options:
+            self.expiry[key] = time.time() + int(options[options.index(b"EX") + 1])
+        return b"+OK\r\n"
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.data[key]) if self._alive(key) else 0
+        value += int(amount)
+        self.data[key] = str(value).encode()
+        return b":%d\r\n" % value
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return b":%d\r\n" % removed
+
+    def cmd_expire(self, key, seconds):
+        if not self._alive(key):
+            return b":0\r\n"
+        self.expiry[key] = time.time() + int(seconds)
+        return b":1\r\n"
+
+    def cmd_dbsize(self):
+        return b":%d\r\n" % sum(1 for key in list(self.data) if self._alive(key))
+
+
+# --- JSON-RPC chain stand-in ---
+def _abi_word(value):
+    return value.to_bytes(32, "big")
+
+
+def _abi_string(text):
+    data = text.encode()
+    return _abi_word(len(data)) + data + b"\x00" * (-len(data) % 32)
+
+
+def _abi_encode(*values):
+    """ABI-encode ints and strings (strings as dynamic values)"""
+    head_size = 32 * len(values)
+    head = b""
+    tail = b""
+    for value in values:
+        if isinstance(value, str):
+            head += _abi_word(head_size + len(tail))
+            tail += _abi_string(value)
+        else:
+            head += _abi_word(value)
+    return head + tail
+
+
+class _RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class _RpcHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if isinstance(payload, list):
+            self.server.batches += 1
+            body = json.dumps([self._reply(request) for request in payload]).encode()
+        else:
+            body = json.dumps(self._reply(payload)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply(self, request):
+        result, error = self.server.dispatch(request.get("method"), request.get("params") or [])
+        reply = {"jsonrpc": "2.0", "id": request.get("id")}
+        if error:
+            reply["error"] = error
+        else:
+            reply["result"] = result
+        return reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ChainStubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An EVM JSON-RPC node with one ForestAdventure contract on it
+
+    `create_story` and `update_story` mine a block holding the call's event,
+    `mine` adds empty blocks. eth_getLogs refuses queries that would return
+    more than max_logs entries, like hosted nodes do.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0,
+                 contract="0xafa6c385c1b6d26fda55f1a576828b75e9f9fd6c", max_logs=1000):
+        super().__init__((host, port), _RpcHandler)
+        self.contract = contract.lower()
+        self.max_logs = max_logs
+        self.block = 0
+        self.logs = []
+        self.stories = {}  # story id -> [ending, score, image, manga image, player, timestamp]
+        self.calls = {}  # method -> count
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # --- Transactions ---
+    def mine(self, blocks=1):
+        with self.lock:
+            self.block += blocks
+
+    def _log(self, topics, data):
+        self.block += 1
+        self.logs.append({
+            "address": self.contract,
+            "topics": topics,
+            "data": "0x" + data.hex(),
+            "blockNumber": hex(self.block),
+            "transactionHash": "0x" + hashlib.sha256(b"%d:%d" % (self.block, len(self.logs))).hexdigest(),
+            "logIndex": "0x0",
+            "removed": False
+        })
+
+    def create_story(self, player, ending_category, score, image_url="", manga_image_url=""):
+        with self.lock:
+            story_id = len(self.stories) + 1
+            self.stories[story_id] = [ending_category, score, image_url, manga_image_url,
+                                      player.lower(), 1700000000 + self.block + 1]
+            self._log([STORY_CREATED, "0x" + _abi_word(story_id).hex(),
+                       "0x" + _abi_word(int(player, 16)).hex()],
+                      _abi_encode(ending_category, score))
+            return story_id
+
+    def update_story(self, story_id, image_url):
+        with self.lock:
+            self.stories[story_id][2] = image_url
+            self._log([STORY_UPDATED, "0x" + _abi_word(story_id).hex()], _abi_encode(image_url))
+
+    # --- JSON-RPC ---
+    def dispatch(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            handler = getattr(self, "rpc_" + str(method), None)
+            if handler is None:
+                return None, {"code": -32601, "message": f"the method {method} does not exist"}
+            try:
+                return handler(*params), None
+            except _RpcError as e:
+                return None, {"code": e.code, "message": str(e)}
+            except (KeyError, ValueError, TypeError) as e:
+                return None, {"code": -32602, "message": f"invalid params: {str(e)}"}
+
+    def rpc_eth_chainId(self):
+        return hex(545)
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.block)
+
+    def rpc_eth_getLogs(self, query):
+        start = int(query.get("fromBlock", "0x0"), 16)
+        end = self.block if query.get("toBlock", "latest") == "latest" else int(query["toBlock"], 16)
+        wanted = (query.get("topics") or [None])[0]
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        found = [log for log in self.logs
+                 if start <= int(log["blockNumber"], 16) <= end
+                 and log["address"] == str(query.get("address", log["address"])).lower()
+                 and (not wanted or log["topics"][0] in wanted)]
+        if len(found) > self.max_logs:
+            raise _RpcError(-32005, f"query returned more than {self.max_logs} results")
+        return found
+
+    def rpc_eth_call(self, call, block="latest"):
+        data = bytes.fromhex(call["data"][2:])
+        if call["to"].lower() != self.contract or data[:4] != GET_STORY_OUTCOME:
+            raise ValueError("unknown call")
+        story_id = int.from_bytes(data[4:36], "big")
+        ending, score, image_url, manga_image_url, player, timestamp = self.stories.get(
+            story_id, ["", 0, "", "", "0x" + "00" * 20, 0])
+        stored_id = story_id if story_id in self.stories else 0
+        return "0x" + _abi_encode(stored_id, ending, score, image_url, manga_image_url,
+                                  int(player, 16), timestamp).hex()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="service", required=True)
+    redis = sub.add_parser("redis", help="Redis-protocol session store")
+    redis.add_argument("--port", type=int, default=6380)
+    images = sub.add_parser("images", help="Pollinations image service")
+    images.add_argument("--port", type=int, default=8090)
+    images.add_argument("--delay", type=float, default=0.0,
+                        help="seconds to wait before answering, like a slow render")
+    images.add_argument("--fail-rate", type=float, default=0.0, help="share of requests that fail")
+    images.add_argument("--fail-status", type=int, default=503, help="status of a failed request")
+    images.add_argument("--slow-rate", type=float, default=0.0,
+                        help="share of requests that take --slow-delay seconds longer")
+    images.add_argument("--slow-delay", type=float, default=10.0)
+    images.add_argument("--down", action="store_true", help="drop every connection")
+    chain = sub.add_parser("chain", help="EVM JSON-RPC node with the ForestAdventure contract")
+    chain.add_argument("--port", type=int, default=8545)
+    chain.add_argument("--stories", type=int, default=0, help="random outcomes to create first")
+    chain.add_argument("--max-logs", type=int, default=1000,
+                       help="most logs one eth_getLogs call may return")
+    args = parser.parse_args()
+
+    if args.service == "redis":
+        server = RespStubServer(port=args.port)
+        print(f"Redis stand-in listening on {server.url}")
+        server.serve_forever()
+    elif args.service == "images":
+        server = ImageStubServer(port=args.port, delay=args.delay, fail_rate=args.fail_rate,
+                                 fail_status=args.fail_status, slow_rate=args.slow_rate,
+                                 slow_delay=args.slow_delay, down=args.down)
+        print(f"Image stand-in listening on {server.base_url}")
+        server.serve_forever()
+    elif args.service == "chain":
+        server = ChainStubServer(port=args.port, max_logs=args.max_logs)
+        rng = random.Random(0)
+        endings = ["Heroic Savior", "Wise Mage", "Forest Guardian", "Lost Soul", "Forest Merchant"]
+        for _ in range(args.stories):
+            story_id = server.create_story("0x%040x" % rng.getrandbits(160), rng.choice(endings),
+                                           rng.randint(0, 12), f"https://example.com/{rng.random()}")
+            if rng.random() < 0.1:
+                server.update_story(story_id, f"https://example.com/{rng.random()}")
+            server.mine(rng.randint(0, 3))
+        print(f"Chain stand-in listening on {server.url} ({server.block} blocks, "
+              f"{len(server.stories)} stories)")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()